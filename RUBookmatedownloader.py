@@ -1,5 +1,4 @@
 import asyncio
-import zipfile
 import random
 import os
 import time
@@ -9,13 +8,18 @@ import warnings
 import json
 import argparse
 import shutil
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
+import threading
+import functools
+import contextlib
+import socket
+import struct
+import subprocess
+import zlib
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
 import httpx
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from PIL import Image
+# Тяжёлые библиотеки конвертации (ebooklib, bs4, reportlab, PIL, zipfile) импортируются
+# внутри функций, которым они нужны: аудиокниги и auth их не загружают.
 
 # ============
 # Graceful exit
@@ -24,6 +28,26 @@ class GracefulExit(SystemExit):
     """Управляемый выход без трейсбеков (например, по Ctrl+C)."""
     pass
 
+
+class StallError(Exception):
+    """Поток скачивания «завис»: нет первого байта за ttfb_budget или скорость ниже stall_min_bps."""
+
+
+class DownloadError(Exception):
+    """Запрос/скачивание не удалось после всех попыток — падает один ресурс, а не весь запуск."""
+
+    def __init__(self, message: str, url: str = "", status: int | None = None):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+
+
+# Коды завершения процесса
+EXIT_OK = 0
+EXIT_FAILED = 1      # ничего не скачано / локальная команда нашла проблемы
+EXIT_USAGE = 2       # неверные аргументы / неизвестная цель
+EXIT_PARTIAL = 3     # пакет: часть ресурсов не скачалась (см. файл неудач)
+
 def run_async_safely(coro):
     """Запускает корутину и гасит Ctrl+C без трейcбека."""
     try:
@@ -46,6 +70,45 @@ CONFIG = {
     "throttle": 0.0,             # «вежливая» задержка между скачиванием треков (сек). 0 = выкл
     "force_meta": False,         # перезаписывать jpeg/json/info.txt, даже если существуют
     "proxy_url": None,           # строка прокси: socks5h://127.0.0.1:9050 или http://127.0.0.1:8080
+    "jobs": 1,                   # число параллельных ресурсов в пакетном режиме
+    "schedule": "fifo",          # порядок пакета: fifo | longest | shortest | fair
+    "sched_est_bps": 1_500_000.0,  # оценка скорости (байт/с) для прогноза, пока нет замера прошлых запусков
+    "sched_audio_kbps": 64.0,    # оценка битрейта аудио, если размеров в playlists.json нет
+    "write_block": 1024 * 1024,  # размер блока записи на диск (байт); чтение из сети идёт по 64 KiB
+    "write_buffer_blocks": 4,    # сколько блоков может ждать записи (write-behind), дальше — backpressure
+    "fsync": False,              # fsync файла перед os.replace (явная гарантия сохранности)
+    "blob_store": None,          # каталог хранилища по содержимому (UUID + sha256); None = выкл
+    "index_db": "mybooks/.library.sqlite",  # индекс библиотеки (обновляется по мере загрузки)
+    "rate_limit": 0,             # общий лимит скорости скачивания (байт/с) на все потоки; 0 = без лимита
+    "rate_schedule": "",         # лимит по времени суток: "09:00-18:00=2M,18:00-09:00=0"
+    "formats": {},               # выбранные форматы по типам ресурсов (--formats); пусто = DEFAULT_FORMATS
+    "pdf_font": None,            # TTF для текстового PDF (по умолчанию — DejaVu/Liberation/Arial)
+    "rate_file": None,           # файл с лимитом/расписанием; перечитывается на ходу при изменении
+    "deferred_retries": 1,       # сколько раз в конце пакета повторять упавшие ресурсы; 0 = выкл
+    "deferred_delay": 60.0,      # пауза перед повторным проходом (сек)
+    "deferred_backoff_factor": 4.0,  # во сколько раз увеличить бэкофф на повторном проходе
+    "failures_file": "failed.txt",   # куда записать окончательно упавшие ресурсы (формат batch-файла)
+    "leases": True,              # пакет: аренда ресурсов, чтобы несколько хостов делили один batch-файл
+    "lease_dir": "mybooks/.leases",  # каталог файлов аренды (должен быть общим для всех хостов)
+    "lease_ttl": 300.0,          # аренда без heartbeat дольше этого (сек) считается брошенной
+    "audio_budget_mb": 0,        # лучшее качество аудиокниги, укладывающееся в N МБ на книгу; 0 = без бюджета
+    "audio_max_kbps": 0,         # не брать варианты трека с битрейтом выше X кбит/с; 0 = без лимита
+    "transcode": None,           # (codec, bitrate) — перекодировать аудиокниги после загрузки; None = хранить как есть
+    "transcode_jobs": 0,         # сколько ffmpeg одновременно при перекодировании; 0 = по числу ядер
+    "stall_min_bps": 16 * 1024,  # минимальная скорость потока (байт/с) за окно stall_window; 0 = не следить
+    "stall_window": 30.0,        # окно усреднения скорости (сек сетевого ожидания)
+    "ttfb_budget": 30.0,         # сколько ждать первый байт тела ответа (сек); 0 = без лимита
+    "hedge": False,              # дублировать медленные GET метаданных (info/playlists), побеждает первый ответ
+    "hedge_percentile": 0.95,    # задержка дубля — этот перцентиль недавних задержек ответа
+    "hedge_min_delay": 0.5,      # но не меньше (сек)
+    "hedge_max_ratio": 0.1,      # не больше такой доли запросов дублируется (ограничение нагрузки на API)
+    "merge_mode": "physical",    # склейка глав: physical — один файл ffmpeg; virtual — оглавление M3U8/CUE/ffmetadata
+    "sink": None,                # куда отдавать готовые ресурсы: каталог или s3://bucket/prefix; None = оставить в mybooks/
+    "sink_pack": None,           # "tar" | "zip" — ресурс одним архивом; None = файлами
+    "keep_local": False,         # не удалять локальную копию после публикации в приёмник
+    "s3_endpoint": None,         # S3-совместимый endpoint (MinIO и т.п.); None = AWS_ENDPOINT_URL или AWS
+    "s3_region": None,           # регион подписи SigV4; None = AWS_REGION или us-east-1
+    "s3_part_mb": 8,             # размер части multipart-загрузки (МБ, не меньше 5)
 }
 
 UA = {
@@ -106,6 +169,8 @@ URLS = {
 # =========================
 ARCHIVE_FILE = "archive.txt"
 _archive_cache: set[str] | None = None
+_archive_offset = 0
+_archive_lock = threading.Lock()
 
 def init_archive(path: str | None = None):
     """Initialize archive cache and optionally set custom archive file path."""
@@ -113,32 +178,355 @@ def init_archive(path: str | None = None):
     if path:
         ARCHIVE_FILE = path
     if _archive_cache is None:
-        try:
-            with open(ARCHIVE_FILE, 'r', encoding='utf-8') as f:
-                _archive_cache = set(line.strip() for line in f if line.strip())
-        except FileNotFoundError:
-            _archive_cache = set()
+        with _archive_lock:
+            _refresh_archive()
     return _archive_cache
 
+def _refresh_archive():
+    """Дочитывает строки, дописанные в архив другими процессами/хостами (под _archive_lock)."""
+    global _archive_cache, _archive_offset
+    try:
+        size = os.path.getsize(ARCHIVE_FILE)
+    except OSError:
+        size = 0
+    if _archive_cache is None or size < _archive_offset:
+        _archive_cache, _archive_offset = set(), 0
+    if size == _archive_offset:
+        return
+    with open(ARCHIVE_FILE, 'rb') as f:
+        f.seek(_archive_offset)
+        chunk = f.read(size - _archive_offset)
+    complete = chunk.rfind(b"\n") + 1  # недописанную строку оставляем на следующий раз
+    _archive_cache.update(ln.strip() for ln in chunk[:complete].decode('utf-8', 'replace').splitlines() if ln.strip())
+    _archive_offset += complete
+
 def is_archived(uid: str) -> bool:
-    """Return True if the given resource id is present in archive."""
-    return uid.strip() in init_archive()
+    """Return True if the given resource id is present in archive (re-reads lines appended by other hosts)."""
+    init_archive()
+    with _archive_lock:
+        _refresh_archive()
+        return uid.strip() in _archive_cache
 
 def add_to_archive(uid: str):
-    """Append the given id to the archive file (idempotent)."""
+    """Append the given id to the archive file (idempotent, safe across hosts sharing the file)."""
     uid = uid.strip()
     if not uid:
         return
-    arc = init_archive()
-    if uid not in arc:
+    init_archive()
+    with _archive_lock, _file_lock(f"{ARCHIVE_FILE}.lock"):
+        _refresh_archive()
+        if uid in _archive_cache:
+            return
         os.makedirs(os.path.dirname(ARCHIVE_FILE) or ".", exist_ok=True)
         with open(ARCHIVE_FILE, 'a', encoding='utf-8') as f:
             f.write(uid + "\n")
-        arc.add(uid)
-        print(f"[archive] Added {uid} to {ARCHIVE_FILE}")
+            f.flush()
+            os.fsync(f.fileno())
+        _refresh_archive()
+    print(f"[archive] Added {uid} to {ARCHIVE_FILE}")
+
+
+# =========================
+# Work leases (several hosts over one shared mybooks/ and archive.txt)
+# =========================
+# Аренда ресурса — файл <lease_dir>/<uuid>.lease, созданный через O_EXCL (атомарно и на NFS).
+# Владелец раз в lease_ttl/3 обновляет mtime; аренда без обновления дольше lease_ttl
+# (или своего хоста с мёртвым pid) считается брошенной и забирается другим.
+_HOST = socket.gethostname()
+_held_leases: dict[str, str] = {}
+_lease_guard = threading.Lock()
+_lease_keeper: threading.Thread | None = None
+
+
+def _create_exclusive(path: str, payload: dict) -> bool:
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(payload, f)
+    return True
+
+
+def _read_owner(path: str) -> dict:
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _pid_alive(pid) -> bool:
+    if not isinstance(pid, int) or pid <= 0 or sys.platform == "win32":
+        return True  # на Windows os.kill(pid, 0) завершает процесс — ждём истечения аренды
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _is_abandoned(path: str, ttl: float) -> bool:
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return True
+    if age > ttl:
+        return True
+    owner = _read_owner(path)
+    return owner.get("host") == _HOST and owner.get("pid") != os.getpid() and not _pid_alive(owner.get("pid"))
+
+
+def _take_over(path: str) -> bool:
+    """Убирает брошенную аренду. rename атомарен: если два хоста решили забрать её одновременно,
+    проигравший мог утащить уже новую аренду победителя — тогда возвращаем её на место."""
+    try:
+        before = os.stat(path)
+        grave = f"{path}.{_HOST}.{os.getpid()}.stale"
+        os.rename(path, grave)
+    except OSError:
+        return False
+    try:
+        after = os.stat(grave)
+        if (after.st_ino, after.st_mtime_ns) != (before.st_ino, before.st_mtime_ns):
+            os.link(grave, path)  # не перезапишет, если путь уже снова занят
+            return False
+        return True
+    except OSError:
+        return False
+    finally:
+        try:
+            os.remove(grave)
+        except OSError:
+            pass
+
+
+@contextlib.contextmanager
+def _file_lock(path: str, ttl: float = 30.0):
+    """Короткая межхостовая блокировка (например, дозапись archive.txt)."""
+    payload = {"host": _HOST, "pid": os.getpid()}
+    while not _create_exclusive(path, payload):
+        if _is_abandoned(path, ttl):
+            _take_over(path)
+        else:
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _lease_path(uid: str) -> str:
+    return os.path.join(CONFIG["lease_dir"], f"{uid}.lease")
+
+
+def acquire_lease(uid: str) -> bool:
+    """Забирает ресурс в работу этим процессом; False — его уже качает кто-то другой."""
+    os.makedirs(CONFIG["lease_dir"], exist_ok=True)
+    path = _lease_path(uid)
+    payload = {"host": _HOST, "pid": os.getpid(), "uid": uid, "acquired": time.time()}
+    for _ in range(2):
+        if _create_exclusive(path, payload):
+            with _lease_guard:
+                _held_leases[uid] = path
+            _start_lease_keeper()
+            return True
+        if not (_is_abandoned(path, CONFIG["lease_ttl"]) and _take_over(path)):
+            return False
+        print(f"[lease] Reclaimed abandoned lease for {uid}")
+    return False
+
+
+def lease_owner(uid: str) -> str:
+    owner = _read_owner(_lease_path(uid))
+    return f"{owner.get('host', '?')}:{owner.get('pid', '?')}"
+
+
+def release_lease(uid: str):
+    with _lease_guard:
+        path = _held_leases.pop(uid, None)
+    if path is None:
+        return
+    owner = _read_owner(path)
+    if owner.get("host") == _HOST and owner.get("pid") == os.getpid():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _start_lease_keeper():
+    global _lease_keeper
+    with _lease_guard:
+        if _lease_keeper is not None:
+            return
+        _lease_keeper = threading.Thread(target=_heartbeat_leases, name="lease-heartbeat", daemon=True)
+        _lease_keeper.start()
+
+
+def _heartbeat_leases():
+    while True:
+        time.sleep(max(1.0, CONFIG["lease_ttl"] / 3))
+        with _lease_guard:
+            held = dict(_held_leases)
+        for uid, path in held.items():
+            owner = _read_owner(path)
+            if owner.get("host") != _HOST or owner.get("pid") != os.getpid():
+                print(f"[lease] ⚠️ Lease for {uid} was taken over by {owner.get('host', '?')} (heartbeat missed?)")
+                continue
+            try:
+                os.utime(path)
+            except OSError:
+                pass
 
 RETRY_STATUSES = {429, 500, 502, 503, 504}
 
+# Счётчик байтов текущего задания (на поток) — нужен планировщику пакета,
+# чтобы сверять прогноз с фактической скоростью.
+_job_ctx = threading.local()
+
+
+def _count_bytes(n: int):
+    _job_ctx.bytes = getattr(_job_ctx, "bytes", 0) + n
+
+
+# =========================
+# Tracing & profiling (opt-in: --trace, --profile)
+# =========================
+# Спаны этапов в формате Chrome trace — открываются в chrome://tracing или ui.perfetto.dev.
+_trace_events: list[dict] | None = None  # None = трассировка выключена, спаны ничего не стоят
+_trace_threads: dict[int, str] = {}
+_trace_lock = threading.Lock()
+_trace_t0 = time.perf_counter()
+
+
+def enable_tracing():
+    global _trace_events
+    if _trace_events is None:
+        _trace_events = []
+
+
+def _trace_add(name: str, cat: str, start: float, end: float, args: dict | None = None):
+    tid = threading.get_ident()
+    event = {"name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": tid,
+             "ts": round((start - _trace_t0) * 1e6, 1), "dur": round((end - start) * 1e6, 1)}
+    if args:
+        event["args"] = args
+    with _trace_lock:
+        _trace_events.append(event)
+        _trace_threads.setdefault(tid, threading.current_thread().name)
+
+
+@contextlib.contextmanager
+def span(name: str, cat: str = "stage", **args):
+    """Замеряет этап (синхронный или внутри корутины) как спан трассы."""
+    if _trace_events is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        _trace_add(name, cat, start, time.perf_counter(), args)
+
+
+def traced(name: str, cat: str = "stage"):
+    """Декоратор: вся функция — один спан; строковые аргументы (uuid, url) попадают в args."""
+    def deco(fn):
+        def describe(a):
+            return {"args": " ".join(str(x) for x in a if isinstance(x, str) and x)[:300]}
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*a, **kw):
+                with span(name, cat, **describe(a)):
+                    return await fn(*a, **kw)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*a, **kw):
+                with span(name, cat, **describe(a)):
+                    return fn(*a, **kw)
+        return wrapper
+    return deco
+
+
+def _http_trace_extensions() -> dict:
+    """extensions для запроса httpx: фазы httpcore (connect_tcp = DNS+TCP, start_tls,
+    send_request_headers, receive_response_headers = ожидание первого байта) как спаны."""
+    if _trace_events is None:
+        return {}
+    started: dict[str, float] = {}
+
+    async def hook(event_name: str, info: dict):
+        stage, _, phase = event_name.rpartition(".")
+        if phase == "started":
+            started[stage] = time.perf_counter()
+        elif phase in ("complete", "failed") and stage in started:
+            _trace_add(stage, "http", started.pop(stage), time.perf_counter(),
+                       {"failed": True} if phase == "failed" else None)
+
+    return {"trace": hook}
+
+
+def write_trace(path: str):
+    with _trace_lock:
+        events = list(_trace_events or [])
+        threads = dict(_trace_threads)
+    meta = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": tname}}
+            for tid, tname in threads.items()]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    print(f"[trace] {len(events)} spans written to {path} (open in ui.perfetto.dev or chrome://tracing)")
+
+
+def trace_report() -> list[str]:
+    """Сводка по этапам: число, суммарное/среднее/максимальное время (по всем потокам)."""
+    with _trace_lock:
+        events = list(_trace_events or [])
+    stages: dict[tuple[str, str], list[float]] = {}
+    for ev in events:
+        stages.setdefault((ev["cat"], ev["name"]), []).append(ev["dur"] / 1e6)
+    lines = [f"{'stage':42} {'count':>6} {'total s':>10} {'mean s':>9} {'max s':>9}"]
+    for (cat, name), durs in sorted(stages.items(), key=lambda kv: -sum(kv[1])):
+        lines.append(f"{cat + ':' + name:42} {len(durs):6} {sum(durs):10.2f} "
+                     f"{sum(durs) / len(durs):9.3f} {max(durs):9.3f}")
+    return lines
+
+
+def start_profiling(prefix: str):
+    """cProfile на весь запуск + спаны; при выходе пишет <prefix>.pstats и отчёт <prefix>.txt."""
+    import atexit
+    import cProfile
+
+    enable_tracing()
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def finish():
+        import io
+        import pstats
+        profiler.disable()
+        profiler.dump_stats(f"{prefix}.pstats")
+        out = io.StringIO()
+        out.write(f"Wall time: {time.perf_counter() - _trace_t0:.2f}s\n\n")
+        out.write("Per-stage time (all threads, nested stages overlap):\n")
+        out.write("\n".join(trace_report()) + "\n\n")
+        out.write("Top functions by cumulative time (main thread):\n")
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+        with open(f"{prefix}.txt", 'w', encoding='utf-8') as f:
+            f.write(out.getvalue())
+        print(f"[profile] Report written to {prefix}.txt, raw stats to {prefix}.pstats")
+
+    atexit.register(finish)
+
 
 def get_auth_token(force: bool = False):
     token_file = "token.txt"
@@ -215,6 +603,311 @@ def _build_transport(http2: bool = True, verify: bool = False):
     return httpx.AsyncHTTPTransport(**params)
 
 
+def _parse_size(value) -> int:
+    """'512K', '2M', '1.5G', '300000' -> байты (двоичные множители)."""
+    text = str(value).strip().upper().rstrip("B").rstrip("I")
+    mult = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(text[-1:], 1)
+    if mult != 1:
+        text = text[:-1]
+    return int(float(text) * mult)
+
+
+def _parse_rate_schedule(spec: str) -> list[tuple[int, int, int]]:
+    """'09:00-18:00=2M,18:00-09:00=0' -> [(start_min, end_min, bytes_per_s), ...]."""
+    out = []
+    for item in filter(None, (x.strip() for x in (spec or "").split(","))):
+        window, _, rate = item.partition("=")
+        start, _, end = window.partition("-")
+        to_min = lambda hhmm: int(hhmm.split(":")[0]) * 60 + int(hhmm.split(":")[1] if ":" in hhmm else 0)
+        out.append((to_min(start.strip()), to_min(end.strip()), _parse_size(rate)))
+    return out
+
+
+class BandwidthLimiter:
+    """
+    Общий token bucket на все потоки скачивания (в т.ч. из разных event loop воркеров пакета).
+    Лимит берётся из CONFIG, окна по времени суток — из rate_schedule, а rate_file позволяет
+    менять лимит без перезапуска (одно значение вроде "2M" или расписание).
+    """
+
+    RELOAD_EVERY = 5.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._file_mtime = None
+        self._file_checked = 0.0
+        self._schedule = ("", [])
+
+    def _reload_file(self, now: float):
+        path = CONFIG["rate_file"]
+        if not path or now - self._file_checked < self.RELOAD_EVERY:
+            return
+        self._file_checked = now
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime == self._file_mtime:
+                return
+            with open(path, encoding='utf-8') as f:
+                spec = f.read().strip()
+        except OSError as e:
+            print(f"⚠️ Cannot read rate file {path}: {e}")
+            self._file_mtime = None
+            return
+        # файл правят на ходу: опечатка не должна обрывать загрузки — оставляем прежний лимит
+        # и перечитываем файл только после следующей правки
+        self._file_mtime = mtime
+        try:
+            if "=" in spec:
+                self._schedule = (spec, _parse_rate_schedule(spec))
+                CONFIG["rate_schedule"] = spec
+            else:
+                CONFIG["rate_limit"] = _parse_size(spec or 0)
+                CONFIG["rate_schedule"] = ""
+        except ValueError as e:
+            print(f"⚠️ Bad rate file {path}, keeping previous limit: {e}")
+            return
+        print(f"[rate] Reloaded {path}: {spec or 'unlimited'}")
+
+    def current_rate(self) -> int:
+        """Актуальный лимит (байт/с) с учётом расписания."""
+        spec = CONFIG["rate_schedule"]
+        if spec:
+            if self._schedule[0] != spec:
+                self._schedule = (spec, _parse_rate_schedule(spec))
+            lt = time.localtime()
+            minute = lt.tm_hour * 60 + lt.tm_min
+            for start, end, rate in self._schedule[1]:
+                inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+                if inside:
+                    return rate
+        return int(CONFIG["rate_limit"] or 0)
+
+    async def consume(self, n: int):
+        now = time.monotonic()
+        with self._lock:
+            self._reload_file(now)
+            rate = self.current_rate()
+            if rate <= 0:
+                self._stamp = now
+                return
+            burst = max(65536.0, rate / 4)
+            self._tokens = min(burst, self._tokens + (now - self._stamp) * rate) - n
+            self._stamp = now
+            wait = -self._tokens / rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+BANDWIDTH = BandwidthLimiter()
+
+
+def _preallocate(f, size: int):
+    """Резервирует место под файл заранее (меньше фрагментации); ошибки не фатальны."""
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+    except OSError:
+        pass
+
+
+def _finish_file(f, written: int, preallocated: int):
+    if preallocated and preallocated != written:
+        f.truncate(written)
+    if CONFIG["fsync"]:
+        f.flush()
+        os.fsync(f.fileno())
+    f.close()
+
+
+class _StallWatch:
+    """
+    Скорость потока в скользящем окне. Учитывается только время ожидания сети —
+    паузы лимита скорости и backpressure записи на диск не считаются «зависанием».
+    """
+
+    def __init__(self):
+        self.min_bps = float(CONFIG["stall_min_bps"] or 0)
+        self.window = max(1.0, float(CONFIG["stall_window"]))
+        self.net_time = 0.0
+        self.total = 0
+        self.samples = [(0.0, 0)]  # (накопленное время сети, накопленные байты)
+
+    async def next_chunk(self, it):
+        """Следующий чанк; StallError, если данных нет дольше окна или окно ниже порога."""
+        t0 = time.monotonic()
+        try:
+            if self.min_bps:
+                chunk = await asyncio.wait_for(it.__anext__(), self.window)
+            else:
+                chunk = await it.__anext__()
+        except asyncio.TimeoutError:
+            raise StallError(f"no data chunk received within {self.window:.0f}s") from None
+        self.net_time += time.monotonic() - t0
+        self.total += len(chunk)
+        if self.min_bps:
+            self.samples.append((self.net_time, self.total))
+            while len(self.samples) > 2 and self.net_time - self.samples[1][0] >= self.window:
+                self.samples.pop(0)
+            span_t = self.net_time - self.samples[0][0]
+            if span_t >= self.window:
+                rate = (self.total - self.samples[0][1]) / span_t
+                if rate < self.min_bps:
+                    raise StallError(f"throughput {rate / 1024:.1f} KB/s over {span_t:.0f}s "
+                                     f"is below {self.min_bps / 1024:.0f} KB/s")
+        return chunk
+
+
+async def _stream_to_file(resp, tmp_path: str, offset: int = 0, on_first_byte=None) -> int:
+    """
+    Пишет тело ответа в tmp_path, не блокируя event loop.
+    Сетевые чанки собираются в блоки CONFIG["write_block"] и уходят в отдельный поток
+    через ограниченную очередь (write-behind); файл заранее размечается по Content-Length.
+    offset > 0 — дозапись после уже скачанных байт (ответ 206 на Range).
+    Медленный поток прерывается StallError (см. _StallWatch). Возвращает итоговый размер файла.
+    """
+    block_size = max(65536, int(CONFIG["write_block"]))
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, int(CONFIG["write_buffer_blocks"])))
+    f = await asyncio.to_thread(open, tmp_path, "r+b" if offset else "wb")
+    if offset:
+        f.seek(offset)
+    try:
+        expected = int(resp.headers.get("Content-Length") or 0)
+    except ValueError:
+        expected = 0
+    if expected > 0:
+        expected += offset
+        await asyncio.to_thread(_preallocate, f, expected)
+
+    write_error: list[BaseException] = []
+    # Отмена writer_task не останавливает запись, уже идущую в потоке: закрытие файла ждёт её
+    # под этой блокировкой (не дольше записи одного блока), поздняя запись в закрытый файл пропускается
+    file_lock = threading.Lock()
+
+    def write_block(block: bytes):
+        with file_lock:
+            if not f.closed:
+                f.write(block)
+
+    def close_file():
+        with file_lock:
+            f.close()
+
+    async def writer():
+        while True:
+            block = await queue.get()
+            if block is None:
+                return
+            if write_error:
+                continue  # дочитываем очередь, чтобы не заблокировать producer
+            try:
+                await asyncio.to_thread(write_block, block)
+            except BaseException as e:
+                write_error.append(e)
+
+    writer_task = asyncio.create_task(writer())
+    written = offset
+    buf = bytearray()
+    watch = _StallWatch()
+    chunks = resp.aiter_bytes(65536)
+    try:
+        while True:
+            try:
+                chunk = await watch.next_chunk(chunks)
+            except StopAsyncIteration:
+                break
+            if not chunk:
+                continue
+            if on_first_byte is not None:
+                on_first_byte()
+                on_first_byte = None
+            buf += chunk
+            written += len(chunk)
+            _count_bytes(len(chunk))
+            await BANDWIDTH.consume(len(chunk))
+            if len(buf) >= block_size:
+                await queue.put(bytes(buf))
+                buf.clear()
+                if write_error:
+                    raise write_error[0]
+        if buf:
+            await queue.put(bytes(buf))
+        await queue.put(None)
+        await writer_task
+        if write_error:
+            raise write_error[0]
+        await asyncio.to_thread(_finish_file, f, written, expected)
+    except Exception:
+        # Сеть оборвалась/зависла: принятое дописываем и обрезаем разметку файла —
+        # размер .part равен числу полученных байт, с него продолжится докачка
+        if not write_error and not writer_task.done():
+            try:
+                if buf:
+                    await queue.put(bytes(buf))
+                await queue.put(None)
+                await writer_task
+                if not write_error:
+                    await asyncio.to_thread(_finish_file, f, written, expected)
+            except Exception:
+                pass
+        writer_task.cancel()
+        close_file()
+        raise
+    except BaseException:
+        writer_task.cancel()
+        close_file()
+        raise
+    return written
+
+
+async def _fetch_to_part(client: httpx.AsyncClient, url: str, tmp_path: str, resume_from: int = 0,
+                         state: dict | None = None):
+    """
+    Один GET тела в tmp_path. resume_from > 0 — Range-докачка (If-Range по ETag/Last-Modified из state,
+    если сервер отдал файл заново целиком — пишем с нуля). Заголовки и первый байт тела должны прийти
+    за CONFIG["ttfb_budget"], иначе StallError.
+    """
+    state = state if state is not None else {}
+    headers = dict(HEADERS)
+    if resume_from:
+        headers["Range"] = f"bytes={resume_from}-"
+        if state.get("validator"):
+            headers["If-Range"] = state["validator"]
+    budget = CONFIG["ttfb_budget"] or None
+    try:
+        async with asyncio.timeout(budget) as ttfb:
+            async with client.stream("GET", url, headers=headers, extensions=_http_trace_extensions()) as resp:
+                offset = 0
+                content_range = resp.headers.get("Content-Range", "")
+                if resume_from and resp.status_code == 206 and content_range.startswith(f"bytes {resume_from}-"):
+                    offset = resume_from
+                    count_stat("resumed")
+                    print(f"Resuming {os.path.basename(tmp_path)} from {resume_from / 1048576:.1f} MB")
+                elif resume_from and resp.status_code == 416:
+                    os.remove(tmp_path)
+                    raise StallError("resume range rejected (HTTP 416), restarting from scratch")
+                elif resume_from and resp.status_code == 206:
+                    # диапазон не с того места — дописывать нельзя, качаем заново
+                    os.remove(tmp_path)
+                    raise StallError(f"unexpected Content-Range '{content_range}' for resume at {resume_from}, "
+                                     "restarting from scratch")
+                elif resp.status_code != 200:
+                    await _print_error_body(resp)
+                    raise httpx.HTTPStatusError(
+                        f"Bad status {resp.status_code}",
+                        request=resp.request,
+                        response=resp,
+                    )
+                state["validator"] = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+                await _stream_to_file(resp, tmp_path, offset, on_first_byte=lambda: ttfb.reschedule(None))
+    except TimeoutError:
+        raise StallError(f"no first byte within {budget:.0f}s") from None
+
+
+@traced("download_file", "http")
 async def download_file(
     url: str,
     file_path: str,
@@ -222,9 +915,12 @@ async def download_file(
     base_timeout: float | None = None,
     backoff_initial: float | None = None,
     backoff_cap: float | None = None,
+    resume: bool = False,
 ):
     """
     Потоковое скачивание с ретраями, экспоненциальными таймаутами и .part-файлом.
+    После обрыва или зависания (StallError) следующая попытка идёт новым соединением и
+    докачивает .part через Range; resume=True — докачать .part, оставленный вызывающим.
     """
     if max_retries is None:
         max_retries = CONFIG["max_retries"]
@@ -236,6 +932,8 @@ async def download_file(
         backoff_cap = CONFIG["backoff_cap"]
 
     os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    tmp_path = f"{file_path}.part"
+    state: dict = {}
 
     for attempt in range(max_retries):
         factor = 2 ** attempt
@@ -245,28 +943,17 @@ async def download_file(
             write=base_timeout * factor,
             pool=base_timeout * factor,
         )
+        resume_from = os.path.getsize(tmp_path) if resume and os.path.exists(tmp_path) else 0
         try:
             async with httpx.AsyncClient(
                 follow_redirects=True,
                 timeout=timeout,
                 transport=_build_transport(http2=True, verify=False),
             ) as client:
-                tmp_path = f"{file_path}.part"
-                async with client.stream("GET", url, headers=HEADERS) as resp:
-                    if resp.status_code != 200:
-                        await _print_error_body(resp)
-                        raise httpx.HTTPStatusError(
-                            f"Bad status {resp.status_code}",
-                            request=resp.request,
-                            response=resp,
-                        )
-                    with open(tmp_path, "wb") as f:
-                        async for chunk in resp.aiter_bytes(65536):
-                            if chunk:
-                                f.write(chunk)
-                os.replace(tmp_path, file_path)
-                print(f"File downloaded successfully to {file_path}")
-                return
+                await _fetch_to_part(client, url, tmp_path, resume_from, state)
+            os.replace(tmp_path, file_path)
+            print(f"File downloaded successfully to {file_path}")
+            return
 
         except asyncio.CancelledError:
             # Отмена ожидания/операции — тихо завершаемся
@@ -277,14 +964,20 @@ async def download_file(
                 httpx.TimeoutException,
                 httpx.RemoteProtocolError,
                 httpx.ConnectError,
-                httpx.HTTPStatusError) as e:
-            # подчистим .part
-            tmp_path = f"{file_path}.part"
-            if os.path.exists(tmp_path):
-                try:
-                    os.remove(tmp_path)
-                except OSError:
-                    pass
+                httpx.HTTPStatusError,
+                StallError) as e:
+            if isinstance(e, httpx.HTTPStatusError):
+                # ответ с ошибкой — недокачанный .part больше не нужен
+                resume = False
+                if os.path.exists(tmp_path):
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+            else:
+                resume = True  # обрыв/зависание: полученные байты оставляем для докачки
+            if isinstance(e, StallError):
+                count_stat("stalls")
 
             # вычислим задержку перед повтором
             retry_after = None
@@ -295,24 +988,30 @@ async def download_file(
                     retry_after = _parse_retry_after(e.response.headers.get("Retry-After"))
 
             if attempt < max_retries - 1 and (status is None or status in RETRY_STATUSES):
-                base_wait = backoff_initial * factor
-                wait_s = max(base_wait, retry_after or 0.0)
-                wait_s = min(wait_s, backoff_cap) + random.uniform(0, 0.8)
-                human = f"HTTP {status}" if status else f"{type(e).__name__}"
+                if isinstance(e, StallError):
+                    wait_s = 1.0 + random.uniform(0, 0.8)  # сервер жив, нужен лишь новый коннект
+                else:
+                    base_wait = backoff_initial * factor
+                    wait_s = max(base_wait, retry_after or 0.0)
+                    wait_s = min(wait_s, backoff_cap) + random.uniform(0, 0.8)
+                human = f"HTTP {status}" if status else (str(e) if isinstance(e, StallError) else type(e).__name__)
                 print(
                     f"Download attempt {attempt+1}/{max_retries} failed ({human}). "
                     f"Retrying in {wait_s:.1f}s..."
                 )
                 try:
-                    await asyncio.sleep(wait_s)
+                    with span("backoff", "wait", seconds=round(wait_s, 1)):
+                        await asyncio.sleep(wait_s)
                 except asyncio.CancelledError:
                     print("\nОтмена по запросу пользователя. Выходим…")
                     raise GracefulExit(130)
             else:
                 print("Failed to download the file after several attempts.")
-                sys.exit(1)
+                raise DownloadError(f"download failed after {attempt + 1} attempt(s): {type(e).__name__}"
+                                    + (f" HTTP {status}" if status else ""), url, status) from e
 
 
+@traced("download_file_once", "http")
 async def download_file_once(url: str, file_path: str, base_timeout: float | None = None):
     """
     ОДНА попытка скачивания без внутреннего бэкоффа/ретраев.
@@ -336,24 +1035,102 @@ async def download_file_once(url: str, file_path: str, base_timeout: float | Non
         timeout=timeout,
         transport=_build_transport(http2=True, verify=False),
     ) as client:
+        # не 200 — тело напечатается и поднимется HTTPStatusError, чтобы снаружи принять решение;
+        # зависание — StallError (полученная часть остаётся в .part для докачки)
         tmp_path = f"{file_path}.part"
-        async with client.stream("GET", url, headers=HEADERS) as resp:
-            if resp.status_code != 200:
-                # напечатаем тело и бросим исключение — чтобы снаружи понять статус и принять решение
-                await _print_error_body(resp)
-                raise httpx.HTTPStatusError(
-                    f"Bad status {resp.status_code}",
-                    request=resp.request,
-                    response=resp,
-                )
-            with open(tmp_path, "wb") as f:
-                async for chunk in resp.aiter_bytes(65536):
-                    if chunk:
-                        f.write(chunk)
+        await _fetch_to_part(client, url, tmp_path)
         os.replace(tmp_path, file_path)
         print(f"File downloaded successfully to {file_path}")
 
 
+class _Hedger:
+    """
+    Адаптивная задержка дубля запроса: перцентиль недавних задержек успешных ответов.
+    Доля дублей ограничена hedge_max_ratio (с небольшим запасом на старте).
+    Один экземпляр на процесс: воркеры пакета (--jobs) обращаются к нему из своих потоков.
+    """
+
+    WARMUP = 8  # пока замеров меньше — дубли не посылаются
+
+    def __init__(self, size: int = 64):
+        self._lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=size)
+        self.requests = 0
+        self.hedges = 0
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def _within_ratio(self) -> bool:
+        return self.hedges + 1 <= CONFIG["hedge_max_ratio"] * self.requests + 1
+
+    def delay(self) -> float | None:
+        """Через сколько секунд посылать дубль; None — не дублировать этот запрос."""
+        with self._lock:
+            self.requests += 1
+            if not CONFIG["hedge"] or len(self.latencies) < self.WARMUP or not self._within_ratio():
+                return None
+            ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(CONFIG["hedge_percentile"] * len(ordered)))
+        return max(CONFIG["hedge_min_delay"], ordered[idx])
+
+    def take(self) -> bool:
+        """Резервирует дубль, если лимит доли ещё позволяет (проверка и учёт — атомарно)."""
+        with self._lock:
+            if not self._within_ratio():
+                return False
+            self.hedges += 1
+            return True
+
+
+_hedger = _Hedger()
+
+
+async def _hedged_get(client, url: str):
+    """
+    GET, который через адаптивную задержку дублируется вторым запросом; первый ответ 200
+    побеждает, проигравший отменяется. Только для идемпотентных запросов метаданных.
+    """
+    async def one():
+        t0 = time.monotonic()
+        resp = await client.get(url, headers=HEADERS, extensions=_http_trace_extensions())
+        if resp.status_code == 200:
+            _hedger.observe(time.monotonic() - t0)
+        return resp
+
+    primary = asyncio.ensure_future(one())
+    delay = _hedger.delay()
+    if delay is None:
+        return await primary
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done and _hedger.take():
+            count_stat("hedges")
+            with span("hedge", "http", after=round(delay, 2)):
+                pending.add(asyncio.ensure_future(one()))
+        result = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code == 200:
+                    if task is not primary:
+                        count_stat("hedge_wins")
+                    return task.result()
+                if result is None or result.exception() is not None:
+                    result = task
+        # ни один не дал 200 — отдаём то, что вернулось (ответ или исключение) для обычных ретраев
+        return result.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            # дожидаемся отмены, чтобы запрос проигравшего закрылся до закрытия клиента и event loop
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+@traced("send_request", "http")
 async def send_request(
     url: str,
     max_retries: int | None = None,
@@ -387,7 +1164,7 @@ async def send_request(
                 timeout=timeout,
                 transport=_build_transport(http2=False, verify=False),
             ) as client:
-                resp = await client.get(url, headers=HEADERS)
+                resp = await _hedged_get(client, url)
                 if resp.status_code == 200:
                     return resp
                 # ретраи только на RETRY_STATUSES
@@ -426,20 +1203,27 @@ async def send_request(
                 human = f"Request attempt {attempt+1}/{max_retries} failed (HTTP {status})."
                 print(f"{human} Retrying in {wait_s:.1f}s...")
                 try:
-                    await asyncio.sleep(wait_s)
+                    with span("backoff", "wait", seconds=round(wait_s, 1)):
+                        await asyncio.sleep(wait_s)
                 except asyncio.CancelledError:
                     print("\nОтмена по запросу пользователя. Выходим…")
                     raise GracefulExit(130)
             else:
                 print("Failed to download the file after several attempts. Check the ID or try again later.")
-                sys.exit(1)
+                raise DownloadError(f"request failed after {attempt + 1} attempt(s): {type(e).__name__}"
+                                    + (f" HTTP {status}" if status else ""), url, status) from e
 
 
 def create_pdf_from_images(images_folder, output_pdf):
-    c = canvas.Canvas(output_pdf, pagesize=letter)
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+    from PIL import Image
+
+    # через .part: готовый файл может быть hardlink на объект хранилища (--blob-store), его не переписываем
+    c = canvas.Canvas(f"{output_pdf}.part", pagesize=letter)
     width, height = letter
 
-    images = filter(lambda file: file.endswith(".jpeg"), os.listdir(images_folder))
+    images = sorted(filter(lambda file: file.endswith(".jpeg"), os.listdir(images_folder)))
 
     for image in images:
         img_path = os.path.join(images_folder, image)
@@ -448,10 +1232,16 @@ def create_pdf_from_images(images_folder, output_pdf):
             c.showPage()
         os.remove(img_path)
     c.save()
+    os.replace(f"{output_pdf}.part", output_pdf)
     print(f"File downloaded successfully to {output_pdf}")
 
 
 def epub_to_fb2(epub_path, fb2_path):
+    import ebooklib
+    from ebooklib import epub
+    from bs4 import BeautifulSoup
+    from xml.sax.saxutils import escape
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         book = epub.read_epub(epub_path)
@@ -461,13 +1251,15 @@ def epub_to_fb2(epub_path, fb2_path):
         if item.get_type() == ebooklib.ITEM_DOCUMENT:
             content = item.get_content()
             soup = BeautifulSoup(content, 'html.parser')
-            text_content = soup.get_text()
+            # &, < и > экранируем, управляющие символы (недопустимы в XML 1.0) выбрасываем
+            text_content = escape(re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", "", soup.get_text()))
             fb2_content += f'<p>{text_content}</p>'
 
     fb2_content += '</body>\n</fb2>'
 
-    with open(fb2_path, 'w', encoding='utf-8') as fb2_file:
-        fb2.write(fb2_content)
+    with open(f"{fb2_path}.part", 'w', encoding='utf-8') as fb2_file:
+        fb2_file.write(fb2_content)
+    os.replace(f"{fb2_path}.part", fb2_path)
 
     print(f"fb2 file save to {fb2_path}")
 
@@ -488,16 +1280,256 @@ def write_book_info(text, path, overwrite: bool = False):
     return info_path
 
 
-def get_resource_info(resource_type, uuid, series=''):
+# =========================
+# Resource manifest (служебные сведения о скачанном ресурсе)
+# =========================
+MANIFEST_NAME = ".manifest.json"
+_manifest_lock = threading.Lock()
+
+
+def read_manifest(download_dir: str) -> dict:
+    try:
+        with open(os.path.join(download_dir, MANIFEST_NAME), encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(download_dir: str, data: dict):
+    os.makedirs(download_dir, exist_ok=True)
+    path = os.path.join(download_dir, MANIFEST_NAME)
+    tmp = f"{path}.part"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def update_manifest(download_dir: str, **fields) -> dict:
+    """Дополняет .manifest.json ресурса (атомарная перезапись)."""
+    with _manifest_lock:
+        data = read_manifest(download_dir)
+        data.update(fields)
+        _write_manifest(download_dir, data)
+    return data
+
+
+def update_manifest_section(download_dir: str, section: str, key: str, value) -> dict:
+    """Меняет один ключ во вложенном словаре манифеста (derived, hashes, …)."""
+    with _manifest_lock:
+        data = read_manifest(download_dir)
+        data.setdefault(section, {})[key] = value
+        _write_manifest(download_dir, data)
+    return data
+
+
+# =========================
+# Content-addressed blob store
+# =========================
+# Один и тот же ресурс встречается в mybooks/book/…, mybooks/series/<серия>/… и в эпизодах сериалов.
+# Хранилище: objects/<sha[:2]>/<sha256> — содержимое, refs/<uuid>/<kind> — sha256 для (UUID, роль файла).
+# Повторные копии не скачиваются и не пересчитываются, а линкуются (hardlink, reflink или копия).
+_blob_lock = threading.Lock()
+
+
+def _blob_paths(uuid: str, kind: str) -> tuple[str, str]:
+    store = CONFIG["blob_store"]
+    return os.path.join(store, "refs", uuid, kind.replace("/", "_")), os.path.join(store, "objects")
+
+
+def _file_sha256(path: str) -> str:
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """Копирование через FICLONE (btrfs/xfs/…); False, если ФС не поддерживает."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409
+    try:
+        with open(src, "rb") as fs, open(dst, "wb") as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+
+
+def _link_into(src: str, dst: str) -> str:
+    """Помещает src в dst: hardlink → reflink → копия. Возвращает использованный способ."""
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp = f"{dst}.part"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+        how = "hardlink"
+    except OSError:
+        if _reflink(src, tmp):
+            how = "reflink"
+        else:
+            shutil.copyfile(src, tmp)
+            how = "copy"
+    os.replace(tmp, dst)
+    return how
+
+
+def blob_fetch(uuid: str, kind: str, dest: str) -> bool:
+    """Если (uuid, kind) уже есть в хранилище — линкует его в dest и возвращает True."""
+    if not CONFIG["blob_store"] or not uuid:
+        return False
+    ref, objects = _blob_paths(uuid, kind)
+    try:
+        with open(ref, encoding='utf-8') as f:
+            sha = f.read().strip()
+    except OSError:
+        return False
+    obj = os.path.join(objects, sha[:2], sha)
+    if not sha or not os.path.isfile(obj):
+        return False
+    if os.path.exists(dest) and os.path.samefile(obj, dest):
+        return True
+    how = _link_into(obj, dest)
+    print(f"[blob] Reused {kind} of {uuid} ({how}): {dest}")
+    return True
+
+
+def blob_put(uuid: str, kind: str, path: str):
+    """Кладёт готовый файл в хранилище и заменяет его ссылкой на объект."""
+    if not CONFIG["blob_store"] or not uuid or not os.path.isfile(path):
+        return
+    ref, objects = _blob_paths(uuid, kind)
+    sha = _file_sha256(path)
+    obj = os.path.join(objects, sha[:2], sha)
+    with _blob_lock:
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            _link_into(path, obj)
+        os.makedirs(os.path.dirname(ref), exist_ok=True)
+        with open(f"{ref}.part", 'w', encoding='utf-8') as f:
+            f.write(sha)
+        os.replace(f"{ref}.part", ref)
+    if not os.path.samefile(obj, path):
+        _link_into(obj, path)
+
+
+def fetch_or_download(uuid: str, kind: str, url: str, dest: str):
+    """download_file с дедупликацией через хранилище (обложку при --force-meta качаем заново)."""
+    if not (kind == "cover" and CONFIG["force_meta"]) and blob_fetch(uuid, kind, dest):
+        return
+    run_async_safely(download_file(url, dest))
+    blob_put(uuid, kind, dest)
+
+
+def skip_archived(uuid: str, placed: bool = False) -> bool:
+    """
+    True — ресурс уже в архиве, пропускаем. placed=True — ресурс раскладывается как часть серии
+    или эпизод сериала: если его файлы есть в хранилище, он всё равно раскладывается в новый каталог
+    (контент линкуется из хранилища, запрашиваются только метаданные).
+    """
+    if not is_archived(uuid):
+        return False
+    if placed and CONFIG["blob_store"] and os.path.isdir(os.path.join(CONFIG["blob_store"], "refs", uuid)):
+        print(f"[blob] {uuid} is already downloaded, linking it here from the blob store")
+        return False
+    print(f"[archive] Skipping already downloaded: {uuid}")
+    return True
+
+
+# JSON, полученный заранее (например, планировщиком пакета), чтобы не запрашивать его повторно.
+# url -> (время получения, json)
+_json_cache: dict[str, tuple[float, dict]] = {}
+_json_cache_lock = threading.Lock()
+PLAYLIST_CACHE_TTL = 600.0  # подписанные ссылки в playlists.json живут ограниченное время
+
+
+def _cache_json(url: str, data):
+    with _json_cache_lock:
+        _json_cache[url] = (time.monotonic(), data)
+
+
+def _take_cached_json(url: str, max_age: float | None = None):
+    """Возвращает (и забирает из кэша) ранее полученный JSON, если он не старше max_age."""
+    with _json_cache_lock:
+        item = _json_cache.pop(url, None)
+    if item is None:
+        return None
+    fetched_at, data = item
+    if max_age is not None and time.monotonic() - fetched_at > max_age:
+        return None
+    return data
+
+
+# Фоновые этапы ресурса: как только пришёл info, обложка и JSON контента (playlists.json,
+# metadata.json, …) качаются параллельно с записью метаданных и загрузкой самого контента.
+_meta_pool: ThreadPoolExecutor | None = None
+_meta_pool_lock = threading.Lock()
+_content_prefetch: dict[str, Future] = {}  # url -> Future[json]
+_cover_futures: dict[str, Future] = {}     # каталог ресурса -> Future
+_prefetch_lock = threading.Lock()
+
+
+def _meta_submit(fn, *args):
+    global _meta_pool
+    with _meta_pool_lock:
+        if _meta_pool is None:
+            _meta_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="meta")
+    return _meta_pool.submit(fn, *args)
+
+
+def _prefetch_content_json(url: str):
+    with _prefetch_lock:
+        if url in _content_prefetch:
+            return
+        _content_prefetch[url] = _meta_submit(lambda: run_async_safely(send_request(url)).json())
+
+
+def _take_prefetched_json(url: str):
+    """JSON контента, запрошенный get_resource_info заранее (ждёт его, если ещё в пути)."""
+    with _prefetch_lock:
+        fut = _content_prefetch.pop(url, None)
+    return fut.result() if fut is not None else None
+
+
+def wait_resource_meta(download_dir: str):
+    """Дожидается фоновой загрузки обложки ресурса; её ошибка поднимается здесь."""
+    with _prefetch_lock:
+        fut = _cover_futures.pop(os.path.normpath(download_dir), None)
+    if fut is not None:
+        fut.result()
+
+
+@traced("get_resource_info")
+def get_resource_info(resource_type, uuid, series='', content_type=None):
     """
     Скачивает метаинформацию и обложку; idempotent — пропускает, если уже скачано,
-    кроме случая force_meta.
+    кроме случая force_meta. Обложка и JSON контента (content_type, по умолчанию тот же
+    тип; у книги контент — сам EPUB) качаются в фоне: обложку дожидается wait_resource_meta,
+    JSON — get_resource_json.
     """
     info_url = URLS[resource_type]['infoUrl'].format(uuid=uuid)
-    info = run_async_safely(send_request(info_url)).json()
+    info = _take_cached_json(info_url)
+    if info is None:
+        info = run_async_safely(send_request(info_url)).json()
     if not info:
         return None
 
+    content_type = content_type or resource_type
+    if content_type != 'book':
+        content_url = URLS[content_type]['contentUrl'].format(uuid=uuid)
+        if content_url not in _json_cache:
+            _prefetch_content_json(content_url)
+
     meta = info.get(resource_type) or {}
 
     # ---- Обложка (если есть) ----
@@ -513,6 +1545,7 @@ def get_resource_info(resource_type, uuid, series=''):
     download_dir = f"mybooks/{'series' if series else resource_type}/{series}{name}/"
     path = f'{download_dir}{name}'
     os.makedirs(download_dir, exist_ok=True)
+    update_manifest(download_dir, type=resource_type, uuid=uuid)
 
     # --- JPEG (обложка) ---
     if picture_url:
@@ -520,7 +1553,9 @@ def get_resource_info(resource_type, uuid, series=''):
         if os.path.isfile(jpeg_path) and not CONFIG["force_meta"]:
             print(f"Cover already exists, skip: {jpeg_path}")
         else:
-            run_async_safely(download_file(picture_url, jpeg_path))
+            fut = _meta_submit(fetch_or_download, uuid, "cover", picture_url, jpeg_path)
+            with _prefetch_lock:
+                _cover_futures[os.path.normpath(download_dir)] = fut
 
     # --- JSON с meta ---
     json_path = f"{path}.json"
@@ -620,8 +1655,14 @@ def get_resource_info(resource_type, uuid, series=''):
     return path
 
 
+@traced("get_resource_json")
 def get_resource_json(resource_type, uuid):
     url = URLS[resource_type]['contentUrl'].format(uuid=uuid)
+    cached = _take_cached_json(url, max_age=PLAYLIST_CACHE_TTL)
+    if cached is None:
+        cached = _take_prefetched_json(url)
+    if cached is not None:
+        return cached
     return run_async_safely(send_request(url)).json()
 
 
@@ -652,6 +1693,16 @@ def _playlist_variants_order(resp_json: dict, pref: str) -> list[str]:
     # pref может быть только 'max' или 'min' (по CLI)
     return ordered
 
+def _track_duration(track: dict) -> float | None:
+    """Длительность трека из playlists.json (сек), если API её отдаёт."""
+    d = (track or {}).get('duration')
+    if isinstance(d, dict):
+        d = d.get('seconds') or d.get('value')
+    try:
+        return float(d) if d else None
+    except (TypeError, ValueError):
+        return None
+
 def _preferred_key(pref_order: list[str], fallback_to_first_if_empty=True) -> str | None:
     """Берёт первый элемент из списка как предпочитаемый ключ."""
     if pref_order:
@@ -659,165 +1710,317 @@ def _preferred_key(pref_order: list[str], fallback_to_first_if_empty=True) -> st
     return pref_order[0] if (fallback_to_first_if_empty and pref_order) else None
 
 
-def download_book(uuid, series='', serial_path=None):
-    if is_archived(uuid):
-        print(f"[archive] Skipping already downloaded: {uuid}")
-        return
-    path = serial_path if serial_path else get_resource_info('book', uuid, series)
-    run_async_safely(download_file(
-        URLS['book']['contentUrl'].format(uuid=uuid), f'{path}.epub'))
-    # Extra formats requested: FB2 + simple text-only PDF
-    try:
-        epub_to_fb2(f"{path}.epub", f"{path}.fb2")
-    except Exception as e:
-        print(f"WARNING: FB2 conversion failed: {e}")
-    try:
-        epub_to_plain_pdf(f"{path}.epub", f"{path}.pdf")
-    except Exception as e:
-        print(f"WARNING: PDF conversion failed: {e}")
+# ------- Истечение подписанных ссылок playlists.json
+# Ссылки offline-вариантов подписаны и живут ограниченное время; длинная книга качается
+# часами, и ближе к концу треки начинают отвечать 4xx. Тогда playlists.json запрашивается
+# заново (один раз на истечение — другие воркеры той же книги берут готовый результат).
 
-    add_to_archive(uuid)
+LINK_EXPIRED_STATUSES = {401, 403, 404, 410}
 
+# uuid -> {"generation", "fetched" (monotonic), "fetched_at" (epoch), "worked" (сек после получения), "data"}
+_playlists: dict[str, dict] = {}
+_playlists_lock = threading.Lock()
+_playlist_refresh_locks: dict[str, threading.Lock] = {}
 
-def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, cleanup_chapters=True):
-    """
-    Merge all M4A chapter files in a directory into a single audiobook using ffmpeg.
-    Creates chapter markers and embeds cover image when available.
-    Returns True on success, False otherwise.
-    """
-    from pathlib import Path
-    import subprocess
-
-    audiobook_path = Path(audiobook_dir)
-    # Find all M4A files and sort them naturally by chapter number
-    chapter_files = sorted([f for f in audiobook_path.glob("*.m4a") if "Глава_" in f.name],
-                           key=lambda x: int(re.search(r'Глава_(\d+)\.m4a', x.name).group(1)) if re.search(r'Глава_(\d+)\.m4a', x.name) else 0)
-    if not chapter_files:
-        print(f"No chapter files found in {audiobook_path}")
-        return False
 
-    print(f"Found {len(chapter_files)} chapters, merging with ffmpeg...")
+def _link_expired(e: Exception) -> bool:
+    """4xx на подписанной ссылке трека — похоже на истёкшую подпись."""
+    if isinstance(e, DownloadError):
+        return e.status in LINK_EXPIRED_STATUSES
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code in LINK_EXPIRED_STATUSES
 
-    # Look for cover image
-    cover_image = None
-    for ext in ['.jpeg', '.jpg', '.png']:
-        potential_cover = audiobook_path / f"{audiobook_path.name}{ext}"
-        if potential_cover.exists():
-            cover_image = potential_cover
-            break
 
-    # Create a temporary file list and chapter metadata file for ffmpeg
-    filelist_path = audiobook_path / "chapters_list.txt"
-    chapters_metadata_path = audiobook_path / "chapters_metadata.txt"
+def _url_expiry(url: str) -> float | None:
+    """Момент истечения (epoch), если подпись несёт его в параметрах ссылки (expires=…, exp=…)."""
+    import urllib.parse
+    for key, values in urllib.parse.parse_qs(urllib.parse.urlparse(url).query).items():
+        if "exp" in key.lower() and values and values[0].isdigit() and int(values[0]) > 1_000_000_000:
+            return float(values[0])
+    return None
+
+
+def track_playlist(uuid: str, data: dict) -> int:
+    """Запоминает полученный playlists.json книги; возвращает его поколение."""
+    with _playlists_lock:
+        entry = _playlists.get(uuid)
+        generation = entry["generation"] + 1 if entry else 0
+        _playlists[uuid] = {"generation": generation, "fetched": time.monotonic(),
+                            "fetched_at": time.time(), "worked": 0.0, "data": data}
+    return generation
+
 
+def playlist_link_worked(uuid: str, generation: int):
+    """Трек поколения generation скачан — ссылки этого поколения живы как минимум до сих пор."""
+    with _playlists_lock:
+        entry = _playlists.get(uuid)
+        if entry and entry["generation"] == generation:
+            entry["worked"] = time.monotonic() - entry["fetched"]
+
+
+def refresh_playlist(uuid: str, generation: int, book_dir: str | None = None) -> tuple[int, dict]:
+    """
+    Свежий playlists.json вместо поколения generation, ссылки которого истекли.
+    Если другой воркер уже обновил его — возвращается готовый результат без запроса.
+    """
+    with _playlists_lock:
+        lock = _playlist_refresh_locks.setdefault(uuid, threading.Lock())
+    with lock:
+        with _playlists_lock:
+            entry = dict(_playlists.get(uuid) or {})
+        if entry and entry["generation"] > generation:
+            return entry["generation"], entry["data"]
+        if entry:
+            expired_after = time.monotonic() - entry["fetched"]
+            nominal = None
+            for track in (entry["data"] or {}).get("tracks", []):
+                urls = _available_variants_track(track)
+                expiry = next((_url_expiry(u) for u in urls.values() if _url_expiry(u)), None)
+                if expiry:
+                    nominal = expiry - entry["fetched_at"]
+                    break
+            print(f"[links] Signed track URLs expired: worked for {entry['worked'] / 60:.0f} min, "
+                  f"failed {expired_after / 60:.0f} min after the playlist was fetched"
+                  + (f" (nominal lifetime {nominal / 60:.0f} min)" if nominal else "")
+                  + ". Re-fetching playlists.json...")
+            if book_dir:
+                update_manifest_section(book_dir, "links", str(entry["generation"]), {
+                    "fetched_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(entry["fetched_at"])),
+                    "worked_s": round(entry["worked"]),
+                    "expired_s": round(expired_after),
+                    "nominal_s": round(nominal) if nominal else None,
+                })
+                add_summary_note(f"{os.path.basename(book_dir)}: signed links expired after "
+                                 f"~{expired_after / 60:.0f} min, playlist re-fetched")
+        url = URLS['audiobook']['contentUrl'].format(uuid=uuid)
+        data = run_async_safely(send_request(url)).json()
+        count_stat("relinked")
+        return track_playlist(uuid, data), data
+
+
+# ------- Выбор качества под бюджет (--max-mb-per-book, --max-kbps)
+
+def _budget_active() -> bool:
+    return bool(CONFIG["audio_budget_mb"] or CONFIG["audio_max_kbps"])
+
+
+async def _probe_size(client: httpx.AsyncClient, url: str) -> int | None:
+    """Размер файла по HEAD; если HEAD не дал Content-Length — по Content-Range на запрос одного байта."""
     try:
-        # Get chapter durations first (for proper chapter markers)
-        print(" Analyzing chapter durations...")
-        chapter_durations = []
-        current_time = 0.0
-        for chapter_file in chapter_files:
-            duration_cmd = [
-                'ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-                '-of', 'csv=p=0', str(chapter_file)
-            ]
-            duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
-            if duration_result.returncode == 0 and duration_result.stdout.strip():
-                duration = float(duration_result.stdout.strip())
+        resp = await client.head(url, headers=HEADERS)
+        if resp.status_code == 200 and resp.headers.get("content-length", "").isdigit():
+            return int(resp.headers["content-length"])
+        async with client.stream("GET", url, headers={**HEADERS, "Range": "bytes=0-0"}) as resp:
+            total = resp.headers.get("content-range", "").rpartition("/")[2]
+            if resp.status_code == 206 and total.isdigit():
+                return int(total)
+            if resp.status_code == 200 and resp.headers.get("content-length", "").isdigit():
+                return int(resp.headers["content-length"])
+    except httpx.HTTPError:
+        pass
+    return None
+
+
+async def _variant_sizes(book_dir: str, tracks: list[dict]) -> dict[str, dict[str, int]]:
+    """
+    {номер трека: {вариант: байты}}: размеры из playlists.json, иначе HEAD.
+    Кэшируется в манифесте (variant_sizes) — повторный запуск не опрашивает сервер.
+    """
+    cache = read_manifest(book_dir).get("variant_sizes") or {}
+    todo = []
+    for track in tracks:
+        known = cache.setdefault(str(track["number"]), {})
+        for key, variant in (track.get("offline") or {}).items():
+            if not (isinstance(variant, dict) and variant.get("url")) or key in known:
+                continue
+            size = _variant_size(variant)
+            if size:
+                known[key] = size
             else:
-                print(f"⚠️ Could not get duration for {chapter_file.name}, assuming 180s")
-                duration = 180.0
-            chapter_durations.append((current_time, current_time + duration, chapter_file))
-            current_time += duration
-
-        # Write ffmpeg concat file list
-        with open(filelist_path, 'w', encoding='utf-8') as f:
-            for chapter_file in chapter_files:
-                abs_path = str(chapter_file.absolute()).replace("'", "'\"'\"'")
-                f.write(f"file '{abs_path}'\n")
-
-        # Create chapters metadata file
-        with open(chapters_metadata_path, 'w', encoding='utf-8') as f:
-            f.write(";FFMETADATA1\n")
-            # Add global metadata from dictionary if provided
-            if metadata:
-                for key, value in metadata.items():
-                    if value:
-                        escaped_value = str(value).replace('=', '\\=').replace(';', '\\;').replace('#', '\\#').replace('\\', '\\\\')
-                        f.write(f"{key.upper()}={escaped_value}\n")
-            # Add chapter markers
-            for i, (start_time, end_time, chapter_file) in enumerate(chapter_durations):
-                chapter_num = i + 1
-                f.write("\n[CHAPTER]\n")
-                f.write("TIMEBASE=1/1000\n")
-                f.write(f"START={int(start_time * 1000)}\n")
-                f.write(f"END={int(end_time * 1000)}\n")
-                f.write(f"title=Глава {chapter_num}\n")
-
-        # Build ffmpeg command
-        cmd = [
-            'ffmpeg', '-y',
-            '-f', 'concat',
-            '-safe', '0',
-            '-i', str(filelist_path),
-            '-i', str(chapters_metadata_path),
-        ]
-        if cover_image:
-            cmd.extend(['-i', str(cover_image)])
-            cmd.extend(['-c:v', 'copy'])
-            cmd.extend(['-c:a', 'copy'])
-            cmd.extend(['-disposition:v:0', 'attached_pic'])
-            cmd.extend(['-map_metadata', '1'])
-        else:
-            cmd.extend(['-c', 'copy'])
-            cmd.extend(['-map_metadata', '1'])
+                todo.append((known, key, variant["url"].replace(".m3u8", ".m4a")))
+    if todo:
+        print(f"[budget] Probing sizes of {len(todo)} track variant(s)...")
+        sem = asyncio.Semaphore(8)
+        async with httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(CONFIG["timeout_base_request"]),
+            transport=_build_transport(http2=False, verify=False),
+        ) as client:
+            async def one(known, key, url):
+                async with sem:
+                    size = await _probe_size(client, url)
+                if size:
+                    known[key] = size
+
+            await asyncio.gather(*(one(*item) for item in todo))
+    update_manifest(book_dir, variant_sizes=cache)
+    return cache
+
+
+def plan_variants(tracks: list[dict], sizes: dict[str, dict[str, int]],
+                  measured: dict[str, float] | None = None) -> tuple[dict[str, str], int]:
+    """
+    Вариант для каждого трека: самый тяжёлый (= лучший), не выше --max-kbps по битрейту трека,
+    так чтобы сумма уложилась в --max-mb-per-book. Качество поднимается ступенями сразу для всех
+    треков (книга звучит одинаково), остаток бюджета добирается отдельными треками с наименьшей
+    доплатой. Возвращает ({номер трека: вариант}, оценка байт). Треки без известных размеров не планируются.
+    Длительность трека — из playlists.json, иначе measured (из манифеста прошлой загрузки), иначе
+    оценка по байтрейту того же варианта у остальных треков книги.
+    """
+    max_kbps = CONFIG["audio_max_kbps"]
+    budget = CONFIG["audio_budget_mb"] * 1024 * 1024 or float("inf")
+    measured = measured or {}
+
+    durations = {str(t["number"]): _track_duration(t) or measured.get(str(t["number"])) for t in tracks}
+    variant_rate: dict[str, list[float]] = {}  # вариант -> [байт, секунд] по трекам с известной длительностью
+    for num, duration in durations.items():
+        for key, size in sizes.get(num, {}).items():
+            if duration:
+                acc = variant_rate.setdefault(key, [0.0, 0.0])
+                acc[0] += size
+                acc[1] += duration
+
+    cands: dict[str, list[tuple[str, int]]] = {}
+    uncapped = []
+    for track in tracks:
+        num = str(track["number"])
+        opts = sorted(sizes.get(num, {}).items(), key=lambda kv: -kv[1])
+        duration = durations[num]
+        if max_kbps and not duration and opts:
+            guesses = [size * acc[1] / acc[0] for key, size in opts
+                       if (acc := variant_rate.get(key)) and acc[0]]
+            duration = sum(guesses) / len(guesses) if guesses else None
+            if not duration:
+                uncapped.append(num)
+        if max_kbps and duration:
+            # даже самый лёгкий вариант выше лимита — берём самый лёгкий
+            opts = [kv for kv in opts if kv[1] * 8 / duration / 1000 <= max_kbps] or opts[-1:]
+        if opts:
+            cands[num] = opts
+    if uncapped:
+        print(f"[budget] ⚠️ No duration for track(s) {', '.join(uncapped)} — "
+              f"--max-kbps {max_kbps:g} could not be applied to them")
+
+    level = {num: len(opts) - 1 for num, opts in cands.items()}
+    total = sum(cands[n][level[n]][1] for n in cands)
+    if total > budget:
+        print(f"[budget] ⚠️ Even the smallest variants need {total / 1048576:.1f} MB "
+              f"(budget {CONFIG['audio_budget_mb']} MB) — using them anyway")
+    while True:
+        ups = [(cands[n][level[n] - 1][1] - cands[n][level[n]][1], n) for n in cands if level[n] > 0]
+        if not ups:
+            break
+        step = sum(cost for cost, _ in ups)
+        if total + step <= budget:
+            for _cost, n in ups:
+                level[n] -= 1
+            total += step
+            continue
+        for cost, n in sorted(ups):
+            if total + cost <= budget:
+                level[n] -= 1
+                total += cost
+        break
+    return {n: cands[n][level[n]][0] for n in cands}, total
 
-        if metadata:
-            for key, value in metadata.items():
-                if value:
-                    cmd.extend(['-metadata', f'{key}={value}'])
-        else:
-            cmd.extend(['-metadata', f'title={audiobook_path.name}'])
-            cmd.extend(['-metadata', 'genre=Audiobook'])
-            cmd.extend(['-metadata', 'media_type=2'])
-
-        cmd.append(str(output_file))
-
-        # Run ffmpeg
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
-        if result.returncode == 0:
-            print(f"✅ Successfully merged audiobook: {output_file}")
-            # Clean up individual chapter files after successful merge (if requested)
-            if cleanup_chapters:
-                print(" Cleaning up chapter files...")
-                for chapter_file in chapter_files:
-                    try:
-                        from pathlib import Path as _P
-                        _P(chapter_file).unlink()
-                        print(f" Removed: {chapter_file.name}")
-                    except OSError as e:
-                        print(f" ⚠️ Could not remove {chapter_file.name}: {e}")
-            return True
-        else:
-            print(f"❌ Error merging audiobook with ffmpeg:")
-            print(result.stderr)
-            return False
-    finally:
-        # Remove temp files
+
+@traced("download_book", "resource")
+def download_book(uuid, series='', serial_path=None):
+    if skip_archived(uuid, placed=bool(series or serial_path)):
+        return
+    path = serial_path if serial_path else get_resource_info('book', uuid, series)
+    if serial_path:
+        update_manifest(os.path.dirname(path), type='book', uuid=uuid)
+    fetch_or_download(uuid, "epub", URLS['book']['contentUrl'].format(uuid=uuid), f'{path}.epub')
+    # Extra formats (by default FB2 + simple text-only PDF), see --formats
+    write_formats('book', uuid, f'{path}.epub', path)
+
+    # эпизоды сериала уходят в приёмник вместе с сериалом
+    finish_resource(uuid, os.path.dirname(path), publish=not serial_path)
+
+
+def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, cleanup_chapters=True):
+    """
+    Merge all M4A chapter files in a directory into a single audiobook using ffmpeg.
+    Реализация живёт в merge_audiobook.py (только stdlib) и общая с отдельной утилитой склейки.
+    Returns True on success, False otherwise.
+    """
+    from merge_audiobook import merge_audiobook_chapters_ffmpeg as _merge
+    return _merge(audiobook_dir, output_file, metadata=metadata, cleanup_chapters=cleanup_chapters)
+
+
+def merge_audiobook_chapters(audiobook_dir, output_file, metadata=None, cleanup_chapters=True):
+    """
+    Склейка глав: встроенный ремукс MP4 (без ffmpeg), fallback — ffmpeg. См. merge_audiobook.py.
+    Returns True on success, False otherwise.
+    """
+    from merge_audiobook import merge_audiobook_chapters as _merge
+    return _merge(audiobook_dir, output_file, metadata=metadata, cleanup_chapters=cleanup_chapters)
+
+def _download_track(av: dict, try_order: list[str], out_path: str, ntrack: str) -> str | None:
+    """
+    Скачивает трек: варианты по try_order по одной попытке (5xx — следующий вариант),
+    затем предпочтительный (или зависший) — с ретраями. Возвращает скачанный вариант;
+    None — скачивать нечего. 4xx пробрасывается (см. истечение ссылок).
+    """
+    success = False
+    used_key = None
+    stalled_key = None
+
+    for idx, key in enumerate(try_order):
+        url_try = av[key].replace(".m3u8", ".m4a")
         try:
-            if filelist_path.exists():
-                filelist_path.unlink()
-            if chapters_metadata_path.exists():
-                chapters_metadata_path.unlink()
-        except Exception:
-            pass
+            # одна попытка без бэкоффа — если 5xx, пробуем следующий вариант качества
+            run_async_safely(download_file_once(url_try, out_path))
+            if idx > 0:
+                # если это не первый (предпочтительный) — сообщаем о даунгрейде/смене
+                print(f"Fallback to {key} for track {ntrack} (preferred {try_order[0]} was 5xx).")
+            success = True
+            used_key = key
+            break
+        except GracefulExit:
+            raise
+        except StallError as e:
+            # этот вариант отвечает, но тянется — докачиваем его же с ретраями (см. ниже)
+            count_stat("stalls")
+            print(f"⚠️ Track {ntrack} ({key}) stalled: {e}")
+            stalled_key = key
+            break
+        except httpx.HTTPStatusError as e:
+            st = getattr(e.response, "status_code", None) if hasattr(e, "response") else None
+            # если не 5xx — это реальная ошибка, пробрасываем немедленно
+            if not (st and 500 <= st <= 599):
+                raise
+            # 5xx — печать body уже была внутри download_file_once; идём понижать качество
+            continue
+
+    if not success:
+        if stalled_key:
+            retry_key = stalled_key
+        else:
+            # Все варианты дали 5xx: тело ответа уже показали внутри download_file_once.
+            print(f"All variants 5xx for track {ntrack}. Will retry preferred with backoff...")
+            # следующая попытка — по обычной схеме (с бэкоффом/ретраями)
+            # берём предпочитаемый из try_order; если вдруг пусто — пропускаем
+            retry_key = try_order[0] if try_order else None
+        if not retry_key:
+            print(f"❌ No usable offline variants for track {ntrack}")
+            return None
+        final_url = av[retry_key].replace(".m3u8", ".m4a")
+        run_async_safely(download_file(final_url, out_path, resume=bool(stalled_key)))
+        used_key = retry_key
+    return used_key
 
+
+@traced("download_audiobook", "resource")
 def download_audiobook(uuid, series='', max_bitrate=False, merge_chapters=False, cleanup_chapters=True):
-    if is_archived(uuid):
-        print(f"[archive] Skipping already downloaded: {uuid}")
+    if skip_archived(uuid, placed=bool(series)):
         return
     path = get_resource_info('audiobook', uuid, series)
     resp = get_resource_json('audiobook', uuid)
     if resp:
+        generation = track_playlist(uuid, resp)
+        fresh_tracks = {}  # номер -> трек из обновлённого playlists.json (после истечения ссылок)
         # Сформируем базовый порядок ИСКЛЮЧИТЕЛЬНО из playlists.json
         pref_mode = 'max' if max_bitrate else 'min'
         base_order = _playlist_variants_order(resp, pref=pref_mode)  # печатает Available offline variants
@@ -830,83 +2033,139 @@ def download_audiobook(uuid, series='', max_bitrate=False, merge_chapters=False,
         # Предпочитаемый ключ (первый в base_order)
         pref_key = _preferred_key(base_order)
 
+        # Длительности треков фиксируем в манифесте (для verify и индексов глав)
+        tracks_meta = read_manifest(book_dir).get("tracks") or {}
+
+        # Бюджетный режим: вариант на каждый трек выбирается заранее по размерам
+        plan, sizes = {}, {}
+        if _budget_active():
+            sizes = run_async_safely(_variant_sizes(book_dir, json_data))
+            measured = {str(rec["number"]): rec["measured"] for rec in tracks_meta.values()
+                        if rec.get("number") is not None and rec.get("measured")}
+            plan, est_bytes = plan_variants(json_data, sizes, measured)
+            counts: dict[str, int] = {}
+            for key in plan.values():
+                counts[key] = counts.get(key, 0) + 1
+            limits = ", ".join(x for x in (
+                f"budget {CONFIG['audio_budget_mb']} MB" if CONFIG["audio_budget_mb"] else "",
+                f"≤ {CONFIG['audio_max_kbps']:g} kbps" if CONFIG["audio_max_kbps"] else "") if x)
+            print(f"[budget] Plan: {', '.join(f'{n}× {k}' for k, n in counts.items()) or '(no sizes known)'}; "
+                  f"estimated total {est_bytes / 1048576:.1f} MB ({limits})")
+            update_manifest(book_dir, quality={"mode": "budget", "budget_mb": CONFIG["audio_budget_mb"],
+                                               "max_kbps": CONFIG["audio_max_kbps"], "estimated_bytes": est_bytes})
+
         for track in json_data:
             ntrack = f'{track["number"]}'
             while len(ntrack) < width:
                 ntrack = '0' + ntrack
             name = f'Глава_{ntrack}.m4a'
             out_path = f"{book_dir}/{name}"
+            tracks_meta.setdefault(name, {})
+            tracks_meta[name].update(number=track["number"], duration=_track_duration(track))
+            if track.get("title"):
+                tracks_meta[name]["title"] = track["title"]  # название главы для оглавления (--merge-mode virtual)
 
             if name in files:
                 continue
 
-            # «вежливая» задержка, если включена
-            if CONFIG["throttle"] and CONFIG["throttle"] > 0:
-                pause = random.uniform(CONFIG["throttle"] / 2, CONFIG["throttle"])
-                print(f"Throttling for {pause:.2f}s before next track...")
-                time.sleep(pause)
-
+            num = str(track["number"])
+            chosen = plan.get(num)
+            track = fresh_tracks.get(track["number"], track)
             av = _available_variants_track(track)
             # Try- ordem: фильтруем ДЛЯ ЭТОГО трека согласно base_order
             try_order = [k for k in base_order if k in av]
+            if chosen in av:
+                # при 5xx откатываемся только на варианты не тяжелее выбранного — бюджет не превышаем
+                limit = sizes[num][chosen]
+                lighter = [k for k in try_order if k != chosen and sizes[num].get(k, float("inf")) <= limit]
+                try_order = [chosen] + sorted(lighter, key=lambda k: -sizes[num][k])
 
             if not try_order:
                 print(f"❌ No offline URL for track {ntrack}")
                 continue
 
-            success = False
+            # в хранилище трек лежит под фактически скачанным вариантом — берём только нужный
+            if blob_fetch(uuid, f"audio-{try_order[0]}-{name}", out_path):
+                tracks_meta[name].update(variant=try_order[0], size=os.path.getsize(out_path))
+                continue
 
-            for idx, key in enumerate(try_order):
-                url_try = av[key].replace(".m3u8", ".m4a")
-                try:
-                    # одна попытка без бэкоффа — если 5xx, пробуем следующий вариант качества
-                    run_async_safely(download_file_once(url_try, out_path))
-                    if idx > 0:
-                        # если это не первый (предпочтительный) — сообщаем о даунгрейде/смене
-                        print(f"Fallback to {key} for track {ntrack} (preferred {try_order[0]} was 5xx).")
-                    success = True
-                    break
-                except GracefulExit:
+            # «вежливая» задержка, если включена
+            if CONFIG["throttle"] and CONFIG["throttle"] > 0:
+                pause = random.uniform(CONFIG["throttle"] / 2, CONFIG["throttle"])
+                print(f"Throttling for {pause:.2f}s before next track...")
+                with span("throttle", "wait"):
+                    time.sleep(pause)
+
+            try:
+                used_key = _download_track(av, try_order, out_path, ntrack)
+            except (httpx.HTTPStatusError, DownloadError) as e:
+                if not _link_expired(e):
                     raise
-                except httpx.HTTPStatusError as e:
-                    st = getattr(e.response, "status_code", None) if hasattr(e, "response") else None
-                    # если не 5xx — это реальная ошибка, пробрасываем немедленно
-                    if not (st and 500 <= st <= 599):
-                        raise
-                    # 5xx — печать body уже была внутри download_file_once; идём понижать качество
-                    continue
-
-            if not success:
-                # Все варианты дали 5xx: тело ответа уже показали внутри download_file_once.
-                print(f"All variants 5xx for track {ntrack}. Will retry preferred with backoff...")
-                # следующая попытка — по обычной схеме (с бэкоффом/ретраями)
-                # берём предпочитаемый из try_order; если вдруг пусто — пропускаем
-                retry_key = try_order[0] if try_order else None
-                if not retry_key:
-                    print(f"❌ No usable offline variants for track {ntrack}")
-                    continue
-                final_url = av[retry_key].replace(".m3u8", ".m4a")
-                run_async_safely(download_file(final_url, out_path))
+                # подписанные ссылки истекли посреди книги — берём свежий playlists.json и
+                # повторяем трек; если и свежая ссылка даёт 4xx, это уже настоящая ошибка
+                print(f"⚠️ Track {ntrack}: HTTP {getattr(e, 'status', None) or e.response.status_code} — signed URL looks expired")
+                generation, fresh = refresh_playlist(uuid, generation, book_dir)
+                fresh_tracks = {t.get("number"): t for t in fresh.get("tracks", [])}
+                track = fresh_tracks.get(track["number"], track)
+                av = _available_variants_track(track)
+                try_order = [k for k in try_order if k in av]
+                used_key = _download_track(av, try_order, out_path, ntrack)
+            if used_key is None:
+                continue
+            playlist_link_worked(uuid, generation)
+
+            if os.path.exists(out_path):
+                blob_put(uuid, f"audio-{used_key}-{name}", out_path)
+                # фактически скачанный вариант — в манифест (в бюджетном режиме может отличаться от плана)
+                tracks_meta[name].update(variant=used_key, size=os.path.getsize(out_path))
+                try:
+                    tracks_meta[name]["measured"] = _mp4_duration(out_path)
+                except (ValueError, IndexError, OSError) as e:
+                    print(f"⚠️ {name}: unreadable M4A container ({e})")
+
+        update_manifest(book_dir, tracks=tracks_meta)
+        wait_resource_meta(book_dir)  # склейка и AAC встраивают обложку
 
         # Merge chapters if requested
-        if merge_chapters:
+        if merge_chapters and CONFIG["merge_mode"] == "physical":
             try:
                 output_file = f"{path}.m4a"
                 _meta = {"title": os.path.basename(path)}
-                ok = merge_audiobook_chapters_ffmpeg(book_dir, output_file, metadata=_meta, cleanup_chapters=cleanup_chapters)
-                if not ok:
+                chapters = _chapter_files(book_dir)
+                # если главы удаляются, пересобрать склейку всё равно не из чего — не хэшируем
+                src_hash = None if cleanup_chapters else source_hash(book_dir, chapters)
+                with span("merge", "audio", chapters=len(chapters)):
+                    ok = merge_audiobook_chapters(book_dir, output_file, metadata=_meta, cleanup_chapters=cleanup_chapters)
+                if ok:
+                    record_derivative(book_dir, "m4a", output_file, chapters, src_hash, _merge_converter())
+                else:
                     print("⚠️ Merge failed or was skipped.")
             except Exception as e:
                 print(f"⚠️ Merge error: {e}")
 
+        # Перекодирование копии для прослушивания: склеенный файл, если он есть, иначе главы
+        if CONFIG["transcode"]:
+            merged = f"{path}.m4a"
+            targets = [merged] if merge_chapters and os.path.exists(merged) else _chapter_files(book_dir)
+            with span("transcode", "ffmpeg", files=len(targets)):
+                transcode_audiobook(book_dir, targets)
+
+        # Оглавление — после перекодирования: в нём должны быть итоговые имена глав (.opus)
+        if merge_chapters and CONFIG["merge_mode"] == "virtual":
+            chapters = _chapter_files(book_dir)
+            written = write_chapter_index(book_dir, path, _audiobook_metadata(book_dir))
+            if written:
+                record_derivative(book_dir, "index", written[0], chapters,
+                                  chapter_index_hash(book_dir, chapters), f"index@{CHAPTER_INDEX_VERSION}")
+
     else:
         print(f" Audiobook chapters saved separately in: {os.path.dirname(path)}")
 
-    add_to_archive(uuid)
+    finish_resource(uuid, os.path.dirname(path))
 
+@traced("download_comicbook", "resource")
 def download_comicbook(uuid, series=''):
-    if is_archived(uuid):
-        print(f"[archive] Skipping already downloaded: {uuid}")
+    if skip_archived(uuid, placed=bool(series)):
         return
     path = get_resource_info('comicbook', uuid, series)
     resp = get_resource_json('comicbook', uuid)
@@ -915,19 +2174,18 @@ def download_comicbook(uuid, series=''):
         namelist = path.split(". ", 2)[:2]
         name = "_".join(namelist)
         download_dir = os.path.dirname(path)
-        run_async_safely(download_file(download_url, f'{name}.cbr'))
-        with zipfile.ZipFile(f'{name}.cbr', 'r') as zip_ref:
-            zip_ref.extractall(download_dir)
-        shutil.rmtree(download_dir + "/preview", ignore_errors=False, onerror=None)
-        create_pdf_from_images(download_dir, f"{name}.pdf")
+        fetch_or_download(uuid, "cbr", download_url, f'{name}.cbr')
+        write_formats('comicbook', uuid, f'{name}.cbr', name)
 
-    add_to_archive(uuid)
+    finish_resource(uuid, os.path.dirname(path))
 
+@traced("download_serial", "resource")
 def download_serial(uuid):
     if is_archived(uuid):
         print(f"[archive] Skipping already downloaded: {uuid}")
         return
-    path = get_resource_info('book', uuid)
+    path = get_resource_info('book', uuid, content_type='serial')
+    update_manifest(os.path.dirname(path), type='serial')
     resp = get_resource_json('serial', uuid)
     if resp:
         for episode_index, episode in enumerate(resp["episodes"]):
@@ -936,8 +2194,9 @@ def download_serial(uuid):
             os.makedirs(download_dir, exist_ok=True)
             download_book(episode['uuid'], serial_path=f'{download_dir}/{name}')
 
-    add_to_archive(uuid)
+    finish_resource(uuid, os.path.dirname(path))
 
+@traced("download_series", "resource")
 def download_series(uuid):
     if is_archived(uuid):
         print(f"[archive] Skipping already downloaded: {uuid}")
@@ -951,7 +2210,317 @@ def download_series(uuid):
         func = FUNCTION_MAP[part['resource_type']]
         func(part['resource']['uuid'], f"{name}/{part_index+1}. ")
 
+    # части серии публикуются сами; здесь — только файлы самой серии
+    finish_resource(uuid, os.path.dirname(path), recursive=False)
+
+# =========================
+# Storage sinks (--sink, --pack)
+# =========================
+# Загрузка и конвертеры работают с локальным каталогом ресурса (ffmpeg, EPUB→FB2/PDF и verify
+# нужны файлы с произвольным доступом), поэтому mybooks/ — промежуточная площадка. По завершении
+# ресурса каждый файл один раз потоком уходит в приёмник: как есть, tar/zip-архивом на ресурс или
+# в S3-совместимое хранилище multipart-загрузкой. Без --keep-local локальная копия затем удаляется.
+
+class _FileWriter:
+    """Запись в локальный файл через .part → os.replace (как download_file)."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.f = open(f"{path}.part", "wb")
+
+    def write(self, data) -> int:
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+        os.replace(f"{self.path}.part", self.path)
+
+    def abort(self):
+        self.f.close()
+        with contextlib.suppress(OSError):
+            os.remove(f"{self.path}.part")
+
+
+class LocalSink:
+    """Каталог на диске (в том числе сам mybooks/ — для архивов --pack рядом с ресурсом)."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def open(self, key: str):
+        return _FileWriter(os.path.join(self.root, key))
+
+    def __str__(self):
+        return self.root
+
+
+def _s3_quote(s: str) -> str:
+    import urllib.parse
+    return urllib.parse.quote(s, safe="-_.~")
+
+
+class S3Sink:
+    """
+    S3-совместимое хранилище (AWS, MinIO, …), path-style адреса, подпись SigV4.
+    Ключи доступа — AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY.
+    """
+
+    def __init__(self, url: str, endpoint: str | None = None, region: str | None = None):
+        import urllib.parse
+        parsed = urllib.parse.urlparse(url)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.endpoint = (endpoint or os.environ.get("AWS_ENDPOINT_URL")
+                         or "https://s3.amazonaws.com").rstrip("/")
+        self.region = region or os.environ.get("AWS_REGION") or "us-east-1"
+        self.access_key = os.environ.get("AWS_ACCESS_KEY_ID", "")
+        self.secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY", "")
+        if not (self.bucket and self.access_key and self.secret_key):
+            raise ValueError("s3 sink needs s3://bucket[/prefix] and AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY")
+        self.client = httpx.Client(timeout=CONFIG["timeout_base_download"] * 4)
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefix} at {self.endpoint}"
+
+    def _url(self, key: str) -> tuple[str, str]:
+        """(URL объекта, канонический путь) — путь кодируется один раз, как его подписывают."""
+        full = f"{self.prefix}/{key}" if self.prefix else key
+        path = "/" + _s3_quote(self.bucket) + "/" + "/".join(_s3_quote(p) for p in full.split("/"))
+        return self.endpoint + path, path
+
+    def _sign(self, method: str, path: str, query: dict, headers: dict, payload: bytes) -> dict:
+        import hashlib
+        import hmac
+        import urllib.parse
+        now = time.gmtime()
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", now)
+        day = amz_date[:8]
+        payload_hash = hashlib.sha256(payload).hexdigest()
+        headers = {**headers, "host": urllib.parse.urlparse(self.endpoint).netloc,
+                   "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash}
+        signed = sorted(k.lower() for k in headers)
+        lower = {k.lower(): str(v).strip() for k, v in headers.items()}
+        canonical = "\n".join([
+            method,
+            path,
+            "&".join(f"{_s3_quote(k)}={_s3_quote(str(v))}" for k, v in sorted(query.items())),
+            "".join(f"{k}:{lower[k]}\n" for k in signed),
+            ";".join(signed),
+            payload_hash,
+        ])
+        scope = f"{day}/{self.region}/s3/aws4_request"
+        to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+        key = f"AWS4{self.secret_key}".encode()
+        for part in (day, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["Authorization"] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                                    f"SignedHeaders={';'.join(signed)}, Signature={signature}")
+        del headers["host"]
+        return headers
+
+    def request(self, method: str, key: str, query: dict | None = None, payload: bytes = b"",
+                headers: dict | None = None) -> httpx.Response:
+        """Подписанный запрос с ретраями на обрывы и RETRY_STATUSES."""
+        import urllib.parse
+        url, path = self._url(key)
+        query = query or {}
+        if query:
+            url += "?" + urllib.parse.urlencode(query, quote_via=urllib.parse.quote)
+        for attempt in range(CONFIG["max_retries"]):
+            try:
+                resp = self.client.request(method, url, content=payload,
+                                           headers=self._sign(method, path, query, headers or {}, payload))
+                if resp.status_code not in RETRY_STATUSES:
+                    if resp.status_code >= 400:
+                        raise DownloadError(f"S3 {method} {key}: HTTP {resp.status_code} {resp.text[:200]}",
+                                            url, resp.status_code)
+                    return resp
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                if attempt == CONFIG["max_retries"] - 1:
+                    raise DownloadError(f"S3 {method} {key}: {type(e).__name__}", url) from e
+            if attempt < CONFIG["max_retries"] - 1:
+                time.sleep(min(CONFIG["backoff_initial"] * 2 ** attempt, CONFIG["backoff_cap"]))
+        raise DownloadError(f"S3 {method} {key}: HTTP {resp.status_code}", url, resp.status_code)
+
+    def open(self, key: str):
+        return _S3Writer(self, key)
+
+
+class _S3Writer:
+    """Потоковая загрузка объекта: до part_size — один PUT, дальше multipart по частям."""
+
+    def __init__(self, sink: S3Sink, key: str):
+        self.sink, self.key = sink, key
+        self.part_size = max(5, int(CONFIG["s3_part_mb"])) * 1024 * 1024
+        self.buf = bytearray()
+        self.upload_id = None
+        self.parts: list[str] = []
+
+    def write(self, data) -> int:
+        self.buf += data
+        while len(self.buf) >= self.part_size:
+            self._upload_part(bytes(self.buf[:self.part_size]))
+            del self.buf[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass  # части уходят по мере накопления, остаток — в close()
+
+    def _upload_part(self, chunk: bytes):
+        if self.upload_id is None:
+            resp = self.sink.request("POST", self.key, {"uploads": ""})
+            m = re.search(r"<UploadId>([^<]+)</UploadId>", resp.text)
+            if not m:
+                raise DownloadError(f"S3 multipart: no UploadId for {self.key}", self.key)
+            self.upload_id = m.group(1)
+        number = len(self.parts) + 1
+        resp = self.sink.request("PUT", self.key, {"partNumber": number, "uploadId": self.upload_id}, chunk)
+        self.parts.append(resp.headers.get("ETag", ""))
+
+    def close(self):
+        if self.upload_id is None:
+            self.sink.request("PUT", self.key, payload=bytes(self.buf))
+            return
+        if self.buf:
+            self._upload_part(bytes(self.buf))
+            self.buf.clear()
+        body = "<CompleteMultipartUpload>" + "".join(
+            f"<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>"
+            for n, etag in enumerate(self.parts, 1)) + "</CompleteMultipartUpload>"
+        resp = self.sink.request("POST", self.key, {"uploadId": self.upload_id}, body.encode())
+        if "<Error>" in resp.text:  # S3 может вернуть ошибку в теле ответа 200
+            raise DownloadError(f"S3 multipart complete failed for {self.key}: {resp.text[:200]}", self.key)
+
+    def abort(self):
+        if self.upload_id is not None:
+            with contextlib.suppress(DownloadError):
+                self.sink.request("DELETE", self.key, {"uploadId": self.upload_id})
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """Приёмник по CONFIG (создаётся один раз); None — файлы остаются в mybooks/ как есть."""
+    global _sink
+    target, pack = CONFIG["sink"], CONFIG["sink_pack"]
+    if not target and not pack:
+        return None
+    with _sink_lock:
+        if _sink is None:
+            if target and target.startswith("s3://"):
+                _sink = S3Sink(target, CONFIG["s3_endpoint"], CONFIG["s3_region"])
+            else:
+                _sink = LocalSink(target or "mybooks")
+        return _sink
+
+
+def _published_files(download_dir: str, recursive: bool) -> list[str]:
+    """Файлы ресурса для публикации — без .part и служебных каталогов."""
+    if not recursive:
+        return sorted(os.path.join(download_dir, n) for n in os.listdir(download_dir)
+                      if os.path.isfile(os.path.join(download_dir, n)) and not n.endswith(".part"))
+    out = []
+    for dirpath, dirnames, filenames in os.walk(download_dir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        out += [os.path.join(dirpath, n) for n in sorted(filenames) if not n.endswith(".part")]
+    return out
+
+
+def _copy_into(writer, path: str):
+    block = CONFIG["write_block"]
+    with open(path, "rb") as f:
+        while chunk := f.read(block):
+            writer.write(chunk)
+
+
+@traced("publish_resource", "sink")
+def publish_resource(download_dir: str, recursive: bool = True):
+    """
+    Отдаёт готовый ресурс в приёмник (--sink/--pack). Ключи — пути относительно mybooks/;
+    с --pack ресурс уходит одним архивом <каталог>.tar|.zip. Затем, без --keep-local,
+    опубликованные файлы удаляются с диска.
+    """
+    sink = get_sink()
+    if sink is None or not download_dir or not os.path.isdir(download_dir):
+        return
+    files = _published_files(download_dir, recursive)
+    if not files:
+        return
+    pack = CONFIG["sink_pack"]
+    if isinstance(sink, LocalSink) and not pack and os.path.realpath(sink.root) == os.path.realpath("mybooks"):
+        return  # файлы уже на месте
+    rel_dir = os.path.relpath(download_dir, "mybooks").replace(os.sep, "/")
+    total = sum(os.path.getsize(p) for p in files)
+
+    if pack:
+        key = f"{rel_dir}.{pack}"
+        writer = sink.open(key)
+        try:
+            base = os.path.dirname(download_dir)
+            if pack == "tar":
+                import tarfile
+                with tarfile.open(fileobj=writer, mode="w|") as tar:
+                    for p in files:
+                        tar.add(p, arcname=os.path.relpath(p, base).replace(os.sep, "/"), recursive=False)
+            else:
+                import zipfile
+                # медиа уже сжаты — без повторного сжатия, просто склейка потоком
+                with zipfile.ZipFile(writer, "w", zipfile.ZIP_STORED) as zf:
+                    for p in files:
+                        with open(p, "rb") as src, zf.open(os.path.relpath(p, base).replace(os.sep, "/"), "w",
+                                                           force_zip64=True) as dst:
+                            shutil.copyfileobj(src, dst, CONFIG["write_block"])
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        keys = [key]
+    else:
+        keys = []
+        for p in files:
+            key = os.path.relpath(p, "mybooks").replace(os.sep, "/")
+            writer = sink.open(key)
+            try:
+                _copy_into(writer, p)
+                writer.close()
+            except BaseException:
+                writer.abort()
+                raise
+            keys.append(key)
+
+    print(f"[sink] {rel_dir}: {len(files)} file(s), {total / 1048576:.1f} MB → {sink}"
+          + (f" as {keys[0]}" if pack else ""))
+    count_stat("published_mb", round(total / 1048576, 1))
+    if not CONFIG["keep_local"]:
+        for p in files:
+            with contextlib.suppress(OSError):
+                os.remove(p)
+        for dirpath, _dirnames, _filenames in sorted(os.walk(download_dir), key=lambda t: -len(t[0])):
+            with contextlib.suppress(OSError):
+                os.rmdir(dirpath)
+
+
+def finish_resource(uuid: str, download_dir: str, publish: bool = True, recursive: bool = True):
+    """
+    Завершение ресурса: приёмник → archive.txt → индекс. Индекс — последним, чтобы запись
+    получила статус complete; если локальная копия ушла в приёмник, запись (и вложенные) удаляется.
+    """
+    wait_resource_meta(download_dir)
+    if publish:
+        publish_resource(download_dir, recursive)
     add_to_archive(uuid)
+    if os.path.isdir(download_dir):
+        index_resource(download_dir)
+    else:
+        unindex_resource(download_dir)
+
 
 # =========================
 # Helpers for URL parsing & conversions
@@ -975,61 +2544,1634 @@ def extract_id_and_type_from_url(url: str) -> tuple[str | None, str | None]:
     return (None, None)
 
 
+# ------- Тип ресурса для «голого» UUID
+# Все infoUrl опрашиваются параллельно, побеждает первый ответ с метаданными нужного типа.
+# Сериал и книга делят один infoUrl — голый UUID сериала определяется как книга.
+TYPE_CACHE_FILE = "mybooks/.uuid_types.json"  # uuid -> тип, чтобы не опрашивать повторно
+PROBE_TYPES = ("book", "audiobook", "comicbook", "series")
+_BARE_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+TYPE_UNRESOLVED = "?"  # опрос не удался (сеть/5xx) — в отличие от None («нет ни под одним типом»)
+_type_cache: dict[str, str] | None = None
+_type_cache_lock = threading.Lock()
+
+
+def _load_type_cache() -> dict[str, str]:
+    global _type_cache
+    if _type_cache is None:
+        try:
+            with open(TYPE_CACHE_FILE, encoding='utf-8') as f:
+                _type_cache = json.load(f)
+        except (OSError, ValueError):
+            _type_cache = {}
+    return _type_cache
+
+
+def _save_types(found: dict[str, str]):
+    with _type_cache_lock:
+        cache = _load_type_cache()
+        cache.update(found)
+        os.makedirs(os.path.dirname(TYPE_CACHE_FILE), exist_ok=True)
+        tmp = f"{TYPE_CACHE_FILE}.part"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, TYPE_CACHE_FILE)
+
+
+async def _probe_types(uids: list[str]) -> dict[str, str | None]:
+    """
+    uuid -> тип, None — все типы ответили «нет», TYPE_UNRESOLVED — ответа так и не получили
+    (сбои сети/5xx, повторы с бэкоффом исчерпаны). Найденный info JSON кладётся в кэш,
+    так что get_resource_info его не запрашивает повторно.
+    """
+    timeout = httpx.Timeout(CONFIG["timeout_base_request"])
+    sem = asyncio.Semaphore(16)
+
+    async def one(client, uid, rtype):
+        url = URLS[rtype]['infoUrl'].format(uuid=uid)
+        async with sem:
+            resp = await client.get(url, headers=HEADERS, extensions=_http_trace_extensions())
+        if resp.status_code in RETRY_STATUSES:
+            resp.raise_for_status()
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        if not (isinstance(data, dict) and data.get(rtype)):
+            return None
+        _cache_json(url, data)
+        return rtype
+
+    async def resolve(client, uid):
+        for attempt in range(CONFIG["max_retries"]):
+            tasks = [asyncio.ensure_future(one(client, uid, t)) for t in PROBE_TYPES]
+            unsure = False
+            try:
+                for fut in asyncio.as_completed(tasks):
+                    try:
+                        rtype = await fut
+                    except (httpx.HTTPError, ValueError):
+                        unsure = True
+                        continue
+                    if rtype:
+                        return rtype
+            finally:
+                for t in tasks:
+                    t.cancel()
+            if not unsure:
+                return None  # все типы ответили «нет»
+            await asyncio.sleep(min(CONFIG["backoff_initial"] * 2 ** attempt, CONFIG["backoff_cap"]))
+        return TYPE_UNRESOLVED
+
+    async with httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=timeout,
+        transport=_build_transport(http2=False, verify=False),
+    ) as client:
+        types = await asyncio.gather(*(resolve(client, uid) for uid in uids))
+    return dict(zip(uids, types))
+
+
+@traced("resolve_uuid_types")
+def resolve_uuid_types(uids: list[str]) -> dict[str, str | None]:
+    """Типы для голых UUID: из кэша TYPE_CACHE_FILE, остальные — параллельным опросом."""
+    with _type_cache_lock:
+        cache = dict(_load_type_cache())
+    out = {uid: cache.get(uid) for uid in uids}
+    todo = list(dict.fromkeys(uid for uid, t in out.items() if not t))
+    if todo:
+        print(f"[type] Probing {len(todo)} bare ID(s) across {', '.join(PROBE_TYPES)}...")
+        found = run_async_safely(_probe_types(todo))
+        out.update(found)
+        _save_types({uid: t for uid, t in found.items() if t and t != TYPE_UNRESOLVED})
+    return out
+
+
+# =========================
+# Streaming text PDF
+# =========================
+# Кандидаты Unicode-шрифта с кириллицей (первый найденный); --pdf-font задаёт свой.
+PDF_FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/usr/share/fonts/liberation/LiberationSans-Regular.ttf",
+    "/System/Library/Fonts/Supplemental/Arial.ttf",
+    "/Library/Fonts/Arial.ttf",
+    os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts", "arial.ttf"),
+]
+
+
+def _find_pdf_font() -> str | None:
+    if CONFIG["pdf_font"]:
+        return CONFIG["pdf_font"]
+    for path in PDF_FONT_CANDIDATES:
+        if os.path.isfile(path):
+            return path
+    # последний вариант — Vera из reportlab (без кириллицы), не импортируя сам пакет
+    import importlib.util
+    spec = importlib.util.find_spec("reportlab")
+    if spec and spec.submodule_search_locations:
+        vera = os.path.join(list(spec.submodule_search_locations)[0], "fonts", "Vera.ttf")
+        if os.path.isfile(vera):
+            return vera
+    return None
+
+
+class TrueTypeFont:
+    """
+    Минимальный разбор TrueType: cmap (формат 4/12), hmtx и поля для FontDescriptor.
+    Ширины глифов кэшируются по символам — перенос строк считается по реальным метрикам.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.data = data = f.read()
+        if data[:4] not in (b"\x00\x01\x00\x00", b"true"):
+            raise ValueError(f"{path}: only plain TrueType (.ttf) fonts are supported")
+        num_tables = struct.unpack(">H", data[4:6])[0]
+        self.tables = {}
+        for i in range(num_tables):
+            tag, _csum, off, length = struct.unpack(">4sIII", data[12 + 16 * i: 28 + 16 * i])
+            self.tables[tag.decode("latin-1")] = (off, length)
+        head = self.tables["head"][0]
+        self.units_per_em = struct.unpack(">H", data[head + 18: head + 20])[0]
+        self.bbox = [self._scale(v) for v in struct.unpack(">hhhh", data[head + 36: head + 44])]
+        hhea = self.tables["hhea"][0]
+        asc, desc = struct.unpack(">hh", data[hhea + 4: hhea + 8])
+        self.ascent, self.descent = self._scale(asc), self._scale(desc)
+        self.num_hmetrics = struct.unpack(">H", data[hhea + 34: hhea + 36])[0]
+        self.cap_height = self.ascent
+        if "OS/2" in self.tables:
+            os2, os2_len = self.tables["OS/2"]
+            if struct.unpack(">H", data[os2: os2 + 2])[0] >= 2 and os2_len >= 90:
+                self.cap_height = self._scale(struct.unpack(">h", data[os2 + 88: os2 + 90])[0])
+        self.italic_angle = 0
+        if "post" in self.tables:
+            post = self.tables["post"][0]
+            self.italic_angle = struct.unpack(">i", data[post + 4: post + 8])[0] / 65536.0
+        stem = re.sub(r"[^A-Za-z0-9-]", "", os.path.splitext(os.path.basename(path))[0])
+        self.name = stem or "EmbeddedFont"
+        self.cmap = self._parse_cmap()
+        self._widths: dict[str, tuple[int, float]] = {}
+
+    def _scale(self, v: int) -> int:
+        return int(round(v * 1000 / self.units_per_em))
+
+    def _parse_cmap(self) -> dict[int, int]:
+        data = self.data
+        base = self.tables["cmap"][0]
+        n = struct.unpack(">H", data[base + 2: base + 4])[0]
+        subtables = {}
+        for i in range(n):
+            pid, eid, off = struct.unpack(">HHI", data[base + 4 + 8 * i: base + 12 + 8 * i])
+            subtables[(pid, eid)] = base + off
+        for key in ((3, 10), (0, 6), (0, 4), (3, 1), (0, 3), (0, 1), (0, 0)):
+            if key not in subtables:
+                continue
+            off = subtables[key]
+            fmt = struct.unpack(">H", data[off: off + 2])[0]
+            if fmt == 12:
+                return self._cmap12(off)
+            if fmt == 4:
+                return self._cmap4(off)
+        raise ValueError("no Unicode cmap in font")
+
+    def _cmap4(self, off: int) -> dict[int, int]:
+        data = self.data
+        seg_x2 = struct.unpack(">H", data[off + 6: off + 8])[0]
+        seg = seg_x2 // 2
+        ends = struct.unpack(f">{seg}H", data[off + 14: off + 14 + seg_x2])
+        starts_at = off + 16 + seg_x2
+        starts = struct.unpack(f">{seg}H", data[starts_at: starts_at + seg_x2])
+        deltas = struct.unpack(f">{seg}h", data[starts_at + seg_x2: starts_at + 2 * seg_x2])
+        ro_at = starts_at + 2 * seg_x2
+        range_offsets = struct.unpack(f">{seg}H", data[ro_at: ro_at + seg_x2])
+        out = {}
+        for i in range(seg):
+            for c in range(starts[i], ends[i] + 1):
+                if c == 0xFFFF:
+                    break
+                if range_offsets[i] == 0:
+                    g = (c + deltas[i]) & 0xFFFF
+                else:
+                    addr = ro_at + 2 * i + range_offsets[i] + 2 * (c - starts[i])
+                    g = struct.unpack(">H", data[addr: addr + 2])[0]
+                    if g:
+                        g = (g + deltas[i]) & 0xFFFF
+                if g:
+                    out[c] = g
+        return out
+
+    def _cmap12(self, off: int) -> dict[int, int]:
+        data = self.data
+        groups = struct.unpack(">I", data[off + 12: off + 16])[0]
+        out = {}
+        for i in range(groups):
+            start, end, glyph = struct.unpack(">III", data[off + 16 + 12 * i: off + 28 + 12 * i])
+            for c in range(start, end + 1):
+                out[c] = glyph + (c - start)
+        return out
+
+    def glyph(self, ch: str) -> tuple[int, float]:
+        """(gid, ширина в 1/1000 em) для символа; кэшируется."""
+        hit = self._widths.get(ch)
+        if hit is None:
+            gid = self.cmap.get(ord(ch), 0)
+            hmtx = self.tables["hmtx"][0] + 4 * min(gid, self.num_hmetrics - 1)
+            adv = struct.unpack(">H", self.data[hmtx: hmtx + 2])[0]
+            hit = self._widths[ch] = (gid, adv * 1000.0 / self.units_per_em)
+        return hit
+
+    def text_width(self, text: str, size: float) -> float:
+        return sum(self.glyph(ch)[1] for ch in text) * size / 1000.0
+
+
+@functools.lru_cache(maxsize=4)
+def _load_font(path: str) -> TrueTypeFont:
+    return TrueTypeFont(path)
+
+
+class StreamingTextPdf:
+    """
+    Текстовый PDF, который пишется на диск постранично: в памяти только текущая страница,
+    список id страниц и набор использованных глифов. Шрифт встраивается целиком (Type0/Identity-H).
+    """
+
+    PAGE_A4 = (595.28, 841.89)
+
+    def __init__(self, path: str, font: TrueTypeFont, font_size: float = 11.0,
+                 margin: float = 56.69, leading: float | None = None):
+        self.font = font
+        self.size = font_size
+        self.leading = leading or font_size * 1.3
+        self.page_w, self.page_h = self.PAGE_A4
+        self.margin = margin
+        self.max_width = self.page_w - 2 * margin
+        self.f = open(path, "wb")
+        self.f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.offsets: dict[int, int] = {}
+        # 1 Catalog, 2 Pages, 3 Type0, 4 CIDFont, 5 FontDescriptor, 6 FontFile2, 7 ToUnicode
+        self.next_id = 8
+        self.page_ids: list[int] = []
+        self.used: dict[int, str] = {}
+        self.missing_glyphs = 0
+        self._lines: list[str] = []
+        self._y = self.page_h - margin
+
+    # --- низкий уровень ---
+    def _write_obj(self, num: int, body: bytes):
+        self.offsets[num] = self.f.tell()
+        self.f.write(f"{num} 0 obj\n".encode() + body + b"\nendobj\n")
+
+    def _write_stream(self, num: int, payload: bytes, extra: str = "", compress: bool = True):
+        if compress:
+            payload = zlib.compress(payload)
+            extra += " /Filter /FlateDecode"
+        head = f"<< /Length {len(payload)}{extra} >>\nstream\n".encode()
+        self._write_obj(num, head + payload + b"\nendstream")
+
+    def _alloc(self) -> int:
+        self.next_id += 1
+        return self.next_id - 1
+
+    def _encode(self, text: str) -> str:
+        out = []
+        for ch in text:
+            gid, _w = self.font.glyph(ch)
+            if gid == 0:
+                self.missing_glyphs += 1
+            self.used.setdefault(gid, ch)
+            out.append(f"{gid:04X}")
+        return "".join(out)
+
+    # --- раскладка ---
+    def _wrap(self, para: str):
+        space = self.font.text_width(" ", self.size)
+        line, width = [], 0.0
+        for word in para.split():
+            w = self.font.text_width(word, self.size)
+            if w > self.max_width:
+                # слово шире строки — режем посимвольно
+                if line:
+                    yield " ".join(line)
+                    line, width = [], 0.0
+                chunk, cw = "", 0.0
+                for ch in word:
+                    chw = self.font.glyph(ch)[1] * self.size / 1000.0
+                    if chunk and cw + chw > self.max_width:
+                        yield chunk
+                        chunk, cw = "", 0.0
+                    chunk += ch
+                    cw += chw
+                line, width = [chunk], cw
+                continue
+            extra = w + (space if line else 0.0)
+            if line and width + extra > self.max_width:
+                yield " ".join(line)
+                line, width = [word], w
+            else:
+                line.append(word)
+                width += extra
+        if line:
+            yield " ".join(line)
+
+    def _emit_line(self, hex_text: str):
+        if self._y < self.margin:
+            self._flush_page()
+        self._lines.append(hex_text)
+        self._y -= self.leading
+
+    def add_paragraph(self, text: str):
+        for line in self._wrap(text):
+            self._emit_line(self._encode(line))
+        self._emit_line("")  # отступ между абзацами
+
+    def _flush_page(self):
+        top = self.page_h - self.margin - self.size
+        ops = [f"BT /F1 {self.size:g} Tf {self.leading:g} TL {self.margin:g} {top:g} Td"]
+        for hex_text in self._lines:
+            ops.append(f"<{hex_text}> Tj T*" if hex_text else "T*")
+        ops.append("ET")
+        content_id, page_id = self._alloc(), self._alloc()
+        self._write_stream(content_id, "\n".join(ops).encode("ascii"))
+        self._write_obj(page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {self.page_w:g} {self.page_h:g}] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>").encode())
+        self.page_ids.append(page_id)
+        self._lines = []
+        self._y = self.page_h - self.margin
+
+    # --- завершение ---
+    def close(self) -> int:
+        if self._lines or not self.page_ids:
+            self._flush_page()
+        font = self.font
+        name = font.name
+        self._write_obj(3, (f"<< /Type /Font /Subtype /Type0 /BaseFont /{name} /Encoding /Identity-H "
+                            f"/DescendantFonts [4 0 R] /ToUnicode 7 0 R >>").encode())
+        widths = " ".join(f"{gid} [{font.glyph(ch)[1]:.0f}]" for gid, ch in sorted(self.used.items()))
+        self._write_obj(4, (f"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{name} "
+                            f"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+                            f"/FontDescriptor 5 0 R /CIDToGIDMap /Identity /DW 1000 /W [{widths}] >>").encode())
+        bbox = " ".join(str(v) for v in font.bbox)
+        self._write_obj(5, (f"<< /Type /FontDescriptor /FontName /{name} /Flags 32 /FontBBox [{bbox}] "
+                            f"/ItalicAngle {font.italic_angle:g} /Ascent {font.ascent} /Descent {font.descent} "
+                            f"/CapHeight {font.cap_height} /StemV 80 /FontFile2 6 0 R >>").encode())
+        self._write_stream(6, font.data, extra=f" /Length1 {len(font.data)}")
+        self._write_stream(7, self._to_unicode_cmap())
+        kids = " ".join(f"{pid} 0 R" for pid in self.page_ids)
+        self._write_obj(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>".encode())
+        self._write_obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_at = self.f.tell()
+        total = self.next_id
+        self.f.write(f"xref\n0 {total}\n0000000000 65535 f \n".encode())
+        for num in range(1, total):
+            self.f.write(f"{self.offsets.get(num, 0):010d} 00000 n \n".encode())
+        self.f.write(f"trailer\n<< /Size {total} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode())
+        self.f.close()
+        return len(self.page_ids)
+
+    def _to_unicode_cmap(self) -> bytes:
+        lines = ["/CIDInit /ProcSet findresource begin", "12 dict begin", "begincmap",
+                 "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def",
+                 "/CMapName /Adobe-Identity-UCS def", "/CMapType 2 def",
+                 "1 begincodespacerange", "<0000> <FFFF>", "endcodespacerange"]
+        items = sorted(self.used.items())
+        for i in range(0, len(items), 100):
+            block = items[i:i + 100]
+            lines.append(f"{len(block)} beginbfchar")
+            for gid, ch in block:
+                utf16 = ch.encode("utf-16-be").hex().upper()
+                lines.append(f"<{gid:04X}> <{utf16}>")
+            lines.append("endbfchar")
+        lines += ["endcmap", "CMapName currentdict /CMap defineresource pop", "end", "end"]
+        return "\n".join(lines).encode("ascii")
+
+
+def _iter_epub_documents(epub_path: str):
+    """HTML-документы EPUB по порядку spine, по одному (без загрузки всей книги в память)."""
+    import zipfile
+    import posixpath
+    import urllib.parse
+    import xml.etree.ElementTree as ET
+
+    with zipfile.ZipFile(epub_path) as zf:
+        container = ET.fromstring(zf.read("META-INF/container.xml"))
+        rootfile = next(el for el in container.iter() if el.tag.endswith("rootfile")).get("full-path")
+        opf = ET.fromstring(zf.read(rootfile))
+        base = posixpath.dirname(rootfile)
+        manifest = {}
+        for el in opf.iter():
+            if el.tag.endswith("}item") or el.tag == "item":
+                manifest[el.get("id")] = (el.get("href"), el.get("media-type") or "")
+        spine = [el.get("idref") for el in opf.iter() if el.tag.endswith("itemref") or el.tag == "itemref"]
+        if not spine:
+            spine = [i for i, (_h, mt) in manifest.items() if "html" in mt]
+        names = set(zf.namelist())
+        for idref in spine:
+            href, media_type = manifest.get(idref, (None, ""))
+            if not href or "html" not in media_type:
+                continue
+            name = posixpath.normpath(posixpath.join(base, urllib.parse.unquote(href)))
+            if name in names:
+                yield zf.read(name)
+
+
+def _iter_epub_paragraphs(epub_path: str):
+    from bs4 import BeautifulSoup
+
+    for html in _iter_epub_documents(epub_path):
+        text = BeautifulSoup(html, 'html.parser').get_text(separator="\n")
+        for p in text.splitlines():
+            p = p.strip()
+            if p:
+                yield p
+
+
 def epub_to_plain_pdf(epub_path: str, pdf_path: str):
-    """Create a very simple text-only PDF from EPUB contents.
-    This is basic: formatting/images are not preserved.
+    """Create a simple text-only PDF from EPUB contents.
+    Paragraphs are streamed from the EPUB into a page-by-page PDF writer with an embedded
+    Unicode TTF; formatting/images are not preserved.
     """
-    from reportlab.pdfgen import canvas as _canvas
-    from reportlab.lib.pagesizes import A4
-    from reportlab.lib.units import mm
+    font_path = _find_pdf_font()
+    if not font_path:
+        raise RuntimeError("no TrueType font found for PDF (use --pdf-font)")
+    pdf = StreamingTextPdf(f"{pdf_path}.part", _load_font(font_path))
+    try:
+        for para in _iter_epub_paragraphs(epub_path):
+            pdf.add_paragraph(para)
+        pages = pdf.close()
+    except BaseException:
+        pdf.f.close()
+        raise
+    os.replace(f"{pdf_path}.part", pdf_path)
+    if pdf.missing_glyphs:
+        print(f"⚠️ {pdf.missing_glyphs} characters are missing in {os.path.basename(font_path)} (use --pdf-font)")
+    print(f"PDF saved to {pdf_path} ({pages} pages)")
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        book = epub.read_epub(epub_path)
 
-    # Collect plain text from HTML documents
-    paragraphs: list[str] = []
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            soup = BeautifulSoup(item.get_content(), 'html.parser')
-            text = soup.get_text(separator="\n")
-            # Normalize newlines
-            parts = [p.strip() for p in text.splitlines()]
-            paragraphs.extend([p for p in parts if p])
-
-    # Build PDF
-    page_w, page_h = A4
-    left = 20 * mm
-    right = 20 * mm
-    top = 20 * mm
-    bottom = 20 * mm
-    max_width = page_w - left - right
-
-    c = _canvas.Canvas(pdf_path, pagesize=A4)
-    text_obj = c.beginText(left, page_h - top)
-    # Use default font, wrap manually
-    from textwrap import wrap
-    # rough characters-per-line estimation
-    cpl = int(max_width / 6.0)  # ~6pt per char at default font
-
-    for para in paragraphs:
-        lines = wrap(para, cpl) or [""]
-        for line in lines:
-            text_obj.textLine(line)
-            if text_obj.getY() < bottom:
-                c.drawText(text_obj)
-                c.showPage()
-                text_obj = c.beginText(left, page_h - top)
-        # paragraph spacing
-        text_obj.textLine("")
-        if text_obj.getY() < bottom:
-            c.drawText(text_obj)
-            c.showPage()
-            text_obj = c.beginText(left, page_h - top)
+# =========================
+# Output format writers
+# =========================
+# resource type -> format -> {"convert": f(source, out_path), "suffix": ..., "version": ...}
+# Новые конвертеры подключаются через register_writer; невыбранные форматы не вызываются
+# (и не импортируют свои библиотеки).
+WRITERS: dict[str, dict[str, dict]] = {}
+# Формат, в котором ресурс скачивается (исходник для остальных)
+SOURCE_FORMATS = {"book": "epub", "comicbook": "cbr"}
+DEFAULT_FORMATS = {"book": ["epub", "fb2", "pdf"], "comicbook": ["cbr", "pdf"]}
+_FORMAT_TYPE_ALIASES = {"comic": "comicbook", "books": "book", "comics": "comicbook"}
+
+
+def register_writer(resource_type: str, fmt: str, suffix: str | None = None, version: int = 1):
+    """Регистрирует конвертер исходника ресурса в формат fmt (можно как декоратор)."""
+    def decorator(func):
+        WRITERS.setdefault(resource_type, {})[fmt] = {
+            "convert": func, "suffix": suffix if suffix is not None else f".{fmt}", "version": version,
+        }
+        return func
+    return decorator
+
+
+def selected_formats(resource_type: str) -> list[str]:
+    return (CONFIG["formats"] or {}).get(resource_type) or DEFAULT_FORMATS.get(resource_type, [])
+
+
+def parse_formats(specs: list[str]) -> dict[str, list[str]]:
+    """['book=epub,fb2 comic=cbz'] -> {'book': ['epub', 'fb2'], 'comicbook': ['cbz']}. ValueError при ошибке."""
+    out: dict[str, list[str]] = {}
+    for spec in specs:
+        for item in spec.replace(";", " ").split():
+            rtype, _, fmts = item.partition("=")
+            rtype = _FORMAT_TYPE_ALIASES.get(rtype.strip().lower(), rtype.strip().lower())
+            known = set(WRITERS.get(rtype, {})) | {SOURCE_FORMATS.get(rtype)}
+            if rtype not in SOURCE_FORMATS:
+                raise ValueError(f"unknown resource type '{rtype}' (use: {', '.join(SOURCE_FORMATS)})")
+            chosen = [f.strip().lower() for f in fmts.split(",") if f.strip()]
+            bad = [f for f in chosen if f not in known]
+            if bad or not chosen:
+                raise ValueError(f"unknown format(s) for {rtype}: {', '.join(bad) or '(none)'}; "
+                                 f"available: {', '.join(sorted(f for f in known if f))}")
+            out[rtype] = chosen
+    return out
 
-    c.drawText(text_obj)
-    c.save()
-    print(f"PDF saved to {pdf_path}")
+
+def write_formats(resource_type: str, uuid: str, source: str, base: str):
+    """
+    Строит выбранные форматы из скачанного исходника (base + suffix).
+    Исходник удаляется, если его собственный формат не выбран.
+    """
+    chosen = selected_formats(resource_type)
+    download_dir = os.path.dirname(source)
+    src_hash = None
+    for fmt in chosen:
+        writer = WRITERS.get(resource_type, {}).get(fmt)
+        if writer is None:
+            continue  # сам исходник
+        out = f"{base}{writer['suffix']}"
+        if src_hash is None:
+            src_hash = source_hash(download_dir, [source])
+        try:
+            if not blob_fetch(uuid, fmt, out):
+                with span(f"convert {fmt}", "convert", source=os.path.basename(source)):
+                    writer["convert"](source, out)
+                blob_put(uuid, fmt, out)
+            record_derivative(download_dir, fmt, out, [source], src_hash, _converter_id(resource_type, fmt))
+        except Exception as e:
+            print(f"WARNING: {fmt.upper()} conversion failed: {e}")
+    if SOURCE_FORMATS[resource_type] not in chosen and os.path.exists(source):
+        os.remove(source)
+
+
+def _extract_comic_pages(cbr_path: str, out_dir: str) -> int:
+    """Извлекает страницы комикса (.jpeg из корня архива, без preview/)."""
+    import zipfile
+    os.makedirs(out_dir, exist_ok=True)
+    count = 0
+    with zipfile.ZipFile(cbr_path) as zf:
+        for member in zf.namelist():
+            if member.endswith(".jpeg") and "/" not in member:
+                zf.extract(member, out_dir)
+                count += 1
+    return count
+
+
+def comic_to_pdf(cbr_path: str, pdf_path: str):
+    pages_dir = f"{pdf_path}.pages"
+    try:
+        _extract_comic_pages(cbr_path, pages_dir)
+        create_pdf_from_images(pages_dir, pdf_path)
+    finally:
+        shutil.rmtree(pages_dir, ignore_errors=True)
+
+
+def comic_to_cbz(cbr_path: str, cbz_path: str):
+    # архив Bookmate — уже zip, достаточно ссылки/копии под нужным расширением
+    _link_into(cbr_path, cbz_path)
+    print(f"CBZ saved to {cbz_path}")
+
+
+def comic_to_images(cbr_path: str, out_dir: str):
+    count = _extract_comic_pages(cbr_path, out_dir)
+    print(f"{count} pages extracted to {out_dir}")
+
+
+register_writer("book", "fb2", version=2)(epub_to_fb2)  # v2: XML-экранирование текста
+register_writer("book", "pdf")(epub_to_plain_pdf)
+register_writer("comicbook", "pdf")(comic_to_pdf)
+register_writer("comicbook", "cbz")(comic_to_cbz)
+register_writer("comicbook", "images", suffix="_pages")(comic_to_images)
+
+
+# =========================
+# Transcoding (listening-copy tier: --transcode opus:32k)
+# =========================
+# codec -> (энкодер ffmpeg, расширение, формат контейнера)
+TRANSCODE_CODECS = {
+    "opus": ("libopus", ".opus", "ogg"),
+    "aac": ("aac", ".m4a", "ipod"),
+}
+_DEFAULT_TRANSCODE_BITRATE = {"opus": "32k", "aac": "48k"}
+
+
+def parse_transcode(spec: str) -> tuple[str, str]:
+    """'opus', 'opus:24k', 'aac:48k' -> (codec, bitrate)."""
+    codec, _, bitrate = spec.strip().lower().partition(":")
+    if codec not in TRANSCODE_CODECS:
+        raise ValueError(f"unknown codec '{codec}' (choose from {', '.join(TRANSCODE_CODECS)})")
+    bitrate = bitrate or _DEFAULT_TRANSCODE_BITRATE[codec]
+    if not re.fullmatch(r"\d+k?", bitrate):
+        raise ValueError(f"bad bitrate '{bitrate}' (e.g. 32k)")
+    return codec, bitrate
+
+
+def _transcode_file(src: str, codec: str, bitrate: str) -> tuple[str, int, int]:
+    """Перекодирует один файл с сохранением тегов и глав; заменяет исходник. -> (новый путь, было, стало)."""
+    encoder, ext, fmt = TRANSCODE_CODECS[codec]
+    dst = os.path.splitext(src)[0] + ext
+    tmp = f"{dst}.part"
+    cmd = ['ffmpeg', '-y', '-v', 'error', '-i', src, '-map', '0:a',
+           '-map_metadata', '0', '-map_chapters', '0',
+           '-c:a', encoder, '-b:a', bitrate, '-threads', '1']
+    if fmt == "ipod":
+        cmd += ['-map', '0:v?', '-c:v', 'copy', '-disposition:v:0', 'attached_pic']  # обложка, если была
+    cmd += ['-f', fmt, tmp]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+    if result.returncode != 0:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "ffmpeg failed")
+    before = os.path.getsize(src)
+    os.replace(tmp, dst)
+    if dst != src:
+        os.remove(src)
+    return dst, before, os.path.getsize(dst)
+
+
+def transcode_audiobook(book_dir: str, files: list[str]):
+    """
+    Перекодирует главы (или склеенный файл) в CONFIG["transcode"]: по процессу ffmpeg на ядро
+    (CONFIG["transcode_jobs"], по умолчанию все). Экономия пишется в манифест и в итоговую сводку.
+    """
+    codec, bitrate = CONFIG["transcode"]
+    if not files:
+        return
+    workers = min(len(files), CONFIG["transcode_jobs"] or os.cpu_count() or 1)
+    print(f"[transcode] {len(files)} file(s) -> {codec} {bitrate} on {workers} core(s)...")
+    before = after = 0
+    done = {}
+    # ffmpeg — отдельные процессы; потоки пула только ждут их завершения
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode") as pool:
+        futures = {pool.submit(_transcode_file, f, codec, bitrate): f for f in files}
+        for fut, src in futures.items():
+            try:
+                dst, size_before, size_after = fut.result()
+            except Exception as e:
+                print(f"⚠️ Transcoding {os.path.basename(src)} failed, original kept: {e}")
+                continue
+            before += size_before
+            after += size_after
+            done[os.path.basename(src)] = os.path.basename(dst)
+    if not done:
+        return
+    # главы могли сменить расширение (.m4a -> .opus): переименовываем их и в манифесте,
+    # иначе verify/status/rebuild не найдут глав по записям tracks
+    tracks = read_manifest(book_dir).get("tracks") or {}
+    for old, new in done.items():
+        if old in tracks:
+            rec = tracks.pop(old)
+            rec["size"] = os.path.getsize(os.path.join(book_dir, new))
+            tracks[new] = rec
+    update_manifest(book_dir, tracks=tracks, transcoded={"codec": codec, "bitrate": bitrate, "files": done,
+                                          "bytes_before": before, "bytes_after": after})
+    saved = before - after
+    line = (f"{os.path.basename(os.path.normpath(book_dir))}: {before / 1048576:.1f} MB -> "
+            f"{after / 1048576:.1f} MB ({codec} {bitrate}, -{saved * 100 / max(before, 1):.0f}%)")
+    print(f"[transcode] {line}")
+    count_stat("transcode_saved_mb", round(saved / 1048576, 1))
+    add_summary_note(line)
+
+
+# =========================
+# Virtual merge (--merge-mode virtual)
+# =========================
+# Вместо склейки ffmpeg главы остаются на месте, а рядом пишется оглавление: M3U8 с
+# длительностями, CUE и ffmetadata (главы «виртуального» общего файла). Длительности берутся
+# из манифеста (mvhd, записанный при загрузке) — аудио не читается, книга «склеивается» мгновенно.
+CHAPTER_INDEX_VERSION = 1
+CHAPTER_INDEX_SUFFIXES = (".m3u8", ".cue", ".ffmetadata")
+
+
+def _chapter_durations(download_dir: str, chapters: list[str]) -> list[tuple[str, float, str]]:
+    """[(путь, сек, название главы)] по манифесту; нет записи — mvhd из заголовка файла."""
+    tracks = read_manifest(download_dir).get("tracks") or {}
+    out = []
+    for p in chapters:
+        rec = tracks.get(os.path.basename(p)) or {}
+        seconds = rec.get("measured") or rec.get("duration")
+        if not seconds:
+            try:
+                seconds = _mp4_duration(p)
+            except ValueError:
+                seconds = None
+        number = int(re.search(r"\d+", os.path.basename(p)).group())
+        out.append((p, float(seconds or 0.0), rec.get("title") or f"Глава {number}"))
+    return out
+
+
+def chapter_index_hash(download_dir: str, chapters: list[str]) -> str:
+    """Отпечаток оглавления: имена, размеры и длительности глав (без чтения аудио)."""
+    import hashlib
+    rows = [f"{os.path.basename(p)}:{os.path.getsize(p)}:{sec:.3f}:{title}"
+            for p, sec, title in _chapter_durations(download_dir, chapters)]
+    return hashlib.sha256("\n".join(rows).encode()).hexdigest()
+
+
+def _ffmeta_escape(value: str) -> str:
+    return re.sub(r"([=;#\\\n])", r"\\\1", str(value))
+
+
+def _cue_quote(value: str) -> str:
+    return '"' + str(value).replace('"', "'") + '"'
+
+
+def write_chapter_index(download_dir: str, base_path: str, metadata: dict | None = None) -> list[str]:
+    """
+    Пишет <base>.m3u8, <base>.cue и <base>.ffmetadata по главам Глава_XX.m4a.
+    Пути в M3U8/CUE — относительные, так что каталог можно переносить целиком.
+    """
+    chapters = _chapter_files(download_dir)
+    if not chapters:
+        return []
+    rows = _chapter_durations(download_dir, chapters)
+    metadata = metadata or {}
+    title = metadata.get("title") or os.path.basename(base_path)
+    artist = metadata.get("artist") or ""
+
+    m3u = ["#EXTM3U", f"#PLAYLIST:{title}"]
+    cue = [f"TITLE {_cue_quote(title)}"] + ([f"PERFORMER {_cue_quote(artist)}"] if artist else [])
+    ffm = [";FFMETADATA1"] + [f"{k}={_ffmeta_escape(v)}" for k, v in metadata.items()]
+    start = 0
+    for n, (p, seconds, chapter) in enumerate(rows, 1):
+        name = os.path.basename(p)
+        m3u += [f"#EXTINF:{seconds:.3f},{chapter}", name]
+        cue += [f"FILE {_cue_quote(name)} WAVE", f"  TRACK {n:02d} AUDIO",
+                f"    TITLE {_cue_quote(chapter)}", "    INDEX 01 00:00:00"]
+        end = start + round(seconds * 1000)
+        ffm += ["", "[CHAPTER]", "TIMEBASE=1/1000", f"START={start}", f"END={end}",
+                f"title={_ffmeta_escape(chapter)}"]
+        start = end
+
+    written = []
+    for suffix, lines in zip(CHAPTER_INDEX_SUFFIXES, (m3u, cue, ffm)):
+        out = base_path + suffix
+        with open(f"{out}.part", "w", encoding="utf-8", newline="\n") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{out}.part", out)
+        written.append(out)
+    print(f"[index] {os.path.basename(base_path)}: {len(rows)} chapter(s), "
+          f"{start / 3600000:.2f} h → {', '.join(os.path.basename(w) for w in written)}")
+    return written
+
+
+# =========================
+# Incremental rebuild of derived files
+# =========================
+# В манифесте ресурса: derived[fmt] = {file, sources, source_sha256, converter},
+# hashes[имя файла] = [size, mtime_ns, sha256] — кэш, чтобы не перечитывать неизменившиеся исходники.
+
+def _converter_id(resource_type: str, fmt: str) -> str:
+    return f"{fmt}@{WRITERS[resource_type][fmt]['version']}"
+
+
+def _audiobook_metadata(download_dir: str) -> dict:
+    """Теги аудиокниги из сохранённого info JSON (как для склейки)."""
+    from merge_audiobook import extract_metadata_from_json
+    from pathlib import Path
+    return extract_metadata_from_json(Path(download_dir)) or {"title": os.path.basename(os.path.normpath(download_dir))}
+
+
+def _merge_converter() -> str:
+    from merge_audiobook import MERGE_VERSION
+    return f"m4a@{MERGE_VERSION}"
+
+
+def _chapter_files(download_dir: str) -> list[str]:
+    names = [fn for fn in os.listdir(download_dir) if re.fullmatch(r"Глава_\d+\.(m4a|opus)", fn)]
+    names.sort(key=lambda fn: int(re.search(r"\d+", fn).group()))
+    return [os.path.join(download_dir, fn) for fn in names]
+
+
+def source_hash(download_dir: str, paths: list[str]) -> str:
+    """sha256 исходника (для нескольких файлов — sha256 от имён и их хэшей), с кэшем по size/mtime."""
+    hashes = read_manifest(download_dir).get("hashes") or {}
+    digests = []
+    for p in paths:
+        st = os.stat(p)
+        key = os.path.basename(p)
+        cached = hashes.get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            sha = cached[2]
+        else:
+            sha = _file_sha256(p)
+            update_manifest_section(download_dir, "hashes", key, [st.st_size, st.st_mtime_ns, sha])
+        digests.append((key, sha))
+    if len(digests) == 1:
+        return digests[0][1]
+    import hashlib
+    return hashlib.sha256("\n".join(f"{k}:{v}" for k, v in digests).encode()).hexdigest()
+
+
+def record_derivative(download_dir: str, fmt: str, out_path: str, sources: list[str],
+                      src_hash: str | None, converter: str):
+    update_manifest_section(download_dir, "derived", fmt, {
+        "file": os.path.basename(out_path),
+        "sources": [os.path.basename(p) for p in sources],
+        "source_sha256": src_hash,
+        "converter": converter,
+    })
+
+
+def _is_stale(download_dir: str, fmt: str, out: str, sources: list[str], src_hash: str,
+              converter: str, force: bool) -> bool:
+    if force or not os.path.exists(out):
+        return True
+    rec = (read_manifest(download_dir).get("derived") or {}).get(fmt)
+    if rec:
+        return rec.get("source_sha256") != src_hash or rec.get("converter") != converter
+    # Файл сделан до появления учёта: как make — свежий, если новее исходников
+    if os.path.getmtime(out) >= max(os.path.getmtime(p) for p in sources):
+        record_derivative(download_dir, fmt, out, sources, src_hash, converter)
+        return False
+    return True
+
+
+def _plan_rebuild(download_dir: str, force: bool, merge_audio: bool) -> list[dict]:
+    """Список недостающих/устаревших производных файлов одного каталога ресурса."""
+    tasks = []
+    name = os.path.basename(os.path.normpath(download_dir))
+    uid, rtype = _resource_id(download_dir)
+    files = os.listdir(download_dir)
+
+    if rtype in ("book", "serial"):
+        rtype = "book"
+    if rtype in SOURCE_FORMATS:
+        ext = f".{SOURCE_FORMATS[rtype]}"
+        sources = [fn for fn in files if fn.endswith(ext)]
+        if not sources:
+            return tasks
+        source = os.path.join(download_dir, sources[0])
+        base = source[: -len(ext)]
+        src_hash = source_hash(download_dir, [source])
+        for fmt in selected_formats(rtype):
+            writer = WRITERS.get(rtype, {}).get(fmt)
+            if not writer:
+                continue
+            out = base + writer["suffix"]
+            converter = _converter_id(rtype, fmt)
+            if _is_stale(download_dir, fmt, out, [source], src_hash, converter, force):
+                tasks.append({"dir": download_dir, "type": rtype, "fmt": fmt, "sources": [source],
+                              "out": out, "hash": src_hash, "converter": converter})
+    elif rtype == "audiobook":
+        chapters = _chapter_files(download_dir)
+        index = os.path.join(download_dir, f"{name}{CHAPTER_INDEX_SUFFIXES[0]}")
+        if chapters and ((merge_audio and CONFIG["merge_mode"] == "virtual") or os.path.exists(index)):
+            converter = f"index@{CHAPTER_INDEX_VERSION}"
+            src_hash = chapter_index_hash(download_dir, chapters)
+            if _is_stale(download_dir, "index", index, chapters, src_hash, converter, force):
+                tasks.append({"dir": download_dir, "type": rtype, "fmt": "index", "sources": chapters,
+                              "out": index, "hash": src_hash, "converter": converter})
+        out = os.path.join(download_dir, f"{name}.m4a")
+        # главы, перекодированные в Opus (--transcode opus), в M4A без перекодирования не склеить
+        chapters = [c for c in chapters if c.endswith(".m4a")]
+        if chapters and ((merge_audio and CONFIG["merge_mode"] == "physical") or os.path.exists(out)):
+            src_hash = source_hash(download_dir, chapters)
+            converter = _merge_converter()
+            if _is_stale(download_dir, "m4a", out, chapters, src_hash, converter, force):
+                tasks.append({"dir": download_dir, "type": rtype, "fmt": "m4a", "sources": chapters,
+                              "out": out, "hash": src_hash, "converter": converter})
+    return tasks
+
+
+def _run_rebuild_task(task: dict, config: dict) -> str | None:
+    """Выполняется в отдельном процессе; возвращает текст ошибки или None."""
+    CONFIG.update(config)
+    try:
+        if task["fmt"] == "index":
+            write_chapter_index(task["dir"], task["out"][: -len(CHAPTER_INDEX_SUFFIXES[0])],
+                                _audiobook_metadata(task["dir"]))
+        elif task["type"] == "audiobook":
+            from merge_audiobook import merge_audiobook_chapters as _merge, extract_metadata_from_json
+            from pathlib import Path
+            tmp = task["out"][:-4] + ".rebuild.m4a"
+            meta = extract_metadata_from_json(Path(task["dir"])) or {"title": os.path.basename(task["dir"])}
+            if not _merge(task["dir"], tmp, metadata=meta, cleanup_chapters=False):
+                return "merge failed"
+            os.replace(tmp, task["out"])
+        else:
+            WRITERS[task["type"]][task["fmt"]]["convert"](task["sources"][0], task["out"])
+        return None
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def _pool_workers(workers: int | None = None) -> int:
+    """Число процессов пула: по умолчанию — по ядрам; на Windows ProcessPoolExecutor не берёт больше 61."""
+    n = workers or os.cpu_count() or 1
+    return max(1, min(n, 61) if sys.platform == "win32" else n)
+
+
+def rebuild_library(root: str = "mybooks", force: bool = False, merge_audio: bool = False,
+                    workers: int | None = None) -> int:
+    """
+    Пересобирает недостающие и устаревшие производные файлы (FB2/PDF/CBZ/…, склейку глав)
+    по хэшу исходника и версии конвертера, параллельно по ядрам и без обращения к сети.
+    Возвращает число неудачных пересборок.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    tasks = []
+    for dirpath, dirnames, _filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]  # служебные (.leases)
+        if _resource_id(dirpath)[0]:
+            tasks.extend(_plan_rebuild(dirpath, force, merge_audio))
+    print(f"[rebuild] {len(tasks)} derivative(s) missing or stale")
+    if not tasks:
+        return 0
+
+    config = {k: CONFIG[k] for k in ("formats", "pdf_font")}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=_pool_workers(workers)) as pool:
+        futures = [(t, pool.submit(_run_rebuild_task, t, config)) for t in tasks]
+        for task, fut in futures:
+            error = fut.result()
+            if error:
+                failed += 1
+                print(f"❌ {task['out']}: {error}")
+                continue
+            record_derivative(task["dir"], task["fmt"], task["out"], task["sources"], task["hash"], task["converter"])
+            if task["fmt"] in WRITERS.get(task["type"], {}):
+                # новый файл — в хранилище под тем же ключом, что и при загрузке (write_formats)
+                blob_put(_resource_id(task["dir"])[0], task["fmt"], task["out"])
+            index_resource(task["dir"])
+            print(f"✅ {task['out']}")
+    print(f"[rebuild] done: {len(tasks) - failed} rebuilt, {failed} failed")
+    return failed
+
+
+# =========================
+# Library verification
+# =========================
+VERIFY_CACHE_NAME = ".verify_cache.json"
+# допустимое расхождение длительности трека с playlists.json
+VERIFY_DURATION_TOLERANCE = 2.0
+# типы ресурсов -> путь на books.yandex.ru (для списка перезагрузки в формате batch-файла)
+_SITE_PATHS = {"book": "books", "serial": "books", "audiobook": "audiobooks",
+               "comicbook": "comicbooks", "series": "series"}
+
+
+def _iter_mp4_boxes(f, start: int, end: int):
+    """Итерирует MP4-атомы в диапазоне [start, end): (type, offset, size, header_len)."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("truncated box header")
+        size = int.from_bytes(header[:4], "big")
+        btype = header[4:8].decode("latin-1")
+        hlen = 8
+        if size == 1:
+            size = int.from_bytes(f.read(8), "big")
+            hlen = 16
+        elif size == 0:
+            size = end - pos
+        if size < hlen or pos + size > end:
+            raise ValueError(f"box '{btype}' exceeds file bounds (truncated?)")
+        yield btype, pos, size, hlen
+        pos += size
+
+
+def _mp4_duration(path: str) -> float | None:
+    """Длительность M4A по mvhd (без ffprobe). ValueError, если контейнер повреждён."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        boxes = {b[0]: b for b in _iter_mp4_boxes(f, 0, file_size)}
+        if "moov" not in boxes or "mdat" not in boxes:
+            raise ValueError("missing moov/mdat")
+        _, moov_pos, moov_size, moov_hlen = boxes["moov"]
+        for btype, pos, size, hlen in _iter_mp4_boxes(f, moov_pos + moov_hlen, moov_pos + moov_size):
+            if btype != "mvhd":
+                continue
+            f.seek(pos + hlen)
+            body = f.read(min(size - hlen, 32))
+            if body[0] == 1:
+                timescale = int.from_bytes(body[20:24], "big")
+                duration = int.from_bytes(body[24:32], "big")
+            else:
+                timescale = int.from_bytes(body[12:16], "big")
+                duration = int.from_bytes(body[16:20], "big")
+            return duration / timescale if timescale else None
+    raise ValueError("missing mvhd")
+
+
+def _pdf_page_count(path: str) -> int:
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(b"%PDF") or b"%%EOF" not in data[-2048:]:
+        raise ValueError("not a complete PDF")
+    return len(re.findall(rb"/Type\s*/Page(?![a-z])", data))
+
+
+def _zip_check(path: str) -> list[str]:
+    import zipfile
+    with zipfile.ZipFile(path) as zf:
+        bad = zf.testzip()
+        if bad:
+            raise ValueError(f"CRC error in {bad}")
+        return zf.namelist()
+
+
+def _image_check(path: str):
+    try:
+        from PIL import Image as _Image
+    except ImportError:
+        with open(path, "rb") as f:
+            head = f.read(4)
+        if not (head.startswith(b"\xff\xd8") or head.startswith(b"\x89PNG")):
+            raise ValueError("unknown image format")
+        return
+    with _Image.open(path) as im:
+        im.verify()
+
+
+def _verify_resource_dir(download_dir: str, files: list[str]) -> list[str]:
+    """
+    Проверяет один каталог ресурса, возвращает список проблем (пустой — всё в порядке).
+    Выполняется в отдельном процессе.
+    """
+    problems = []
+    manifest = read_manifest(download_dir)
+    tracks = manifest.get("tracks") or {}
+    name = os.path.basename(os.path.normpath(download_dir))
+    comic_pages = None
+    chapters_total = 0.0
+    merged_duration = None
+    merged_opus = False
+
+    for fn in sorted(files):
+        fp = os.path.join(download_dir, fn)
+        ext = os.path.splitext(fn)[1].lower()
+        try:
+            if ext == ".epub":
+                names = _zip_check(fp)
+                if "META-INF/container.xml" not in names:
+                    raise ValueError("no META-INF/container.xml")
+            elif ext == ".cbr":
+                names = _zip_check(fp)
+                # create_pdf_from_images берёт только .jpeg из корня архива
+                comic_pages = len([n for n in names if n.endswith(".jpeg") and "/" not in n])
+            elif ext == ".m4a":
+                dur = _mp4_duration(fp) or 0.0
+                if fn.startswith("Глава_"):
+                    chapters_total += dur
+                    expected = (tracks.get(fn) or {}).get("duration")
+                    if expected and abs(dur - expected) > VERIFY_DURATION_TOLERANCE:
+                        raise ValueError(f"duration {dur:.1f}s, playlist says {expected:.1f}s")
+                else:
+                    merged_duration = dur
+            elif ext == ".opus":
+                # Ogg не разбираем — только сверяем наличие; склеенный .opus заменяет главы
+                if not fn.startswith("Глава_"):
+                    merged_opus = True
+            elif ext in (".jpeg", ".jpg", ".png") and fn.startswith(name):
+                _image_check(fp)
+            elif ext == ".fb2":
+                import xml.etree.ElementTree as ET
+                ET.parse(fp)
+        except Exception as e:
+            problems.append(f"{fn}: {e}")
+
+    pdf_path = os.path.join(download_dir, f"{name}.pdf")
+    if os.path.basename(pdf_path) in files:
+        try:
+            pages = _pdf_page_count(pdf_path)
+            if pages == 0:
+                raise ValueError("no pages")
+            if comic_pages and pages != comic_pages:
+                raise ValueError(f"{pages} pages, archive has {comic_pages} images")
+        except Exception as e:
+            problems.append(f"{name}.pdf: {e}")
+
+    expected_total = sum((t or {}).get("duration") or 0.0 for t in tracks.values())
+    if merged_duration is not None and expected_total and \
+            abs(merged_duration - expected_total) > VERIFY_DURATION_TOLERANCE * max(1, len(tracks)):
+        problems.append(f"{name}.m4a: duration {merged_duration:.0f}s, playlist total {expected_total:.0f}s")
+    if tracks and merged_duration is None and not merged_opus:
+        missing = [t for t in tracks if t not in files]
+        if missing:
+            problems.append(f"missing chapters: {', '.join(sorted(missing))}")
+    return problems
+
+
+def _resource_id(download_dir: str) -> tuple[str | None, str | None]:
+    """(uuid, type) ресурса: из манифеста, иначе из info-JSON."""
+    manifest = read_manifest(download_dir)
+    if manifest.get("uuid"):
+        return manifest["uuid"], manifest.get("type")
+    name = os.path.basename(os.path.normpath(download_dir))
+    try:
+        with open(os.path.join(download_dir, f"{name}.json"), encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    for rtype in ("audiobook", "comicbook", "series", "book"):
+        meta = info.get(rtype)
+        if isinstance(meta, dict) and meta.get("uuid"):
+            return meta["uuid"], rtype
+    return None, None
+
+
+def _dir_signature(download_dir: str, files: list[str]) -> list:
+    sig = []
+    names = sorted(files)
+    if os.path.exists(os.path.join(download_dir, MANIFEST_NAME)):
+        names.append(MANIFEST_NAME)  # ожидаемые длительности влияют на результат
+    for fn in names:
+        st = os.stat(os.path.join(download_dir, fn))
+        sig.append([fn, st.st_size, st.st_mtime_ns])
+    return sig
+
+
+def verify_library(root: str = "mybooks", out_path: str | None = "broken.txt", workers: int | None = None) -> int:
+    """
+    Проверяет все ресурсы в root параллельно по ядрам. Результат кэшируется по размеру и mtime
+    файлов, повторный запуск проверяет только изменившиеся каталоги.
+    Список битых ресурсов пишется в out_path в формате batch-файла. Возвращает число битых.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    cache_path = os.path.join(root, VERIFY_CACHE_NAME)
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    todo, results = {}, {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]  # служебные (.leases)
+        files = [fn for fn in filenames if not fn.startswith(".") and not fn.endswith(".part")]
+        if not files:
+            continue
+        sig = _dir_signature(dirpath, files)
+        cached = cache.get(dirpath)
+        if cached and cached.get("sig") == sig:
+            results[dirpath] = cached["problems"]
+        else:
+            todo[dirpath] = (files, sig)
+
+    print(f"[verify] {len(results) + len(todo)} resources, {len(todo)} changed since last run")
+    if todo:
+        with ProcessPoolExecutor(max_workers=_pool_workers(workers)) as pool:
+            futures = {d: pool.submit(_verify_resource_dir, d, files) for d, (files, _) in todo.items()}
+            for d, fut in futures.items():
+                try:
+                    results[d] = fut.result()
+                except Exception as e:
+                    results[d] = [f"verification crashed: {e}"]
+                cache[d] = {"sig": todo[d][1], "problems": results[d]}
+
+    cache = {d: v for d, v in cache.items() if d in results}
+    os.makedirs(root, exist_ok=True)
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False)
+
+    broken = {d: p for d, p in sorted(results.items()) if p}
+    lines = []
+    for d, problems in broken.items():
+        print(f"❌ {d}")
+        for p in problems:
+            print(f"   {p}")
+        uid, rtype = _resource_id(d)
+        lines.append(f"# {d}: {'; '.join(problems)}")
+        if uid and rtype in _SITE_PATHS:
+            lines.append(f"https://books.yandex.ru/{_SITE_PATHS[rtype]}/{uid}")
+    if out_path and lines:
+        with open(out_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"[verify] Broken resources written to {out_path} (use with -a; remove them from the archive first)")
+    print(f"[verify] OK: {len(results) - len(broken)}, broken: {len(broken)}")
+    return len(broken)
+
+
+# =========================
+# Library index (SQLite)
+# =========================
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    dir TEXT PRIMARY KEY,
+    uuid TEXT,
+    type TEXT,
+    title TEXT,
+    status TEXT,
+    size INTEGER,
+    formats TEXT,
+    missing TEXT,
+    mtime_ns INTEGER,
+    scanned_at REAL
+);
+CREATE INDEX IF NOT EXISTS resources_uuid ON resources(uuid);
+CREATE INDEX IF NOT EXISTS resources_status ON resources(status);
+"""
+_index_lock = threading.Lock()
+
+
+def _index_connect(db_path: str | None = None):
+    import sqlite3
+    db_path = db_path or CONFIG["index_db"]
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executescript(_INDEX_SCHEMA)
+    return conn
+
+
+def _describe_resource(download_dir: str) -> dict | None:
+    """Состояние каталога ресурса: статус, размер, форматы и недостающие производные."""
+    try:
+        entries = [e for e in os.scandir(download_dir) if e.is_file() and not e.name.startswith(".")]
+    except OSError:
+        return None
+    if not entries:
+        return None
+    name = os.path.basename(os.path.normpath(download_dir))
+    files = {e.name for e in entries}
+    uid, rtype = _resource_id(download_dir)
+    formats = sorted({os.path.splitext(fn)[1].lstrip(".").lower() for fn in files} - {"", "txt", "json", "part"})
+    has = lambda ext: f"{name}.{ext}" in files
+    missing, partial = [], any(fn.endswith(".part") for fn in files)
+
+    def missing_derivatives(resource_type):
+        for fmt in selected_formats(resource_type):
+            writer = WRITERS.get(resource_type, {}).get(fmt)
+            if writer and not os.path.exists(os.path.join(download_dir, name + writer["suffix"])):
+                missing.append(fmt)
+
+    if rtype == "book" or (rtype is None and has("epub")):
+        if "epub" in selected_formats("book") and not has("epub"):
+            partial = True
+        missing_derivatives("book")
+    elif rtype == "audiobook":
+        tracks = read_manifest(download_dir).get("tracks") or {}
+        merged = has("m4a") or has("opus")
+        absent = [t for t in tracks if t not in files]
+        if absent and not merged:  # оглавление (m3u8) без глав не заменяет склейку
+            partial = True
+            missing.append(f"chapters:{len(absent)}")
+        if not merged and not has("m3u8"):
+            missing.append("merged")
+    elif rtype == "comicbook":
+        if "cbr" in selected_formats("comicbook") and not has("cbr"):
+            partial = True
+        missing_derivatives("comicbook")
+    if rtype in ("book", "audiobook", "comicbook") and not (has("jpeg") or has("jpg")):
+        missing.append("cover")
+
+    if partial:
+        status = "partial"
+    elif uid and is_archived(uid):
+        status = "complete"
+    else:
+        status = "unarchived"
+    return {
+        "dir": download_dir, "uuid": uid, "type": rtype, "title": name, "status": status,
+        "size": sum(e.stat().st_size for e in entries), "formats": ",".join(formats),
+        "missing": ",".join(missing), "mtime_ns": os.stat(download_dir).st_mtime_ns,
+    }
+
+
+def _index_store(conn, row: dict):
+    conn.execute(
+        "INSERT OR REPLACE INTO resources (dir, uuid, type, title, status, size, formats, missing, mtime_ns, scanned_at) "
+        "VALUES (:dir, :uuid, :type, :title, :status, :size, :formats, :missing, :mtime_ns, :scanned_at)",
+        dict(row, scanned_at=time.time()),
+    )
+
+
+def index_resource(download_dir: str):
+    """Обновляет одну запись индекса (вызывается загрузчиком по завершении ресурса)."""
+    if not CONFIG["index_db"] or not download_dir:
+        return
+    try:
+        row = _describe_resource(download_dir)
+        with _index_lock:
+            conn = _index_connect()
+            with conn:
+                if row:
+                    _index_store(conn, row)
+                else:
+                    conn.execute("DELETE FROM resources WHERE dir = ?", (download_dir,))
+            conn.close()
+    except Exception as e:
+        print(f"⚠️ Library index update failed: {e}")
+
+
+def unindex_resource(download_dir: str):
+    """Удаляет из индекса каталог и всё, что под ним (локальные файлы опубликованы и удалены)."""
+    if not CONFIG["index_db"] or not download_dir:
+        return
+    prefix = os.path.join(download_dir, "")
+    try:
+        with _index_lock:
+            conn = _index_connect()
+            with conn:
+                conn.execute("DELETE FROM resources WHERE dir = ? OR substr(dir, 1, ?) = ?",
+                             (download_dir, len(prefix), prefix))
+            conn.close()
+    except Exception as e:
+        print(f"⚠️ Library index update failed: {e}")
+
+
+def scan_library(root: str = "mybooks", full: bool = False) -> tuple[int, int]:
+    """
+    Инкрементальный скан: перечитываются только каталоги, чей mtime изменился.
+    Возвращает (всего ресурсов, пересканировано).
+    """
+    conn = _index_connect()
+    known = {d: m for d, m in conn.execute("SELECT dir, mtime_ns FROM resources")}
+    seen, rescanned = set(), 0
+    with conn:
+        for dirpath, dirnames, _filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+            if not full and known.get(dirpath) == mtime:
+                seen.add(dirpath)
+                continue
+            row = _describe_resource(dirpath)
+            if row:
+                _index_store(conn, row)
+                seen.add(dirpath)
+                rescanned += 1
+        gone = [d for d in known if d not in seen]
+        conn.executemany("DELETE FROM resources WHERE dir = ?", [(d,) for d in gone])
+    conn.close()
+    return len(seen), rescanned
+
+
+def library_status(query: str | None = None):
+    """
+    Печатает сводку индекса. query: статус (complete/partial/unarchived), тип ресурса,
+    'missing' или 'missing:<fb2|pdf|merged|cover>', либо подстрока названия.
+    """
+    conn = _index_connect()
+    sql, params = "SELECT dir, uuid, type, status, size, formats, missing FROM resources", []
+    if query in ("complete", "partial", "unarchived"):
+        sql += " WHERE status = ?"
+        params = [query]
+    elif query in _SITE_PATHS:
+        sql += " WHERE type = ?"
+        params = [query]
+    elif query == "missing":
+        sql += " WHERE missing != ''"
+    elif query and query.startswith("missing:"):
+        sql += " WHERE ',' || missing || ',' LIKE ?"
+        params = [f"%,{query.split(':', 1)[1]}%"]
+    elif query:
+        sql += " WHERE title LIKE ?"
+        params = [f"%{query}%"]
+    rows = conn.execute(sql + " ORDER BY dir", params).fetchall()
+
+    totals = conn.execute("SELECT type, status, COUNT(*), SUM(size) FROM resources GROUP BY type, status").fetchall()
+    conn.close()
+    print("Library:")
+    for rtype, status, count, size in totals:
+        print(f"  {rtype or '?':10} {status:11} {count:6}  {(size or 0) / 1073741824:8.2f} GB")
+    if query:
+        for d, uid, rtype, status, size, formats, missing in rows:
+            extra = f"  missing: {missing}" if missing else ""
+            print(f"{status:11} {rtype or '?':10} {(size or 0) / 1048576:9.1f} MB  [{formats}]  {d}{extra}")
+        print(f"{len(rows)} matching resources")
+
+
+# =========================
+# Batch scheduling
+# =========================
+SCHEDULE_POLICIES = ("fifo", "longest", "shortest", "fair")
+
+# Грубые оценки объёма, если API не сообщает ни размер, ни длительность
+SCHED_THROUGHPUT_FILE = "mybooks/.throughput.json"  # замеренная скорость одного потока прошлого пакета
+
+_DEFAULT_EST_BYTES = {
+    "book": 2 * 1024 * 1024,
+    "serial": 5 * 1024 * 1024,
+    "comicbook": 60 * 1024 * 1024,
+    "audiobook": 100 * 1024 * 1024,
+    "series": 200 * 1024 * 1024,
+}
+
+
+def _variant_size(variant) -> int | None:
+    """Размер варианта трека из playlists.json (если API его отдаёт)."""
+    if not isinstance(variant, dict):
+        return None
+    for key in ("size", "bytes", "content_length"):
+        try:
+            val = int(variant.get(key) or 0)
+        except (TypeError, ValueError):
+            continue
+        if val > 0:
+            return val
+    return None
+
+
+def _playlist_size_bytes(playlist: dict, pref: str = 'max') -> int | None:
+    """Сумма размеров предпочитаемого варианта по всем трекам; None, если размеров нет."""
+    total = 0
+    for track in playlist.get('tracks', []) or []:
+        off = track.get('offline') or {}
+        keys = sorted(k for k, v in off.items() if isinstance(v, dict) and v.get('url'))
+        if not keys:
+            continue
+        size = _variant_size(off[keys[0] if pref == 'max' else keys[-1]])
+        if size is None:
+            return None
+        total += size
+    return total or None
+
+
+async def _plan_fetch(url: str):
+    """Одна попытка получить JSON для планирования; ошибки не фатальны."""
+    try:
+        return (await send_request(url, max_retries=1)).json()
+    except GracefulExit:
+        raise
+    except Exception:
+        return None
+
+
+async def _estimate_jobs(jobs: list[dict], quality: str = 'max', concurrency: int = 8):
+    """
+    Заполняет est_bytes/duration у заданий пакета по info (duration) и playlists.json (размеры).
+    Полученный JSON кладётся в кэш, чтобы загрузка не запрашивала его повторно.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    kbps = CONFIG["sched_audio_kbps"]
+
+    async def one(job):
+        rtype = job['rtype']
+        async with sem:
+            info_url = URLS[rtype]['infoUrl'].format(uuid=job['uid'])
+            info = await _plan_fetch(info_url)
+            if info:
+                _cache_json(info_url, info)
+                meta = info.get(rtype) or {}
+                try:
+                    job['duration'] = float(meta.get('duration') or 0) or None
+                except (TypeError, ValueError):
+                    job['duration'] = None
+            if rtype != 'audiobook':
+                return
+            content_url = URLS[rtype]['contentUrl'].format(uuid=job['uid'])
+            playlist = await _plan_fetch(content_url)
+            size = None
+            if playlist:
+                _cache_json(content_url, playlist)
+                size = _playlist_size_bytes(playlist, quality)
+            if size:
+                job['est_bytes'] = float(size)
+            elif job['duration']:
+                job['est_bytes'] = job['duration'] * kbps * 1000 / 8
+            if CONFIG["audio_budget_mb"]:
+                job['est_bytes'] = min(job['est_bytes'], CONFIG["audio_budget_mb"] * 1048576.0)
+
+    await asyncio.gather(*(one(j) for j in jobs))
+
+
+def _order_jobs(jobs: list[dict], policy: str) -> list[dict]:
+    """Порядок выдачи заданий воркерам согласно политике."""
+    if policy == "longest":
+        # LPT: длинные задания первыми — минимизирует общее время при нескольких воркерах
+        return sorted(jobs, key=lambda j: -j['est_bytes'])
+    if policy == "shortest":
+        return sorted(jobs, key=lambda j: j['est_bytes'])
+    if policy == "fair":
+        # round-robin по типам ресурсов, внутри типа — порядок файла
+        queues: dict[str, list[dict]] = {}
+        for j in jobs:
+            queues.setdefault(j['rtype'], []).append(j)
+        ordered = []
+        while any(queues.values()):
+            for q in queues.values():
+                if q:
+                    ordered.append(q.pop(0))
+        return ordered
+    return list(jobs)
+
+
+def _sched_throughput(workers: int) -> tuple[float, str]:
+    """
+    Скорость одного потока (байт/с) для прогноза и её источник: замер прошлого пакета
+    (SCHED_THROUGHPUT_FILE), иначе CONFIG["sched_est_bps"]; не выше доли лимита --limit-rate на поток.
+    """
+    bps, source = CONFIG["sched_est_bps"], "assumed"
+    try:
+        with open(SCHED_THROUGHPUT_FILE, encoding='utf-8') as f:
+            measured = float(json.load(f).get("per_stream_bps") or 0)
+        if measured > 0:
+            bps, source = measured, "measured last run"
+    except (OSError, ValueError, AttributeError):
+        pass
+    limit = BANDWIDTH.current_rate()
+    if limit > 0 and limit / workers < bps:
+        bps, source = limit / workers, "rate limit"
+    return max(1.0, bps), source
+
+
+def _save_sched_throughput(per_stream_bps: float):
+    try:
+        os.makedirs(os.path.dirname(SCHED_THROUGHPUT_FILE), exist_ok=True)
+        with open(f"{SCHED_THROUGHPUT_FILE}.part", 'w', encoding='utf-8') as f:
+            json.dump({"per_stream_bps": round(per_stream_bps), "at": time.time()}, f)
+        os.replace(f"{SCHED_THROUGHPUT_FILE}.part", SCHED_THROUGHPUT_FILE)
+    except OSError:
+        pass
+
+
+def _predict_makespan(durations: list[float], workers: int) -> float:
+    """Прогноз общего времени: жадная раздача заданий в порядке очереди свободным воркерам."""
+    import heapq
+    slots = [0.0] * max(1, workers)
+    for d in durations:
+        t = heapq.heappop(slots)
+        heapq.heappush(slots, t + d)
+    return max(slots)
+
+
+# =========================
+# Run summary
+# =========================
+_run_stats: dict[str, float] = {}
+_run_stats_lock = threading.Lock()
+
+# Подписи счётчиков итоговой сводки (в порядке вывода)
+SUMMARY_LABELS = {
+    "ok": "downloaded",
+    "recovered": "recovered on deferred retry",
+    "failed": "failed",
+    "claimed": "claimed by other hosts",
+    "transcode_saved_mb": "saved by transcoding, MB",
+    "stalls": "stalled streams restarted",
+    "resumed": "downloads resumed",
+    "hedges": "metadata requests hedged",
+    "hedge_wins": "won by the hedge",
+    "relinked": "playlists re-fetched after link expiry",
+    "published_mb": "published to sink, MB",
+}
+_run_notes: list[str] = []  # построчные детали сводки (например, экономия по каждой книге)
+
+
+def count_stat(key: str, n: float = 1):
+    """Увеличивает счётчик итоговой сводки запуска (потокобезопасно)."""
+    with _run_stats_lock:
+        _run_stats[key] = _run_stats.get(key, 0) + n
+
+
+def add_summary_note(line: str):
+    with _run_stats_lock:
+        _run_notes.append(line)
+
+
+def print_run_summary():
+    items = [(label, _run_stats[key]) for key, label in SUMMARY_LABELS.items() if _run_stats.get(key)]
+    if items:
+        print("Summary: " + ", ".join(f"{label}: {value:g}" for label, value in items))
+    for line in _run_notes:
+        print(f"  {line}")
+
+
+def _is_permanent_failure(exc: BaseException) -> bool:
+    """Ошибки, которые повтор не исправит (несуществующий/удалённый ID)."""
+    status = getattr(exc, "status", None)
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response is not None:
+        status = exc.response.status_code
+    return status in (400, 404, 410)
+
+
+def _run_batch_job(job: dict, merge_audio: bool, quality: str, cleanup_chapters: bool):
+    """Одно задание пакета; ошибка ресурса записывается в job['error'] и не прерывает пакет."""
+    uid = job['uid']
+    if CONFIG["leases"]:
+        # другой хост мог уже скачать ресурс или взять его в работу
+        if is_archived(uid):
+            print(f"[archive] Skipping already downloaded: {uid}")
+            job['skipped'], job['error'] = "archived", None
+            return
+        if not acquire_lease(uid):
+            print(f"[lease] Skipping {uid}: claimed by {lease_owner(uid)}")
+            job['skipped'], job['error'] = "claimed", None
+            count_stat("claimed")
+            return
+    try:
+        _download_batch_job(job, merge_audio, quality, cleanup_chapters)
+        job['error'] = None
+    except GracefulExit:
+        raise
+    except Exception as e:
+        job['error'] = f"{type(e).__name__}: {e}"
+        job['permanent'] = _is_permanent_failure(e)
+        print(f"❌ {job['rtype']} {job['uid']} failed: {job['error']}")
+    finally:
+        if CONFIG["leases"]:
+            release_lease(uid)
+
+
+def _download_batch_job(job: dict, merge_audio: bool, quality: str, cleanup_chapters: bool):
+    _job_ctx.bytes = 0
+    t0 = time.monotonic()
+    rtype, uid = job['rtype'], job['uid']
+    if rtype == "audiobook":
+        print(f"--> Audiobook {uid}: quality={quality}, merge_chapters={merge_audio}")
+        download_audiobook(uid,
+                           max_bitrate=(quality == 'max'),
+                           merge_chapters=merge_audio,
+                           cleanup_chapters=cleanup_chapters)
+    elif rtype == "book":
+        print(f"--> Book {uid}: downloading {' + '.join(f.upper() for f in selected_formats('book'))}")
+        download_book(uid)
+    else:
+        print(f"--> {rtype.capitalize()} {uid}")
+        FUNCTION_MAP[rtype](uid)
+    job['actual'] = time.monotonic() - t0
+    job['bytes'] = _job_ctx.bytes
+    print(f"[sched] done {rtype} {uid}: predicted {job['predicted']:.0f}s, "
+          f"actual {job['actual']:.0f}s ({job['bytes'] / 1048576:.1f} MB)")
 
 
 def process_batch_file(batch_path: str, merge_audio_default: bool = False, quality_default: str = 'max', cleanup_chapters_default: bool = True):
@@ -1037,20 +4179,33 @@ def process_batch_file(batch_path: str, merge_audio_default: bool = False, quali
     Process URLs from a text file (yt-dlp style). For each URL:
     - If it's an audiobook => download with defaults: merge=merge_audio_default, quality=quality_default
     - If it's a book => download EPUB and additionally produce FB2 and a plain-text PDF
+    - Bare IDs are resolved to their type first (parallel probe, cached in TYPE_CACHE_FILE)
     - Duplicate URLs/IDs are handled by archive.txt automatically
+    Order and parallelism are controlled by CONFIG["schedule"] and CONFIG["jobs"].
     """
     if not os.path.exists(batch_path):
         print(f"ERROR: Batch file not found: {batch_path}")
-        sys.exit(1)
+        return EXIT_FAILED
 
     print(f"Reading URLs from: {batch_path}")
     with open(batch_path, "r", encoding="utf-8") as f:
-        lines = [ln.strip() for ln in f if ln.strip()]
+        lines = [ln.strip() for ln in f if ln.strip() and not ln.lstrip().startswith(("#", ";"))]
+
+    # голые UUID (без URL) — тип определяется одним параллельным опросом на весь файл
+    bare = resolve_uuid_types([ln for ln in lines if _BARE_ID_RE.match(ln) and not is_archived(ln)])
 
     seen: set[str] = set()
-    processed = 0
+    jobs: list[dict] = []
+    unresolved: list[dict] = []  # тип не определили из-за сбоев сети — это ошибка, а не «неизвестный URL»
     for ln in lines:
         uid, rtype = extract_id_and_type_from_url(ln)
+        if bare.get(ln) == TYPE_UNRESOLVED:
+            print(f"❌ {ln}: type probe failed (network errors), will be listed in failures")
+            unresolved.append({"rtype": "unknown", "uid": ln, "line": ln,
+                               "error": "type probe failed (network errors or 5xx)"})
+            continue
+        if bare.get(ln):
+            uid, rtype = ln, bare[ln]
         if not uid or not rtype:
             print(f"[skip] Unrecognized URL: {ln}")
             continue
@@ -1059,19 +4214,100 @@ def process_batch_file(batch_path: str, merge_audio_default: bool = False, quali
             print(f"[skip] duplicate in batch: {ln}")
             continue
         seen.add(key)
-
-        if rtype == "audiobook":
-            print(f"--> Audiobook {uid}: quality={quality_default}, merge_chapters={merge_audio_default}")
-            download_audiobook(uid,
-                               max_bitrate=(quality_default == 'max'),
-                               merge_chapters=merge_audio_default,
-                               cleanup_chapters=cleanup_chapters_default)
-        elif rtype == "book":
-            print(f"--> Book {uid}: downloading EPUB + FB2 + PDF")
-            download_book(uid)
-
-        processed += 1
-    print(f"Batch done. Processed entries: {processed}")
+        if is_archived(uid):
+            print(f"[archive] Skipping already downloaded: {uid}")
+            continue
+        jobs.append({
+            "index": len(jobs), "rtype": rtype, "uid": uid, "line": ln,
+            "est_bytes": float(_DEFAULT_EST_BYTES.get(rtype, _DEFAULT_EST_BYTES["book"])),
+            "duration": None, "predicted": 0.0, "actual": None, "bytes": 0,
+            "error": None, "permanent": False, "skipped": None,
+        })
+
+    policy = CONFIG["schedule"]
+    workers = max(1, int(CONFIG["jobs"]))
+    if policy != "fifo" and jobs:
+        print(f"[sched] Estimating {len(jobs)} entries for '{policy}' scheduling...")
+        run_async_safely(_estimate_jobs(jobs, quality_default))
+    jobs = _order_jobs(jobs, policy)
+
+    est_bps, est_source = _sched_throughput(workers)
+    for j in jobs:
+        j['predicted'] = j['est_bytes'] / est_bps
+    predicted_total = _predict_makespan([j['predicted'] for j in jobs], workers)
+    print(f"[sched] policy={policy}, workers={workers}, entries={len(jobs)}, "
+          f"predicted completion ~{predicted_total:.0f}s (rough: {est_bps / 1048576:.2f} MB/s per stream, {est_source})")
+
+    t0 = time.monotonic()
+    args = (merge_audio_default, quality_default, cleanup_chapters_default)
+    _run_jobs(jobs, workers, args)
+
+    # Отложенные повторы: упавшие ресурсы — в конец пакета, с паузой и более длинным бэкоффом
+    for round_no in range(1, CONFIG["deferred_retries"] + 1):
+        retry = [j for j in jobs if j['error'] and not j['permanent']]
+        if not retry:
+            break
+        print(f"[retry] Deferred retry {round_no}/{CONFIG['deferred_retries']}: {len(retry)} resource(s) "
+              f"in {CONFIG['deferred_delay']:.0f}s...")
+        try:
+            time.sleep(CONFIG["deferred_delay"])
+        except KeyboardInterrupt:
+            raise GracefulExit(130)
+        saved = {k: CONFIG[k] for k in ("backoff_initial", "backoff_cap")}
+        factor = CONFIG["deferred_backoff_factor"]
+        CONFIG["backoff_initial"] *= factor
+        CONFIG["backoff_cap"] *= factor
+        try:
+            _run_jobs(retry, workers, args)
+        finally:
+            CONFIG.update(saved)
+        for j in retry:
+            if not j['error']:
+                count_stat("recovered")
+    elapsed = time.monotonic() - t0
+
+    failed = [j for j in jobs if j['error']] + unresolved
+    count_stat("ok", sum(1 for j in jobs if not j['error'] and not j['skipped']))
+    count_stat("failed", len(failed))
+    failures_file = CONFIG["failures_file"]
+    if failed and failures_file:
+        with open(failures_file, 'w', encoding='utf-8') as f:
+            for j in failed:
+                f.write(f"# {j['rtype']} {j['uid']}: {j['error']}\n{j['line']}\n")
+        print(f"[retry] {len(failed)} failed resource(s) written to {failures_file} (re-run with -a {failures_file})")
+
+    done = [j for j in jobs if j['actual'] is not None and not j['error']]
+    total_bytes = sum(j['bytes'] for j in done)
+    busy = sum(j['actual'] for j in done)
+    print(f"[sched] predicted completion {predicted_total:.0f}s, actual {elapsed:.0f}s")
+    if busy > 0 and total_bytes:
+        print(f"[sched] observed per-stream throughput {total_bytes / busy / 1048576:.2f} MB/s "
+              f"(estimate was {est_bps / 1048576:.2f} MB/s)")
+        _save_sched_throughput(total_bytes / busy)  # прогноз следующего пакета — по этому замеру
+    print(f"Batch done. Processed entries: {len(done)}")
+    print_run_summary()
+    if not failed:
+        return EXIT_OK
+    return EXIT_PARTIAL if len(failed) < len(jobs) + len(unresolved) else EXIT_FAILED
+
+
+def _run_jobs(jobs: list[dict], workers: int, args: tuple):
+    if workers == 1:
+        for j in jobs:
+            _run_batch_job(j, *args)
+        return
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+    try:
+        futures = [pool.submit(_run_batch_job, j, *args) for j in jobs]
+        for fut in futures:
+            fut.result()
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise GracefulExit(130)
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown(wait=True)
 
 
 async def _print_error_body(resp, limit: int = 4000) -> None:
@@ -1090,15 +4326,67 @@ async def _print_error_body(resp, limit: int = 4000) -> None:
         pass
 
 
+# =========================
+# Startup import budget
+# =========================
+# Библиотеки, которые не должны загружаться при импорте модуля и на пути аудиокниги.
+# zipfile не проверяем: его подтягивает stdlib (importlib.resources) через httpx/certifi.
+CONVERSION_MODULES = ("ebooklib", "bs4", "lxml", "reportlab", "PIL")
+IMPORT_BUDGET_MS = 300.0
+
+_IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import RUBookmatedownloader as m
+import merge_audiobook
+elapsed = (time.perf_counter() - t0) * 1000
+# всё, что download_audiobook делает без сети: выбор вариантов, манифест, индекс
+m.CONFIG["index_db"] = None
+m._playlist_variants_order({"tracks": []}, pref="max")
+m._track_duration({"duration": 1})
+print(json.dumps({"ms": elapsed, "loaded": [n for n in m.CONVERSION_MODULES if n in sys.modules]}))
+"""
+
+
+def check_startup_imports(budget_ms: float | None = None) -> bool:
+    """
+    Запускает чистый интерпретатор, меряет время импорта и проверяет, что путь аудиокниги
+    не загружает библиотеки конвертации. Возвращает True, если всё в бюджете.
+    Бюджет можно переопределить переменной BOOKMATE_IMPORT_BUDGET_MS (например, для CI).
+    """
+    if budget_ms is None:
+        budget_ms = float(os.environ.get("BOOKMATE_IMPORT_BUDGET_MS") or IMPORT_BUDGET_MS)
+    if getattr(sys, "frozen", False):
+        print("importcheck is only available when running from source")
+        return True
+    here = os.path.dirname(os.path.abspath(__file__))
+    res = subprocess.run([sys.executable, "-c", _IMPORT_PROBE], cwd=here,
+                         capture_output=True, text=True)
+    if res.returncode != 0:
+        print(res.stderr)
+        return False
+    data = json.loads(res.stdout.strip().splitlines()[-1])
+    ok = data["ms"] <= budget_ms and not data["loaded"]
+    print(f"Import time: {data['ms']:.0f} ms (budget {budget_ms:.0f} ms)")
+    if data["loaded"]:
+        print(f"❌ Audiobook path loaded conversion libraries: {', '.join(data['loaded'])}")
+    elif data["ms"] > budget_ms:
+        print("❌ Import time is over budget")
+    else:
+        print("✅ Startup imports are within budget")
+    return ok
+
+
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("-a", "--batch-file", type=str, default=None,
                            help="Read URLs from a text file (yt-dlp style). Each line is a URL from books.yandex.ru.")
     # Single-run positional: could be a resource command ('book', 'audiobook', etc.), 'auth', a UUID, or a URL
     argparser.add_argument("target", nargs="?",
-                           help="Resource type ('book', 'audiobook', 'comicbook', 'serial', 'series'), 'auth', a resource UUID, or a full URL.")
+                           help="Resource type ('book', 'audiobook', 'comicbook', 'serial', 'series'), 'auth', 'verify', 'rebuild', 'index', 'status', 'importcheck', a resource UUID, or a full URL.")
     argparser.add_argument("uuid", nargs="?",
-                           help="Resource UUID (when target is a resource type). Ignored if target is a URL or 'auth'.")
+                           help="Resource UUID (when target is a resource type); library root for 'verify'/'rebuild' (default mybooks); "
+                                "query for 'status' (complete, partial, a type, missing, missing:fb2, or part of a title). Ignored if target is a URL or 'auth'.")
 
     # Оставляем ровно два режима CLI: max и min.
     # Порядок вариантов внутри берём из playlists.json:
@@ -1113,22 +4401,102 @@ def main():
     argparser.add_argument("--backoff-initial", type=float, default=None, help="Initial backoff seconds (default 5)")
     argparser.add_argument("--timeout-base-req", type=float, default=None, help="Base timeout for metadata requests (default 10)")
     argparser.add_argument("--timeout-base-dl", type=float, default=None, help="Base timeout for file downloads (default 15)")
+    argparser.add_argument("--max-mb-per-book", type=float, default=None, metavar="MB",
+                           help="Audiobooks: best quality that fits MB per book (variant sizes from playlists.json or HEAD, cached in the manifest)")
+    argparser.add_argument("--max-kbps", type=float, default=None, metavar="KBPS",
+                           help="Audiobooks: never pick a track variant above this bitrate")
+    argparser.add_argument("--transcode", type=str, default=None, metavar="CODEC[:BITRATE]",
+                           help="Audiobooks: re-encode chapters (or the merged file) after download, e.g. opus:32k or aac:48k")
+    argparser.add_argument("--transcode-jobs", type=int, default=None, metavar="N",
+                           help="How many ffmpeg encoders to run in parallel for --transcode (default: all cores)")
+    argparser.add_argument("--stall-speed", type=str, default=None, metavar="RATE",
+                           help="Abort and resume a stream slower than RATE over --stall-window, e.g. 16K (default 16K, 0 = off)")
+    argparser.add_argument("--stall-window", type=float, default=None, metavar="SEC",
+                           help="Window for --stall-speed in seconds of network wait (default 30)")
+    argparser.add_argument("--ttfb", type=float, default=None, metavar="SEC",
+                           help="Time-to-first-byte budget per download attempt (default 30, 0 = off)")
+    argparser.add_argument("--sink", type=str, default=None, metavar="DEST",
+                           help="Publish each finished resource to DEST: a directory or s3://bucket/prefix (S3-compatible, SigV4 "
+                                "with AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY); mybooks/ then only stages files")
+    argparser.add_argument("--pack", choices=("tar", "zip"), default=None,
+                           help="Publish each resource as one streamed archive (to --sink, or next to it in mybooks/)")
+    argparser.add_argument("--keep-local", action="store_true",
+                           help="Keep the local copy in mybooks/ after publishing to --sink/--pack")
+    argparser.add_argument("--s3-endpoint", type=str, default=None, metavar="URL",
+                           help="S3-compatible endpoint, e.g. http://127.0.0.1:9000 for MinIO (default AWS_ENDPOINT_URL or AWS)")
+    argparser.add_argument("--s3-region", type=str, default=None,
+                           help="Region for SigV4 signing (default AWS_REGION or us-east-1)")
+    argparser.add_argument("--s3-part-mb", type=int, default=None, metavar="MB",
+                           help="Multipart upload part size in MB (default 8, minimum 5)")
+    argparser.add_argument("--hedge", action="store_true",
+                           help="Hedge slow metadata GETs (info/playlists): send a second request after the p95 of recent latency, first answer wins")
+    argparser.add_argument("--hedge-percentile", type=float, default=None, metavar="P",
+                           help="Latency percentile that triggers the hedge, 0..1 (default 0.95)")
+    argparser.add_argument("--hedge-max-ratio", type=float, default=None, metavar="R",
+                           help="At most this share of requests is hedged (default 0.1)")
+    argparser.add_argument("--trace", type=str, default=None, metavar="PATH",
+                           help="Write a Chrome-trace/Perfetto JSON timeline of all stages (HTTP phases, backoff, conversions, merge) on exit")
+    argparser.add_argument("--profile", nargs="?", const="profile", default=None, metavar="PREFIX",
+                           help="Run under cProfile and write a per-stage report to PREFIX.txt and PREFIX.pstats (default prefix: profile)")
+    argparser.add_argument("--no-leases", action="store_true",
+                           help="batch: do not claim resources via lease files in mybooks/.leases (single-host runs)")
+    argparser.add_argument("--lease-ttl", type=float, default=None,
+                           help="batch: seconds without heartbeat after which another host reclaims a lease (default 300)")
+    argparser.add_argument("--failures-out", type=str, default=None,
+                           help="batch: where to write resources that still failed after deferred retries (default failed.txt)")
+    argparser.add_argument("--deferred-retries", type=int, default=None,
+                           help="batch: how many times to retry failed resources at the end of the run (default 1, 0 = off)")
     argparser.add_argument("--force-meta", action="store_true", help="Overwrite meta files (jpeg/json/info.txt) even if they exist")
     argparser.add_argument("--archive", type=str, default="archive.txt", help="Path to archive file with downloaded IDs")
+    argparser.add_argument("--blob-store", type=str, default=None,
+                           help="Content-addressed store dir: identical files (by UUID + sha256) are hardlinked/reflinked instead of re-downloaded")
     argparser.add_argument("--no-merge", action="store_true", help="(Legacy, default is no-merge)")
     argparser.add_argument("--keep-chapters", action="store_true", help="Keep individual chapter files after merging")
     argparser.add_argument("--merge-chapters", action="store_true", help="Merge audiobook chapters into a single file (default: do not merge)")
+    argparser.add_argument("--merge-mode", choices=("physical", "virtual"), default=None,
+                           help="physical: one M4A via ffmpeg (default); virtual: keep chapters and write M3U8/CUE/ffmetadata "
+                                "from recorded durations (implies --merge-chapters)")
+    argparser.add_argument("--limit-rate", type=str, default=None,
+                           help="Global download bandwidth cap shared by all streams, e.g. 2M or 500K (bytes/s)")
+    argparser.add_argument("--rate-schedule", type=str, default=None,
+                           help="Time-of-day caps, e.g. '09:00-18:00=1M,18:00-09:00=0' (0 = unlimited; outside windows --limit-rate applies)")
+    argparser.add_argument("--rate-file", type=str, default=None,
+                           help="File holding a cap or schedule; re-read while running so the limit can be changed on the fly")
+    argparser.add_argument("--formats", action="append", default=None, metavar="TYPE=FMT,...",
+                           help="Output formats per resource type, e.g. 'book=epub,fb2' or 'comic=cbz' "
+                                "(book: epub,fb2,pdf; comic: cbr,cbz,pdf,images). Default: book=epub,fb2,pdf comic=cbr,pdf")
+    argparser.add_argument("--pdf-font", type=str, default=None,
+                           help="TrueType font (.ttf with Cyrillic) embedded into text PDFs (default: DejaVu Sans/Liberation/Arial if found)")
+    argparser.add_argument("--write-block-kb", type=int, default=None, help="Disk write block size in KiB (default 1024)")
+    argparser.add_argument("--write-buffer", type=int, default=None, help="Number of write blocks buffered in memory before backpressure (default 4)")
+    argparser.add_argument("--fsync", action="store_true", help="fsync every downloaded file before it is renamed into place")
+    # Batch scheduling
+    argparser.add_argument("--jobs", type=int, default=None, help="Batch mode: number of resources downloaded in parallel (default 1)")
+    argparser.add_argument("--schedule", choices=SCHEDULE_POLICIES, default=None,
+                           help="Batch mode order: fifo (file order), longest (longest first, minimises total time), "
+                                "shortest (fast feedback), fair (interleave resource types)")
+    argparser.add_argument("--rebuild-all", action="store_true", help="rebuild: regenerate all derivatives, not only missing/stale ones")
+    argparser.add_argument("--full-scan", action="store_true", help="index/status: rescan every directory, not only changed ones")
+    argparser.add_argument("--verify-out", type=str, default="broken.txt",
+                           help="verify: where to write broken resources as a batch file (default broken.txt)")
     args = argparser.parse_args()
 
     # Merge behavior: default is DO NOT merge
     merge_flag = True if getattr(args, 'merge_chapters', False) else False
+    if args.merge_mode:
+        CONFIG["merge_mode"] = args.merge_mode
+        merge_flag = merge_flag or args.merge_mode == "virtual"
+
+    if args.trace:
+        import atexit
+        enable_tracing()
+        atexit.register(write_trace, args.trace)
+    if args.profile:
+        start_profiling(args.profile)
 
     # Archive initialization
     init_archive(args.archive)
 
-    # Authorization token
-    HEADERS['auth-token'] = get_auth_token()
-
     # Proxy: arg or env
     proxy_url = args.proxy or os.environ.get("BOOKMATE_PROXY")
     if proxy_url:
@@ -1148,6 +4516,99 @@ def main():
         CONFIG["timeout_base_download"] = max(1.0, args.timeout_base_dl)
     if args.force_meta:
         CONFIG["force_meta"] = True
+    if args.formats:
+        try:
+            CONFIG["formats"] = parse_formats(args.formats)
+        except ValueError as e:
+            argparser.error(f"--formats: {e}")
+    if args.pdf_font:
+        CONFIG["pdf_font"] = args.pdf_font
+    if args.limit_rate:
+        CONFIG["rate_limit"] = _parse_size(args.limit_rate)
+    if args.rate_schedule:
+        _parse_rate_schedule(args.rate_schedule)  # ошибки формата — сразу, а не посреди загрузки
+        CONFIG["rate_schedule"] = args.rate_schedule
+    if args.rate_file:
+        CONFIG["rate_file"] = args.rate_file
+    if args.write_block_kb is not None:
+        CONFIG["write_block"] = max(64, args.write_block_kb) * 1024
+    if args.write_buffer is not None:
+        CONFIG["write_buffer_blocks"] = max(1, args.write_buffer)
+    if args.fsync:
+        CONFIG["fsync"] = True
+    if args.blob_store:
+        CONFIG["blob_store"] = args.blob_store
+    if args.stall_speed is not None:
+        CONFIG["stall_min_bps"] = _parse_size(args.stall_speed)
+    if args.stall_window is not None:
+        CONFIG["stall_window"] = max(1.0, args.stall_window)
+    if args.ttfb is not None:
+        CONFIG["ttfb_budget"] = max(0.0, args.ttfb)
+    if args.hedge:
+        CONFIG["hedge"] = True
+    if args.hedge_percentile is not None:
+        CONFIG["hedge_percentile"] = min(1.0, max(0.0, args.hedge_percentile))
+    if args.hedge_max_ratio is not None:
+        CONFIG["hedge_max_ratio"] = max(0.0, args.hedge_max_ratio)
+    if args.sink:
+        CONFIG["sink"] = args.sink
+    if args.pack:
+        CONFIG["sink_pack"] = args.pack
+    if args.keep_local:
+        CONFIG["keep_local"] = True
+    if args.s3_endpoint:
+        CONFIG["s3_endpoint"] = args.s3_endpoint
+    if args.s3_region:
+        CONFIG["s3_region"] = args.s3_region
+    if args.s3_part_mb is not None:
+        CONFIG["s3_part_mb"] = max(5, args.s3_part_mb)
+    try:
+        get_sink()
+    except ValueError as e:
+        argparser.error(f"--sink: {e}")
+    if args.transcode:
+        try:
+            CONFIG["transcode"] = parse_transcode(args.transcode)
+        except ValueError as e:
+            argparser.error(f"--transcode: {e}")
+    if args.transcode_jobs is not None:
+        CONFIG["transcode_jobs"] = max(1, args.transcode_jobs)
+    if args.max_mb_per_book:
+        CONFIG["audio_budget_mb"] = args.max_mb_per_book
+    if args.max_kbps:
+        CONFIG["audio_max_kbps"] = args.max_kbps
+    if args.no_leases:
+        CONFIG["leases"] = False
+    if args.lease_ttl is not None:
+        CONFIG["lease_ttl"] = max(10.0, args.lease_ttl)
+    if args.failures_out:
+        CONFIG["failures_file"] = args.failures_out
+    if args.deferred_retries is not None:
+        CONFIG["deferred_retries"] = max(0, args.deferred_retries)
+    if args.jobs is not None:
+        CONFIG["jobs"] = max(1, args.jobs)
+    if args.schedule:
+        CONFIG["schedule"] = args.schedule
+
+    # Local-only commands (no token needed)
+    if args.target == "importcheck":
+        sys.exit(EXIT_OK if check_startup_imports() else EXIT_FAILED)
+    if args.target == "verify":
+        broken = verify_library(args.uuid or "mybooks", args.verify_out, workers=args.jobs)
+        sys.exit(EXIT_FAILED if broken else EXIT_OK)
+    if args.target == "rebuild":
+        failed = rebuild_library(args.uuid or "mybooks", force=args.rebuild_all, merge_audio=merge_flag, workers=args.jobs)
+        sys.exit(EXIT_FAILED if failed else EXIT_OK)
+    if args.target in ("index", "status"):
+        if args.target == "index" or args.full_scan:
+            total, rescanned = scan_library("mybooks", full=args.full_scan)
+            print(f"[index] {total} resources, {rescanned} rescanned")
+        if args.target == "status":
+            library_status(args.uuid)
+        return
+
+    # Authorization token
+    HEADERS['auth-token'] = get_auth_token()
 
     # Auth-only command
     if args.target == "auth":
@@ -1157,13 +4618,12 @@ def main():
 
     # Batch mode
     if args.batch_file:
-        process_batch_file(
+        sys.exit(process_batch_file(
             args.batch_file,
             merge_audio_default=merge_flag,
             quality_default=args.quality,
             cleanup_chapters_default=not args.keep_chapters,
-        )
-        return
+        ))
 
     # No batch: target can be URL, resource type + uuid, or just uuid
     if not args.target:
@@ -1177,17 +4637,18 @@ def main():
         uid, rtype = extract_id_and_type_from_url(args.target)
         if not uid or not rtype:
             print(f"❌ Unrecognized URL: {args.target}")
-            sys.exit(2)
+            sys.exit(EXIT_USAGE)
         if rtype == "audiobook":
             download_audiobook(uid,
                                max_bitrate=(args.quality == 'max'),
                                merge_chapters=merge_flag,
                                cleanup_chapters=not args.keep_chapters)
-        elif rtype == "book":
-            download_book(uid)
+        elif rtype in FUNCTION_MAP:
+            FUNCTION_MAP[rtype](uid)
         else:
             print(f"❌ URL type '{rtype}' is not supported for direct URL mode.")
-            sys.exit(2)
+            sys.exit(EXIT_USAGE)
+        print_run_summary()
         return
 
     # Resource type + UUID
@@ -1202,25 +4663,34 @@ def main():
                  cleanup_chapters=not args.keep_chapters)
         else:
             func(args.uuid)
+        print_run_summary()
         return
 
-    # If user passed only UUID (no explicit type) — try as book first, then audiobook
+    # If user passed only UUID (no explicit type) — resolve the type by probing all info endpoints at once
     guess = args.target
-    if re.match(r"^[A-Za-z0-9_-]+$", guess):
-        try:
-            download_book(guess)
-            return
-        except SystemExit:
-            raise
-        except Exception:
+    if _BARE_ID_RE.match(guess):
+        rtype = resolve_uuid_types([guess])[guess]
+        if rtype == TYPE_UNRESOLVED:
+            print(f"❌ {guess}: could not determine the type (network errors or 5xx), try again later")
+            count_stat("failed")
+            print_run_summary()
+            sys.exit(EXIT_FAILED)
+        if not rtype:
+            print(f"❌ {guess}: not found as {', '.join(PROBE_TYPES)}")
+            sys.exit(EXIT_FAILED)
+        print(f"[type] {guess} is a {rtype}")
+        if rtype == "audiobook":
             download_audiobook(guess,
                                max_bitrate=(args.quality == 'max'),
                                merge_chapters=merge_flag,
                                cleanup_chapters=not args.keep_chapters)
-            return
+        else:
+            FUNCTION_MAP[rtype](guess)
+        print_run_summary()
+        return
 
     print(f"❌ Unknown target: {args.target}")
-    sys.exit(2)
+    sys.exit(EXIT_USAGE)
 
 
 FUNCTION_MAP = {
@@ -1232,6 +4702,8 @@ FUNCTION_MAP = {
 }
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # ProcessPoolExecutor в собранном .exe
     try:
         # If run without arguments: open auth flow (backward-compatible behavior)
         if len(sys.argv) == 1:
@@ -1243,6 +4715,9 @@ if __name__ == "__main__":
         code = e.code if isinstance(e.code, int) else 130
         print("Завершено.")
         sys.exit(code)
+    except DownloadError as e:
+        print(f"❌ {e}")
+        sys.exit(EXIT_FAILED)
     except KeyboardInterrupt:
         print("\nЗавершено по Ctrl+C.")
         sys.exit(130)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark.py — замеры горячих путей конвертации и склейки на синтетических данных.
+
+Фикстуры генерируются локально и детерминированно (кэшируются в .bench/):
+EPUB на тысячи глав, комикс на 500 страниц, 100 глав M4A (нужен ffmpeg).
+Каждый этап запускается в отдельном процессе, печатаются время, пик RSS за время
+самого вызова (без импорта и подготовки), отдельно пик ffmpeg и размер результата. С --baseline результаты сравниваются с сохранёнными ранее
+(--save-baseline); при регрессии больше --tolerance код выхода 1.
+
+  python benchmark.py                                 # все этапы
+  python benchmark.py --only epub_to_fb2 --chapters 500
+  python benchmark.py --save-baseline bench_baseline.json
+  python benchmark.py --baseline bench_baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ("epub_to_fb2", "epub_to_plain_pdf", "create_pdf_from_images", "merge_audiobook_chapters_ffmpeg",
+          "merge_audiobook_chapters_remux")
+
+_WORDS = ("книга глава текст слово время человек жизнь день рука дело голова дом сторона страна мир "
+          "случай вопрос работа город место лицо друг глаз земля вода ночь утро дорога окно память "
+          "the and of to in that it was he for on are with as his they be at one have this").split()
+
+
+# =========================
+# Fixtures
+# =========================
+
+def _paragraphs(rnd: random.Random, count: int) -> list[str]:
+    out = []
+    for _ in range(count):
+        words = [rnd.choice(_WORDS) for _ in range(rnd.randint(40, 120))]
+        out.append(" ".join(words).capitalize() + ".")
+    return out
+
+
+def make_epub(path: str, chapters: int, seed: int = 1):
+    """EPUB 2 с OPF, NCX и chapters XHTML-главами (~3–8 абзацев каждая)."""
+    rnd = random.Random(seed)
+    items, spine, nav = [], [], []
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml",
+                   '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                   '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                   '</rootfiles></container>')
+        for i in range(1, chapters + 1):
+            body = "".join(f"<p>{p}</p>" for p in _paragraphs(rnd, rnd.randint(3, 8)))
+            z.writestr(f"OEBPS/ch{i}.xhtml",
+                       '<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml">'
+                       f'<head><title>Глава {i}</title></head><body><h1>Глава {i}</h1>{body}</body></html>')
+            items.append(f'<item id="ch{i}" href="ch{i}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="ch{i}"/>')
+            nav.append(f'<navPoint id="n{i}" playOrder="{i}"><navLabel><text>Глава {i}</text></navLabel>'
+                       f'<content src="ch{i}.xhtml"/></navPoint>')
+        z.writestr("OEBPS/toc.ncx",
+                   '<?xml version="1.0" encoding="utf-8"?><ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                   '<head><meta name="dtb:uid" content="bench"/></head><docTitle><text>Benchmark</text></docTitle>'
+                   f'<navMap>{"".join(nav)}</navMap></ncx>')
+        z.writestr("OEBPS/content.opf",
+                   '<?xml version="1.0" encoding="utf-8"?>'
+                   '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">'
+                   '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Benchmark</dc:title>'
+                   '<dc:creator>bench</dc:creator><dc:language>ru</dc:language><dc:identifier id="uid">bench</dc:identifier>'
+                   f'</metadata><manifest><item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>{"".join(items)}'
+                   f'</manifest><spine toc="ncx">{"".join(spine)}</spine></package>')
+
+
+def make_comic_pages(folder: str, pages: int, seed: int = 2):
+    """pages JPEG-страниц 1000x1500 (градиент + случайные блоки, чтобы сжатие было реалистичным)."""
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    base = Image.linear_gradient("L").resize((1000, 1500)).convert("RGB")
+    for i in range(1, pages + 1):
+        img = base.copy()
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x, y = rnd.randrange(0, 900), rnd.randrange(0, 1400)
+            draw.rectangle((x, y, x + rnd.randrange(20, 300), y + rnd.randrange(20, 300)),
+                           fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        img.save(os.path.join(folder, f"{i:04d}.jpeg"), quality=85)
+
+
+def make_chapters(folder: str, count: int, seconds: float):
+    """count глав M4A (AAC 64 кбит/с, синус разной частоты) через ffmpeg."""
+    os.makedirs(folder, exist_ok=True)
+    for i in range(1, count + 1):
+        out = os.path.join(folder, f"Глава_{i}.m4a")
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi',
+                        '-i', f'sine=frequency={200 + i * 7}:duration={seconds}',
+                        '-c:a', 'aac', '-b:a', '64k', out], check=True)
+
+
+def ensure_fixtures(root: str, args) -> dict:
+    """Создаёт недостающие фикстуры; параметры входят в имя каталога, так что кэш не путается."""
+    fx = {
+        "epub": os.path.join(root, f"book_{args.chapters}ch.epub"),
+        "pages": os.path.join(root, f"comic_{args.pages}p"),
+        "audio": os.path.join(root, f"audio_{args.audio_chapters}x{args.chapter_seconds:g}s", "Книга"),
+    }
+    os.makedirs(root, exist_ok=True)
+    if not os.path.exists(fx["epub"]):
+        print(f"[fixtures] EPUB with {args.chapters} chapters...")
+        make_epub(fx["epub"] + ".part", args.chapters)
+        os.replace(fx["epub"] + ".part", fx["epub"])
+    if not os.path.isdir(fx["pages"]):
+        print(f"[fixtures] {args.pages} comic pages...")
+        make_comic_pages(fx["pages"] + ".part", args.pages)
+        os.replace(fx["pages"] + ".part", fx["pages"])
+    if not os.path.isdir(fx["audio"]) and shutil.which("ffmpeg"):
+        print(f"[fixtures] {args.audio_chapters} M4A chapters of {args.chapter_seconds:g}s...")
+        make_chapters(fx["audio"] + ".part", args.audio_chapters, args.chapter_seconds)
+        os.replace(fx["audio"] + ".part", fx["audio"])
+    return fx
+
+
+# =========================
+# Stages
+# =========================
+
+def _maxrss(who: str) -> int | None:
+    """ru_maxrss (байты) за всё время жизни процесса ("SELF") или его дочерних ("CHILDREN")."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024  # macOS — байты, Linux — КиБ
+    return resource.getrusage(getattr(resource, f"RUSAGE_{who}")).ru_maxrss * scale
+
+
+def _current_rss() -> int | None:
+    """Текущий RSS процесса (Linux, /proc); None, если недоступно."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _RssSampler:
+    """
+    Пик RSS за время вызова сверх уровня до него: импорт модулей и копирование фикстур
+    в замер не входят. Без /proc — прирост ru_maxrss (занижен, если пик был ещё до вызова).
+    """
+
+    INTERVAL = 0.005
+
+    def __enter__(self):
+        self.base = _current_rss()
+        self.base_max = _maxrss("SELF")
+        self.peak = self.base or 0
+        self._stop = threading.Event()
+        if self.base is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.INTERVAL):
+            self.peak = max(self.peak, _current_rss() or 0)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.base is not None:
+            self._thread.join()
+            self.peak = max(self.peak, _current_rss() or 0)
+            self.growth = self.peak - self.base
+        elif self.base_max is not None:
+            self.growth = max(0, _maxrss("SELF") - self.base_max)
+        else:
+            self.growth = None
+        return False
+
+
+def run_stage(stage: str, fx: dict, out_dir: str) -> dict:
+    """Выполняется в отдельном процессе: импорт и подготовка не входят в замер времени."""
+    sys.path.insert(0, HERE)
+    import contextlib
+    import io
+    import RUBookmatedownloader as dl
+
+    if stage == "epub_to_fb2":
+        output = os.path.join(out_dir, "book.fb2")
+        call = lambda: dl.epub_to_fb2(fx["epub"], output)
+    elif stage == "epub_to_plain_pdf":
+        output = os.path.join(out_dir, "book.pdf")
+        call = lambda: dl.epub_to_plain_pdf(fx["epub"], output)
+    elif stage == "create_pdf_from_images":
+        # функция удаляет картинки по мере вставки — работаем с копией
+        pages = shutil.copytree(fx["pages"], os.path.join(out_dir, "pages"))
+        output = os.path.join(out_dir, "comic.pdf")
+        call = lambda: dl.create_pdf_from_images(pages, output)
+    elif stage == "merge_audiobook_chapters_ffmpeg":
+        if not (os.path.isdir(fx["audio"]) and shutil.which("ffprobe")):
+            return {"skipped": "skipped: ffmpeg/ffprobe not found"}
+        output = os.path.join(out_dir, "merged.m4a")
+        call = lambda: dl.merge_audiobook_chapters_ffmpeg(fx["audio"], output, cleanup_chapters=False)
+    elif stage == "merge_audiobook_chapters_remux":
+        if not os.path.isdir(fx["audio"]):
+            return {"skipped": "skipped: no audio fixture (needs ffmpeg to generate)"}
+        import merge_audiobook
+        output = os.path.join(out_dir, "remuxed.m4a")
+        call = lambda: merge_audiobook.merge_audiobook_chapters_remux(fx["audio"], output, cleanup_chapters=False)
+    else:
+        raise ValueError(f"unknown stage {stage}")
+
+    with contextlib.redirect_stdout(io.StringIO()), _RssSampler() as rss:
+        t0 = time.perf_counter()
+        call()
+        wall = time.perf_counter() - t0
+    # дочерние процессы (ffmpeg) появляются только внутри вызова — их пик отдельно
+    return {"wall_s": round(wall, 3), "call_rss": rss.growth, "child_rss": _maxrss("CHILDREN") or None,
+            "output_bytes": os.path.getsize(output)}
+
+
+def _run_isolated(stage: str, fx: dict, out_dir: str) -> dict:
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-stage", stage,
+           "--fixtures-json", json.dumps(fx), "--out-dir", out_dir]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    if result.returncode != 0:
+        return {"error": (result.stderr.strip().splitlines() or ["failed"])[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# =========================
+# Report & baseline
+# =========================
+
+def _mb(value) -> str:
+    return f"{value / 1048576:10.1f}" if isinstance(value, (int, float)) else f"{'—':>10}"
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Регрессии: время или пиковая память хуже базовой больше чем на tolerance."""
+    problems = []
+    for stage, cur in results.items():
+        base = (baseline.get("stages") or {}).get(stage)
+        if not base or "wall_s" not in cur or "wall_s" not in base:
+            continue
+        for key, label, unit, scale in (("wall_s", "wall time", "s", 1), ("call_rss", "peak RSS of the call", "MB", 1048576),
+                                        ("child_rss", "ffmpeg peak RSS", "MB", 1048576)):
+            if cur.get(key) and base.get(key) and cur[key] > base[key] * (1 + tolerance):
+                problems.append(f"{stage}: {label} {cur[key] / base[key] - 1:+.0%} "
+                                f"({base[key] / scale:.2f} {unit} -> {cur[key] / scale:.2f} {unit})")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark conversion and merge hot paths on synthetic fixtures.")
+    ap.add_argument("--only", action="append", choices=STAGES, help="Запустить только этот этап (можно повторять)")
+    ap.add_argument("--fixtures", default=os.path.join(HERE, ".bench"), help="Каталог кэша фикстур (по умолчанию .bench/)")
+    ap.add_argument("--chapters", type=int, default=3000, help="Глав в синтетическом EPUB")
+    ap.add_argument("--pages", type=int, default=500, help="Страниц в синтетическом комиксе")
+    ap.add_argument("--audio-chapters", type=int, default=100, help="Число глав M4A")
+    ap.add_argument("--chapter-seconds", type=float, default=60, help="Длительность каждой главы M4A (сек)")
+    ap.add_argument("--repeat", type=int, default=1, help="Повторов на этап; берётся лучший результат по времени")
+    ap.add_argument("--baseline", help="JSON с базовыми результатами для сравнения")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="Допустимое ухудшение относительно базы (0.15 = 15%%)")
+    ap.add_argument("--save-baseline", help="Сохранить результаты как базу в этот JSON")
+    ap.add_argument("--run-stage", help=argparse.SUPPRESS)
+    ap.add_argument("--fixtures-json", help=argparse.SUPPRESS)
+    ap.add_argument("--out-dir", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, json.loads(args.fixtures_json), args.out_dir)))
+        return
+
+    fx = ensure_fixtures(args.fixtures, args)
+    out_dir = os.path.join(args.fixtures, "out")
+    results = {}
+    print(f"{'stage':34} {'wall s':>8} {'call RSS MB':>12} {'ffmpeg MB':>10} {'output MB':>10}")
+    for stage in args.only or STAGES:
+        best = None
+        for _ in range(max(1, args.repeat)):
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+            res = _run_isolated(stage, fx, out_dir)
+            if "wall_s" not in res or best is None or res["wall_s"] < best.get("wall_s", float("inf")):
+                best = res
+            if "wall_s" not in res:
+                break
+        results[stage] = best
+        if "wall_s" in best:
+            print(f"{stage:34} {best['wall_s']:8.2f} {_mb(best.get('call_rss')):>12} "
+                  f"{_mb(best.get('child_rss'))} {_mb(best['output_bytes'])}")
+        else:
+            print(f"{stage:34} {best.get('skipped') or 'ERROR: ' + best.get('error', '?')}")
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    meta = {"python": sys.version.split()[0], "platform": sys.platform, "cpus": os.cpu_count(),
+            "params": {k: getattr(args, k) for k in ("chapters", "pages", "audio_chapters", "chapter_seconds")}}
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "stages": results}, f, ensure_ascii=False, indent=1)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    failed = [s for s, r in results.items() if "error" in r]
+    problems = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if (baseline.get("meta") or {}).get("params") != meta["params"]:
+            print("⚠️ Baseline was recorded with different fixture parameters — comparison may be meaningless")
+        problems = compare(results, baseline, args.tolerance)
+        for p in problems:
+            print(f"❌ Regression: {p}")
+        if not problems:
+            print(f"✅ No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    sys.exit(1 if problems or failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,95 +8,838 @@ merge_audiobook.py — объединение глав аудиокниги в 
 
 import os
 import re
-import glob
 import argparse
 from pathlib import Path
 import json
+import struct
 import subprocess
+import sys
+from array import array
+
+# Версия склейки: при изменении логики увеличить — rebuild пересоберёт склеенные файлы
+MERGE_VERSION = 3
+
+def _ffmeta_escape(value) -> str:
+    """Экранирование значения для файла ;FFMETADATA1 (сначала обратный слэш)."""
+    out = str(value).replace('\\', '\\\\')
+    for ch in ('=', ';', '#', '\n'):
+        out = out.replace(ch, '\\' + ch)
+    return out
+
+
+def _chapter_titles(audiobook_path: Path, chapter_files) -> list:
+    """Названия глав из .manifest.json (tracks.*.title), иначе «Глава N» по номеру из имени файла."""
+    try:
+        tracks = json.loads((audiobook_path / ".manifest.json").read_text(encoding='utf-8')).get("tracks") or {}
+    except (OSError, ValueError):
+        tracks = {}
+    titles = []
+    for p in chapter_files:
+        number = int(re.search(r'\d+', p.name).group())
+        titles.append((tracks.get(p.name) or {}).get("title") or f"Глава {number}")
+    return titles
+
 
 def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, cleanup_chapters=True):
-    """Объединяет m4a главы с помощью ffmpeg, добавляет главы и обложку."""
+    """
+    Merge all M4A chapter files in a directory into a single audiobook using ffmpeg.
+    Creates chapter markers and embeds cover image when available.
+    Returns True on success, False otherwise.
+    """
     audiobook_path = Path(audiobook_dir)
+    # Find all M4A files and sort them naturally by chapter number
     chapter_files = sorted([f for f in audiobook_path.glob("*.m4a") if "Глава_" in f.name],
                            key=lambda x: int(re.search(r'Глава_(\d+)\.m4a', x.name).group(1)) if re.search(r'Глава_(\d+)\.m4a', x.name) else 0)
     if not chapter_files:
-        print(f"[skip] Нет глав в {audiobook_path}")
+        print(f"No chapter files found in {audiobook_path}")
         return False
 
+    print(f"Found {len(chapter_files)} chapters, merging with ffmpeg...")
+
+    # Look for cover image
     cover_image = None
-    for ext in ('.jpeg', '.jpg', '.png'):
-        p = audiobook_path / f"{audiobook_path.name}{ext}"
-        if p.exists():
-            cover_image = p
+    for ext in ['.jpeg', '.jpg', '.png']:
+        potential_cover = audiobook_path / f"{audiobook_path.name}{ext}"
+        if potential_cover.exists():
+            cover_image = potential_cover
             break
 
+    # Create a temporary file list and chapter metadata file for ffmpeg
     filelist_path = audiobook_path / "chapters_list.txt"
     chapters_metadata_path = audiobook_path / "chapters_metadata.txt"
+
     try:
-        # длительности
+        # Get chapter durations first (for proper chapter markers)
+        print(" Analyzing chapter durations...")
         chapter_durations = []
         current_time = 0.0
-        for ch in chapter_files:
-            cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration', '-of', 'csv=p=0', str(ch)]
-            res = subprocess.run(cmd, capture_output=True, text=True)
-            dur = float(res.stdout.strip()) if res.returncode == 0 and res.stdout.strip() else 180.0
-            chapter_durations.append((current_time, current_time + dur, ch))
-            current_time += dur
+        for chapter_file in chapter_files:
+            duration_cmd = [
+                'ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
+                '-of', 'csv=p=0', str(chapter_file)
+            ]
+            duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
+            if duration_result.returncode == 0 and duration_result.stdout.strip():
+                duration = float(duration_result.stdout.strip())
+            else:
+                print(f"⚠️ Could not get duration for {chapter_file.name}, assuming 180s")
+                duration = 180.0
+            chapter_durations.append((current_time, current_time + duration, chapter_file))
+            current_time += duration
 
+        # Write ffmpeg concat file list
         with open(filelist_path, 'w', encoding='utf-8') as f:
-            for ch in chapter_files:
-                ap = str(ch.absolute()).replace("'", "\\'")
-                f.write(f"file '{ap}'\n")
+            for chapter_file in chapter_files:
+                # concat demuxer: кавычку внутри '...' экранируем как '\''
+                abs_path = str(chapter_file.absolute()).replace("'", "'\\''")
+                f.write(f"file '{abs_path}'\n")
 
+        # Create chapters metadata file
         with open(chapters_metadata_path, 'w', encoding='utf-8') as f:
             f.write(";FFMETADATA1\n")
+            # Add global metadata from dictionary if provided
             if metadata:
-                for k, v in metadata.items():
-                    if v:
-                        ev = str(v).replace('=', '\\=').replace(';', '\\;').replace('#', '\\#').replace('\\', '\\\\')
-                        f.write(f"{k.upper()}={ev}\n")
-            for i, (start, end, _) in enumerate(chapter_durations):
-                f.write("\n[CHAPTER]\nTIMEBASE=1/1000\n")
-                f.write(f"START={int(start*1000)}\nEND={int(end*1000)}\n")
-                f.write(f"title=Глава {i+1}\n")
-
-        cmd = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', str(filelist_path), '-i', str(chapters_metadata_path)]
+                for key, value in metadata.items():
+                    if value:
+                        escaped_value = _ffmeta_escape(value)
+                        f.write(f"{key.upper()}={escaped_value}\n")
+            # Add chapter markers
+            titles = _chapter_titles(audiobook_path, [c for _s, _e, c in chapter_durations])
+            for (start_time, end_time, chapter_file), title in zip(chapter_durations, titles):
+                f.write("\n[CHAPTER]\n")
+                f.write("TIMEBASE=1/1000\n")
+                f.write(f"START={int(start_time * 1000)}\n")
+                f.write(f"END={int(end_time * 1000)}\n")
+                f.write(f"title={_ffmeta_escape(title)}\n")
+
+        # Build ffmpeg command
+        cmd = [
+            'ffmpeg', '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', str(filelist_path),
+            '-i', str(chapters_metadata_path),
+        ]
         if cover_image:
-            cmd += ['-i', str(cover_image), '-c:v', 'copy', '-c:a', 'copy', '-disposition:v:0', 'attached_pic', '-map_metadata', '1']
+            cmd.extend(['-i', str(cover_image)])
+            cmd.extend(['-c:v', 'copy'])
+            cmd.extend(['-c:a', 'copy'])
+            cmd.extend(['-disposition:v:0', 'attached_pic'])
+            cmd.extend(['-map_metadata', '1'])
         else:
-            cmd += ['-c', 'copy', '-map_metadata', '1']
+            cmd.extend(['-c', 'copy'])
+            cmd.extend(['-map_metadata', '1'])
+
         if metadata:
-            for k, v in metadata.items():
-                if v:
-                    cmd += ['-metadata', f'{k}={v}']
+            for key, value in metadata.items():
+                if value:
+                    cmd.extend(['-metadata', f'{key}={value}'])
         else:
-            cmd += ['-metadata', f'title={audiobook_path.name}', '-metadata', 'genre=Audiobook', '-metadata', 'media_type=2']
+            cmd.extend(['-metadata', f'title={audiobook_path.name}'])
+            cmd.extend(['-metadata', 'genre=Audiobook'])
+            cmd.extend(['-metadata', 'media_type=2'])
+
         cmd.append(str(output_file))
 
-        r = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
-        if r.returncode == 0:
-            print(f"[ok] {output_file}")
+        # Run ffmpeg
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+        if result.returncode == 0:
+            print(f"✅ Successfully merged audiobook: {output_file}")
+            # Clean up individual chapter files after successful merge (if requested)
             if cleanup_chapters:
-                for ch in chapter_files:
+                print(" Cleaning up chapter files...")
+                for chapter_file in chapter_files:
                     try:
-                        Path(ch).unlink()
-                    except OSError:
-                        pass
+                        Path(chapter_file).unlink()
+                        print(f" Removed: {chapter_file.name}")
+                    except OSError as e:
+                        print(f" ⚠️ Could not remove {chapter_file.name}: {e}")
             return True
         else:
-            print(r.stderr)
+            print(f"❌ Error merging audiobook with ffmpeg:")
+            print(result.stderr)
             return False
     finally:
-        for p in (filelist_path, chapters_metadata_path):
+        # Remove temp files
+        try:
+            if filelist_path.exists():
+                filelist_path.unlink()
+            if chapters_metadata_path.exists():
+                chapters_metadata_path.unlink()
+        except Exception:
+            pass
+
+def _probe_audio(path):
+    """(sample_rate, channels, bit_rate) первой аудиодорожки; None, если ffprobe не справился."""
+    cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'a:0',
+           '-show_entries', 'stream=sample_rate,channels,bit_rate', '-of', 'json', str(path)]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        stream = json.loads(result.stdout)['streams'][0]
+        bit_rate = stream.get('bit_rate')
+        return int(stream['sample_rate']), int(stream['channels']), int(bit_rate) if bit_rate not in (None, 'N/A') else None
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
+
+
+def merge_audiobook_chapters_stream(audiobook_dir, output_file, metadata=None, cleanup_chapters=True,
+                                    chunk_size=1 << 20):
+    """
+    Склейка с перекодированием при постоянном расходе памяти: каждая глава декодируется
+    отдельным ffmpeg в PCM, который по кускам chunk_size передаётся в stdin одного
+    AAC-энкодера. Границы глав считаются по числу PCM-байт (точно), затем главы, теги и
+    обложка добавляются ремуксом без перекодирования. Returns True on success.
+    """
+    import shutil
+    import tempfile
+    import time
+
+    audiobook_path = Path(audiobook_dir)
+    chapter_files = sorted([f for f in audiobook_path.glob("*.m4a") if re.fullmatch(r'Глава_\d+\.m4a', f.name)],
+                           key=lambda x: int(re.search(r'\d+', x.name).group()))
+    if not chapter_files:
+        print(f"No chapter files found in {audiobook_path}")
+        return False
+    if not shutil.which('ffmpeg'):
+        print("❌ ffmpeg not found, streaming merge is unavailable")
+        return False
+
+    rate, channels, bit_rate = _probe_audio(chapter_files[0]) or (44100, 2, None)
+    bit_rate = bit_rate or 64000
+    bytes_per_sec = rate * channels * 2  # s16le
+    pcm_args = ['-f', 's16le', '-ar', str(rate), '-ac', str(channels)]
+    output_file = Path(output_file)
+    encoded = output_file.with_name(output_file.name + '.enc.m4a')
+    meta_path = audiobook_path / "chapters_metadata.txt"
+
+    print(f"Streaming {len(chapter_files)} chapters through one AAC encoder "
+          f"({rate} Hz, {channels} ch, {bit_rate // 1000} kbit/s)...")
+    started = time.monotonic()
+    spans = []
+    in_bytes = 0
+    try:
+        with tempfile.TemporaryFile() as enc_log:
+            encoder = subprocess.Popen(
+                ['ffmpeg', '-y', '-v', 'error', *pcm_args, '-i', 'pipe:0',
+                 '-c:a', 'aac', '-b:a', str(bit_rate), str(encoded)],
+                stdin=subprocess.PIPE, stderr=enc_log)
+            pcm_total = 0
             try:
-                if p.exists():
-                    p.unlink()
-            except Exception:
+                for chapter_file in chapter_files:
+                    decoder = subprocess.Popen(
+                        ['ffmpeg', '-v', 'error', '-i', str(chapter_file), *pcm_args, 'pipe:1'],
+                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                    start = pcm_total
+                    while True:
+                        chunk = decoder.stdout.read(chunk_size)
+                        if not chunk:
+                            break
+                        encoder.stdin.write(chunk)
+                        pcm_total += len(chunk)
+                    decoder.stdout.close()
+                    if decoder.wait() != 0:
+                        raise RuntimeError(f"decoding failed: {chapter_file.name}")
+                    in_bytes += chapter_file.stat().st_size
+                    spans.append((start / bytes_per_sec, pcm_total / bytes_per_sec))
+                encoder.stdin.close()
+            except BaseException:
+                encoder.kill()
+                encoder.wait()
+                raise
+            if encoder.wait() != 0:
+                enc_log.seek(0)
+                print("❌ AAC encoder failed:")
+                print(enc_log.read().decode('utf-8', 'replace'))
+                return False
+
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            f.write(";FFMETADATA1\n")
+            for key, value in (metadata or {'title': audiobook_path.name, 'genre': 'Audiobook'}).items():
+                if value:
+                    f.write(f"{key.upper()}={_ffmeta_escape(value)}\n")
+            for (start_time, end_time), title in zip(spans, _chapter_titles(audiobook_path, chapter_files)):
+                f.write(f"\n[CHAPTER]\nTIMEBASE=1/1000\nSTART={int(start_time * 1000)}\n"
+                        f"END={int(end_time * 1000)}\ntitle={_ffmeta_escape(title)}\n")
+        cover_image = next((p for p in (audiobook_path / f"{audiobook_path.name}{ext}" for ext in ('.jpeg', '.jpg', '.png'))
+                            if p.exists()), None)
+        cmd = ['ffmpeg', '-y', '-v', 'error', '-i', str(encoded), '-i', str(meta_path)]
+        if cover_image:
+            cmd += ['-i', str(cover_image), '-map', '0:a', '-map', '2:v', '-disposition:v:0', 'attached_pic']
+        cmd += ['-map_metadata', '1', '-map_chapters', '1', '-c', 'copy', str(output_file)]
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+        if result.returncode != 0:
+            print("❌ Error writing chapters/metadata:")
+            print(result.stderr)
+            return False
+    except (OSError, RuntimeError) as e:
+        print(f"❌ Streaming merge failed: {e}")
+        return False
+    finally:
+        for tmp in (encoded, meta_path):
+            try:
+                tmp.unlink()
+            except OSError:
                 pass
 
+    elapsed = max(time.monotonic() - started, 1e-6)
+    audio_sec = spans[-1][1]
+    print(f"✅ Successfully merged audiobook: {output_file}")
+    print(f"   {audio_sec / 3600:.2f} h of audio in {elapsed:.1f} s — {audio_sec / elapsed:.0f}x realtime, "
+          f"{in_bytes / elapsed / (1 << 20):.2f} MB/s input")
+    if cleanup_chapters:
+        for chapter_file in chapter_files:
+            try:
+                chapter_file.unlink()
+            except OSError as e:
+                print(f" ⚠️ Could not remove {chapter_file.name}: {e}")
+    return True
+
+
+# ---- Встроенная склейка без ffmpeg: ремукс MP4 ----
+# Главы с одинаковым AAC (тот же AudioSpecificConfig, частота и timescale) склеиваются
+# переписыванием таблиц moov/stbl: данные mdat копируются крупными блоками как есть,
+# главы пишутся в chpl (Nero) и текстовой дорожкой (QuickTime, tref chap), теги и обложка — в ilst.
+
+class RemuxUnsupported(Exception):
+    """Главы нельзя склеить ремуксом (другой кодек/параметры, фрагментированный MP4, …)."""
+
+
+_STCO_LIMIT = 0xFFFFFFFF  # смещения выше — co64 вместо stco
+_ILST_TAGS = {'title': b'\xa9nam', 'artist': b'\xa9ART', 'album': b'\xa9alb', 'album_artist': b'aART',
+              'composer': b'\xa9wrt', 'genre': b'\xa9gen', 'comment': b'\xa9cmt', 'performer': b'\xa9nrt'}
+_LANGUAGES = {'ru': 'rus', 'en': 'eng', 'uk': 'ukr', 'be': 'bel', 'kk': 'kaz', 'de': 'deu', 'fr': 'fra'}
+
+
+def _children(data, start, end):
+    """[(тип, начало данных, конец)] вложенных боксов в data[start:end]."""
+    out = []
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise RemuxUnsupported(f"broken '{kind.decode('latin-1')}' box")
+        out.append((kind, pos + header, pos + size))
+        pos += size
+    return out
+
+
+def _child(data, start, end, kind):
+    return next(((s, e) for k, s, e in _children(data, start, end) if k == kind), None)
+
+
+def _path(data, start, end, *kinds):
+    for kind in kinds:
+        found = _child(data, start, end, kind)
+        if found is None:
+            return None
+        start, end = found
+    return start, end
+
+
+def _table(data, start, count, code='I'):
+    """Массив big-endian чисел (I — 32 бита, Q — 64) без поэлементного разбора."""
+    arr = array(code)
+    arr.frombytes(data[start:start + count * arr.itemsize])
+    if len(arr) != count:
+        raise RemuxUnsupported("truncated sample table")
+    if sys.byteorder == 'little':
+        arr.byteswap()
+    return arr
+
+
+def _be(arr):
+    out = array(arr.typecode, arr)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out.tobytes()
+
+
+def _box(kind, *payload):
+    body = b''.join(payload)
+    if len(body) + 8 > 0xFFFFFFFF:
+        return struct.pack('>I4sQ', 1, kind, len(body) + 16) + body
+    return struct.pack('>I4s', len(body) + 8, kind) + body
+
+
+def _full_box(kind, version, flags, *payload):
+    return _box(kind, struct.pack('>I', (version << 24) | flags), *payload)
+
+
+def _aac_config(esds):
+    """objectTypeIndication + DecoderSpecificInfo из esds (без полей битрейта, они у глав разные)."""
+    def descriptor(i):
+        tag, i = esds[i], i + 1
+        size = 0
+        for _ in range(4):
+            b, i = esds[i], i + 1
+            size = (size << 7) | (b & 0x7F)
+            if not b & 0x80:
+                break
+        return tag, i, i + size
+
+    tag, s, _e = descriptor(4)  # после version/flags
+    if tag != 0x03:
+        raise ValueError
+    flags = esds[s + 2]
+    s += 3
+    if flags & 0x80:
+        s += 2
+    if flags & 0x40:
+        s += 1 + esds[s]
+    if flags & 0x20:
+        s += 2
+    tag, s, _e = descriptor(s)
+    if tag != 0x04:
+        raise ValueError
+    oti = esds[s]
+    tag, s, e = descriptor(s + 13)
+    if tag != 0x05:
+        raise ValueError
+    return bytes([oti]) + esds[s:e]
+
+
+class _Chapter:
+    """Аудиодорожка одной главы: таблицы сэмплов и положение данных в файле."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self._parse()
+        except RemuxUnsupported:
+            raise
+        except (KeyError, IndexError, TypeError, ValueError, struct.error) as e:
+            # нет обязательного бокса, обрезанный заголовок и т.п. — такую главу склеит ffmpeg
+            raise RemuxUnsupported(f"{path.name}: malformed MP4 ({type(e).__name__}: {e})") from e
+
+    def _parse(self):
+        path = self.path
+        with open(path, 'rb') as f:
+            moov = self._read_moov(f)
+        if _child(moov, 0, len(moov), b'mvex'):
+            raise RemuxUnsupported(f"{path.name}: fragmented MP4")
+        trak = None
+        for kind, s, e in _children(moov, 0, len(moov)):
+            hdlr = _path(moov, s, e, b'mdia', b'hdlr') if kind == b'trak' else None
+            if hdlr and moov[hdlr[0] + 8:hdlr[0] + 12] == b'soun':
+                trak = (s, e)
+                break
+        if trak is None:
+            raise RemuxUnsupported(f"{path.name}: no audio track")
+
+        mdhd = _path(moov, *trak, b'mdia', b'mdhd')
+        s = mdhd[0]
+        if moov[s] == 1:
+            self.timescale, = struct.unpack_from('>I', moov, s + 20)
+            self.language = moov[s + 32:s + 34]
+        else:
+            self.timescale, = struct.unpack_from('>I', moov, s + 12)
+            self.language = moov[s + 20:s + 22]
+
+        # сдвиг начала (AAC priming) из первой записи edit list
+        self.media_time = 0
+        elst = _path(moov, *trak, b'edts', b'elst')
+        if elst:
+            s = elst[0]
+            if struct.unpack_from('>I', moov, s + 4)[0]:
+                if moov[s] == 1:
+                    self.media_time = max(0, struct.unpack_from('>q', moov, s + 16)[0])
+                else:
+                    self.media_time = max(0, struct.unpack_from('>i', moov, s + 12)[0])
+
+        stbl = _path(moov, *trak, b'mdia', b'minf', b'stbl')
+        if stbl is None:
+            raise RemuxUnsupported(f"{path.name}: no sample table")
+        boxes = {k: (s, e) for k, s, e in _children(moov, *stbl)}
+        if b'ctts' in boxes:
+            raise RemuxUnsupported(f"{path.name}: composition offsets are not supported")
+        s, e = boxes[b'stsd']
+        self.stsd = moov[s:e]
+        entry = _children(moov, s + 8, e)[0]
+        es, ee = entry[1], entry[2]
+        channels, sample_bits = struct.unpack_from('>HH', moov, es + 16)
+        rate, = struct.unpack_from('>I', moov, es + 24)
+        esds = None
+        try:
+            found = _child(moov, es + 28, ee, b'esds')
+            esds = _aac_config(moov[found[0]:found[1]]) if found else None
+        except (ValueError, IndexError, RemuxUnsupported):
+            esds = moov[es:ee]
+        self.codec = (entry[0], channels, sample_bits, rate, esds or moov[es:ee], self.timescale)
+
+        s, _e = boxes[b'stts']
+        n, = struct.unpack_from('>I', moov, s + 4)
+        self.stts = _table(moov, s + 8, n * 2)
+
+        s, _e = boxes[b'stsz']
+        self.sample_size, self.count = struct.unpack_from('>II', moov, s + 4)
+        self.sizes = None if self.sample_size else _table(moov, s + 12, self.count)
+
+        if b'stco' in boxes:
+            s, _e = boxes[b'stco']
+            n, = struct.unpack_from('>I', moov, s + 4)
+            offsets = _table(moov, s + 8, n)
+        elif b'co64' in boxes:
+            s, _e = boxes[b'co64']
+            n, = struct.unpack_from('>I', moov, s + 4)
+            offsets = _table(moov, s + 8, n, 'Q')
+        else:
+            raise RemuxUnsupported(f"{path.name}: no chunk offsets")
+
+        s, _e = boxes[b'stsc']
+        n, = struct.unpack_from('>I', moov, s + 4)
+        stsc = _table(moov, s + 8, n * 3)
+        if any(stsc[i + 2] != 1 for i in range(0, len(stsc), 3)):
+            raise RemuxUnsupported(f"{path.name}: several sample descriptions")
+        per_chunk = array('I')
+        for i in range(0, len(stsc), 3):
+            first = stsc[i]
+            nxt = stsc[i + 3] if i + 3 < len(stsc) else len(offsets) + 1
+            per_chunk.extend([stsc[i + 1]] * (nxt - first))
+        if len(per_chunk) != len(offsets) or sum(per_chunk) != self.count:
+            raise RemuxUnsupported(f"{path.name}: inconsistent sample-to-chunk table")
+        self.per_chunk = per_chunk
+
+        # (смещение, длина) каждого чанка; соседние чанки подряд сливаются в один диапазон копирования
+        self.chunks = []
+        idx = 0
+        for off, n in zip(offsets, per_chunk):
+            size = n * self.sample_size if self.sample_size else sum(self.sizes[idx:idx + n])
+            self.chunks.append((off, size))
+            idx += n
+        self._totals()
+
+    def _totals(self):
+        self.ranges = []
+        for off, size in self.chunks:
+            if self.ranges and self.ranges[-1][0] + self.ranges[-1][1] == off:
+                self.ranges[-1][1] += size
+            else:
+                self.ranges.append([off, size])
+        self.data_bytes = sum(size for _off, size in self.chunks)
+        self.duration = sum(self.stts[i] * self.stts[i + 1] for i in range(0, len(self.stts), 2))
+
+    def drop_priming(self):
+        """
+        Убирает из таблиц и диапазонов копирования целые сэмплы в пределах media_time (AAC priming),
+        чтобы на стыке глав не было щелчка и метки не уезжали. Остаток меньше кадра остаётся в media_time.
+        """
+        dropped, t, stts, cutting = 0, 0, array('I'), True
+        for i in range(0, len(self.stts), 2):
+            count, delta = self.stts[i], self.stts[i + 1]
+            take = min(count, (self.media_time - t) // delta) if cutting and delta else 0
+            dropped += take
+            t += take * delta
+            if take < count:
+                cutting = False
+                stts.extend((count - take, delta))
+        if not dropped:
+            return
+        if dropped >= self.count:
+            raise RemuxUnsupported(f"{self.path.name}: edit list skips the whole track")
+        chunks, per_chunk, left, idx = [], array('I'), dropped, 0
+        for (off, size), n in zip(self.chunks, self.per_chunk):
+            if left >= n:
+                left -= n
+                idx += n
+                continue
+            if left:
+                cut = sum(self.sizes[idx:idx + left]) if self.sizes is not None else left * self.sample_size
+                off, size, n, idx, left = off + cut, size - cut, n - left, idx + left, 0
+            chunks.append((off, size))
+            per_chunk.append(n)
+        if self.sizes is not None:
+            self.sizes = self.sizes[dropped:]
+        self.chunks, self.per_chunk, self.stts = chunks, per_chunk, stts
+        self.count -= dropped
+        self.media_time -= t
+        self._totals()
+
+    @staticmethod
+    def _read_moov(f):
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        pos = 0
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            head = f.read(16)
+            size, kind = struct.unpack_from('>I4s', head)
+            header = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', head, 8)[0]
+                header = 16
+            elif size == 0:
+                size = file_size - pos
+            if size < header:
+                raise RemuxUnsupported("broken top-level box")
+            if kind == b'moov':
+                return f.read(size - header) if header == 16 else head[8:] + f.read(size - 16)
+            if kind == b'moof':
+                raise RemuxUnsupported("fragmented MP4")
+            pos += size
+        raise RemuxUnsupported("no moov box")
+
+
+def _ilst(metadata, cover):
+    items = []
+    for key, value in metadata.items():
+        tag = _ILST_TAGS.get(key)
+        if tag and value:
+            items.append(_box(tag, _box(b'data', struct.pack('>II', 1, 0), str(value).encode('utf-8'))))
+    if str(metadata.get('media_type', '')).isdigit():
+        items.append(_box(b'stik', _box(b'data', struct.pack('>II', 21, 0), bytes([int(metadata['media_type'])]))))
+    if cover:
+        kind = 14 if cover.suffix.lower() == '.png' else 13
+        items.append(_box(b'covr', _box(b'data', struct.pack('>II', kind, 0), cover.read_bytes())))
+    hdlr = _full_box(b'hdlr', 0, 0, struct.pack('>I4sIII', 0, b'mdir', 0x6170706C, 0, 0), b'\0')
+    return _full_box(b'meta', 0, 0, hdlr, _box(b'ilst', *items))
+
+
+def _chpl(marks):
+    """Главы Nero (chpl): время в 100 нс, не больше 255 записей."""
+    body = [struct.pack('>IB', 0, min(len(marks), 255))]
+    for start, title in marks[:255]:
+        name = title.encode('utf-8')[:255]
+        body.append(struct.pack('>QB', start * 10_000, len(name)) + name)
+    return _full_box(b'chpl', 1, 0, *body)
+
+
+def _lang_code(language):
+    code = _LANGUAGES.get((language or '').lower(), language if language and len(language) == 3 else 'und')
+    packed = 0
+    for ch in code.lower()[:3]:
+        packed = (packed << 5) | ((ord(ch) - 0x60) & 0x1F)
+    return struct.pack('>H', packed)
+
+
+def _mdhd(timescale, duration, language):
+    if duration > 0xFFFFFFFF:
+        return _full_box(b'mdhd', 1, 0, struct.pack('>QQIQ', 0, 0, timescale, duration), language, b'\0\0')
+    return _full_box(b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, timescale, duration), language, b'\0\0')
+
+
+_MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+# mvhd после длительности: rate, volume, reserved, matrix, pre_defined, next_track_ID
+_MVHD_TAIL = (struct.pack('>IH10x', 0x10000, 0x0100), _MATRIX, b'\0' * 24, struct.pack('>I', 3))
+
+
+def _tkhd(track_id, duration, flags, volume):
+    v1 = duration > 0xFFFFFFFF
+    times = struct.pack('>QQIIQ', 0, 0, track_id, 0, duration) if v1 else struct.pack('>IIIII', 0, 0, track_id, 0, duration)
+    return _full_box(b'tkhd', int(v1), flags, times, struct.pack('>8xHHHH', 0, 0, volume, 0), _MATRIX, struct.pack('>II', 0, 0))
+
+
+def _stbl(stsd, stts, stsc, sample_size, sizes, count, offsets):
+    co64 = offsets and max(offsets) > _STCO_LIMIT
+    return _box(b'stbl',
+                stsd,
+                _full_box(b'stts', 0, 0, struct.pack('>I', len(stts) // 2), _be(stts)),
+                _full_box(b'stsc', 0, 0, struct.pack('>I', len(stsc) // 3), _be(stsc)),
+                _full_box(b'stsz', 0, 0, struct.pack('>II', sample_size, count), _be(sizes) if sizes is not None else b''),
+                _full_box(b'co64', 0, 0, struct.pack('>I', len(offsets)), _be(array('Q', offsets))) if co64 else
+                _full_box(b'stco', 0, 0, struct.pack('>I', len(offsets)), _be(array('I', offsets))))
+
+
+def _runs(values):
+    """Сжатие [(кол-во, значение)…] / stsc: соседние одинаковые значения — одной записью."""
+    out = array('I')
+    for count, value in values:
+        if len(out) and out[-1] == value:
+            out[-2] += count
+        else:
+            out.extend((count, value))
+    return out
+
+
+def merge_audiobook_chapters_remux(audiobook_dir, output_file, metadata=None, cleanup_chapters=True,
+                                   chunk_size=4 << 20):
+    """
+    Склейка глав без ffmpeg: ремукс MP4 с переписанными таблицами stbl и копированием mdat
+    блоками chunk_size. RemuxUnsupported — главы так не склеить (вызывающий берёт ffmpeg).
+    Returns True on success.
+    """
+    import time
+
+    audiobook_path = Path(audiobook_dir)
+    chapter_files = sorted([f for f in audiobook_path.glob("*.m4a") if re.fullmatch(r'Глава_\d+\.m4a', f.name)],
+                           key=lambda x: int(re.search(r'\d+', x.name).group()))
+    if not chapter_files:
+        print(f"No chapter files found in {audiobook_path}")
+        return False
+    started = time.monotonic()
+    chapters = [_Chapter(p) for p in chapter_files]
+    first = chapters[0]
+    # priming первой главы пропускается edit list'ом склейки, у остальных — выбрасывается
+    for ch in chapters[1:]:
+        ch.drop_priming()
+    for ch in chapters[1:]:
+        if ch.codec != first.codec:
+            raise RemuxUnsupported(f"{ch.path.name}: audio parameters differ from {first.path.name}")
+    print(f"Found {len(chapters)} chapters, merging in-process (MP4 remux)...")
+
+    metadata = dict(metadata or {'title': audiobook_path.name, 'genre': 'Audiobook', 'media_type': '2'})
+    cover = next((p for p in (audiobook_path / f"{audiobook_path.name}{ext}" for ext in ('.jpeg', '.jpg', '.png'))
+                  if p.exists()), None)
+    timescale = first.timescale
+
+    # таблицы склеенной дорожки
+    stts = _runs((ch.stts[i], ch.stts[i + 1]) for ch in chapters for i in range(0, len(ch.stts), 2))
+    stsc_runs = []
+    chunk_no = 0
+    for ch in chapters:
+        for n in ch.per_chunk:
+            chunk_no += 1
+            if not stsc_runs or stsc_runs[-1][1] != n:
+                stsc_runs.append((chunk_no, n))
+    stsc = array('I', [v for first_chunk, n in stsc_runs for v in (first_chunk, n, 1)])
+    const = first.sample_size if all(ch.sample_size == first.sample_size for ch in chapters) else 0
+    sizes = None
+    if not const:
+        sizes = array('I')
+        for ch in chapters:
+            sizes.extend(ch.sizes if ch.sizes is not None else array('I', [ch.sample_size]) * ch.count)
+    count = sum(ch.count for ch in chapters)
+    total = sum(ch.duration for ch in chapters)
+
+    # метки глав (мс) в шкале воспроизведения: с учётом priming первой главы
+    marks, t = [], 0
+    for ch, title in zip(chapters, _chapter_titles(audiobook_path, chapter_files)):
+        marks.append((max(0, round((t - first.media_time) * 1000 / timescale)), title))
+        t += ch.duration
+    total_ms = max(1, round((total - first.media_time) * 1000 / timescale))
+    text_samples = [struct.pack('>H', len(title.encode('utf-8'))) + title.encode('utf-8') +
+                    struct.pack('>I4sI', 12, b'encd', 0x100) for _start, title in marks]
+    text_durations = [(marks[i + 1][0] if i + 1 < len(marks) else total_ms) - marks[i][0] for i in range(len(marks))]
+
+    ftyp = _box(b'ftyp', b'M4A ', struct.pack('>I', 0x200), b'M4A mp42isom')
+    payload = sum(ch.data_bytes for ch in chapters) + sum(len(s) for s in text_samples)
+    mdat_header = (struct.pack('>I4sQ', 1, b'mdat', payload + 16) if payload + 8 > 0xFFFFFFFF
+                   else struct.pack('>I4s', payload + 8, b'mdat'))
+    pos = len(ftyp) + len(mdat_header)
+    offsets = []
+    for ch in chapters:
+        # диапазоны копируются в порядке чанков, так что чанки в выходном mdat идут подряд
+        for _off, size in ch.chunks:
+            offsets.append(pos)
+            pos += size
+    text_offsets = []
+    for s in text_samples:
+        text_offsets.append(pos)
+        pos += len(s)
+
+    language = _lang_code(metadata.get('language')) if metadata.get('language') else first.language
+    movie_total = total_ms  # movie timescale = 1000
+    audio_trak = _box(
+        b'trak',
+        _tkhd(1, movie_total, 3, 0x0100),
+        _box(b'edts', _full_box(b'elst', 1, 0, struct.pack('>IQqI', 1, movie_total, first.media_time, 0x10000)))
+        if first.media_time else b'',
+        _box(b'tref', _box(b'chap', struct.pack('>I', 2))),
+        _box(b'mdia',
+             _mdhd(timescale, total, language),
+             _full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'soun'), b'SoundHandler\0'),
+             _box(b'minf',
+                  _full_box(b'smhd', 0, 0, b'\0\0\0\0'),
+                  _box(b'dinf', _full_box(b'dref', 0, 0, struct.pack('>I', 1), _full_box(b'url ', 0, 1))),
+                  _stbl(_box(b'stsd', first.stsd), stts, stsc, const, sizes, count, offsets))))
+    text_entry = _box(b'text', b'\0' * 6, struct.pack('>H', 1), bytes([
+        0, 0, 0, 1, 0, 0, 0, 0, 0, 0,               # displayFlags, justification, background
+        0, 0, 0, 0, 0, 0, 0, 0,                     # default text box
+        0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0,         # style record
+        0, 0, 0, 13, 0x66, 0x74, 0x61, 0x62, 0, 1, 0, 1, 0]))  # ftab: один шрифт без имени
+    text_trak = _box(
+        b'trak',
+        _tkhd(2, movie_total, 0, 0),
+        _box(b'mdia',
+             _mdhd(1000, total_ms, language),
+             _full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'text'), b'SubtitleHandler\0'),
+             _box(b'minf',
+                  _box(b'gmhd',
+                       _full_box(b'gmin', 0, 0, struct.pack('>HHHHhH', 0x40, 0x8000, 0x8000, 0x8000, 0, 0)),
+                       _box(b'text', struct.pack('>H8IH', 1, 0, 0, 0, 1, 0, 0, 0, 0x4000, 0))),
+                  _box(b'dinf', _full_box(b'dref', 0, 0, struct.pack('>I', 1), _full_box(b'url ', 0, 1))),
+                  _stbl(_full_box(b'stsd', 0, 0, struct.pack('>I', 1), text_entry),
+                        _runs((1, d) for d in text_durations),
+                        array('I', [1, 1, 1]), 0, array('I', [len(s) for s in text_samples]),
+                        len(text_samples), text_offsets))))
+    mvhd = (_full_box(b'mvhd', 1, 0, struct.pack('>QQIQ', 0, 0, 1000, movie_total), *_MVHD_TAIL)
+            if movie_total > 0xFFFFFFFF else
+            _full_box(b'mvhd', 0, 0, struct.pack('>IIII', 0, 0, 1000, movie_total), *_MVHD_TAIL))
+    moov = _box(b'moov', mvhd, audio_trak, text_trak,
+                _box(b'udta', _chpl(marks), _ilst(metadata, cover)))
+
+    output_file = Path(output_file)
+    tmp = output_file.with_name(output_file.name + '.part')
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    try:
+        with open(tmp, 'wb') as out:
+            out.write(ftyp)
+            out.write(mdat_header)
+            for ch in chapters:
+                with open(ch.path, 'rb', buffering=0) as src:
+                    for off, length in ch.ranges:
+                        src.seek(off)
+                        while length:
+                            n = src.readinto(view[:min(length, chunk_size)])
+                            if not n:
+                                raise RemuxUnsupported(f"{ch.path.name}: truncated media data")
+                            out.write(view[:n])
+                            length -= n
+            for s in text_samples:
+                out.write(s)
+            out.write(moov)
+        os.replace(tmp, output_file)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        raise
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"✅ Successfully merged audiobook: {output_file}")
+    print(f"   {total_ms / 3600000:.2f} h, {payload / (1 << 20):.1f} MB in {elapsed:.2f} s "
+          f"({payload / elapsed / (1 << 20):.0f} MB/s), {len(marks)} chapters")
+    if cleanup_chapters:
+        for chapter_file in chapter_files:
+            try:
+                chapter_file.unlink()
+            except OSError as e:
+                print(f" ⚠️ Could not remove {chapter_file.name}: {e}")
+    return True
+
+
+def merge_audiobook_chapters(audiobook_dir, output_file, metadata=None, cleanup_chapters=True):
+    """
+    Склейка глав: встроенный ремукс; если главы так не склеить — ffmpeg (-c copy),
+    а если и он не справился — перекодирование потоком. Returns True on success.
+    """
+    import shutil
+    try:
+        return merge_audiobook_chapters_remux(audiobook_dir, output_file, metadata, cleanup_chapters)
+    except RemuxUnsupported as e:
+        print(f"ℹ️ In-process remux is not possible ({e}), falling back to ffmpeg")
+    except OSError as e:
+        print(f"⚠️ In-process remux failed ({e}), falling back to ffmpeg")
+    if not shutil.which('ffmpeg'):
+        print("❌ ffmpeg not found, cannot merge these chapters")
+        return False
+    # склейка -c copy меряет главы через ffprobe; без него — сразу перекодирование потоком
+    if shutil.which('ffprobe') and merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata, cleanup_chapters):
+        return True
+    return merge_audiobook_chapters_stream(audiobook_dir, output_file, metadata, cleanup_chapters)
+
 def extract_metadata_from_json(folder: Path):
     try:
-        json_file = next(folder.glob("*.json"), None)
+        json_file = folder / f"{folder.name}.json"
+        if not json_file.exists():
+            json_file = next((p for p in folder.glob("*.json") if not p.name.startswith(".")), None)
         if not json_file:
             return None
         info = json.loads(json_file.read_text(encoding='utf-8'))
@@ -132,22 +875,8 @@ def merge_one(folder: Path, force=False, keep_chapters=False):
         return
 
     metadata = extract_metadata_from_json(folder)
-    ok = merge_audiobook_chapters_ffmpeg(folder, output, metadata, cleanup_chapters=not keep_chapters)
-    if not ok:
-        # fallback pydub — если установлена
-        try:
-            from pydub import AudioSegment
-        except ImportError:
-            return
-        files = sorted(glob.glob(str(folder / "Глава_*.m4a")),
-                       key=lambda x: int(re.search(r'Глава_(\d+)\.m4a', x).group(1)) if re.search(r'Глава_(\d+)\.m4a', x) else 0)
-        if not files:
-            return
-        merged = AudioSegment.empty()
-        for f in files:
-            merged += AudioSegment.from_file(f)
-        merged.export(str(folder / f"{folder.name}.m4a"), format="mp4")
-        print(f"[ok] pydub => {folder / f'{folder.name}.m4a'}")
+    # ремукс без ffmpeg; fallback — ffmpeg -c copy, затем перекодирование потоком
+    merge_audiobook_chapters(folder, output, metadata, cleanup_chapters=not keep_chapters)
 
 def main():
     ap = argparse.ArgumentParser(description="Merge audiobook chapters into a single file.")